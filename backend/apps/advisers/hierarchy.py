@@ -0,0 +1,204 @@
+"""
+Работа с иерархией консультантов: цепочки руководителей для расчета оверрайдов
+и closure-таблица AdviserHierarchy для фильтрации по поддереву.
+
+Цепочки кэшируются. Ключи содержат общую версию иерархии, которая меняется
+при изменении parent_adviser или fee_percentage любого консультанта
+(см. signals.py): такое изменение затрагивает цепочки всех его подчиненных,
+а смена версии инвалидирует их разом, без поиска поддерева.
+"""
+import uuid
+from collections import defaultdict, namedtuple
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Adviser, AdviserHierarchy
+
+
+# Облегченное представление консультанта в цепочке (без загрузки моделей Adviser/User)
+AdviserLink = namedtuple('AdviserLink', ['id', 'parent_id', 'fee_percentage', 'full_name'])
+
+CHAIN_VERSION_KEY = 'advisers:chain:version'
+CHAIN_CACHE_TIMEOUT = 60 * 60
+# Ограничение глубины рекурсии на случай циклов в некорректно заполненной иерархии
+MAX_HIERARCHY_DEPTH = 50
+# Запас относительно лимита параметров SQLite (999)
+QUERY_BATCH_SIZE = 500
+
+
+def _full_name(first_name, last_name):
+    """Аналог AbstractUser.get_full_name() без загрузки пользователя."""
+    return f"{first_name or ''} {last_name or ''}".strip()
+
+
+def _chain_version():
+    version = cache.get(CHAIN_VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.add(CHAIN_VERSION_KEY, version, timeout=None)
+        version = cache.get(CHAIN_VERSION_KEY, version)
+    return version
+
+
+def _chain_key(version, adviser_id):
+    return f'advisers:chain:{version}:{adviser_id}'
+
+
+def get_hierarchy_version():
+    """
+    Текущая версия иерархии. Меняется при каждом изменении parent_adviser
+    или fee_percentage; ее можно включать в ключи кэша, зависящие от иерархии.
+    """
+    return _chain_version()
+
+
+def invalidate_ancestor_chains():
+    """Инвалидирует все закэшированные цепочки руководителей."""
+    cache.set(CHAIN_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def _load_ancestor_chains(adviser_ids):
+    """Загружает цепочки для всех adviser_ids одним рекурсивным запросом на пакет."""
+    adviser_table = Adviser._meta.db_table
+    user_table = get_user_model()._meta.db_table
+    chains = {adviser_id: [] for adviser_id in adviser_ids}
+    adviser_ids = list(adviser_ids)
+
+    for start in range(0, len(adviser_ids), QUERY_BATCH_SIZE):
+        batch = adviser_ids[start:start + QUERY_BATCH_SIZE]
+        placeholders = ', '.join(['%s'] * len(batch))
+        query = f"""
+            WITH RECURSIVE chain (origin_id, adviser_id, depth) AS (
+                SELECT id, id, 0 FROM {adviser_table} WHERE id IN ({placeholders})
+                UNION ALL
+                SELECT chain.origin_id, a.parent_adviser_id, chain.depth + 1
+                FROM chain JOIN {adviser_table} a ON a.id = chain.adviser_id
+                WHERE a.parent_adviser_id IS NOT NULL AND chain.depth < %s
+            )
+            SELECT a.id, a.parent_adviser_id, a.fee_percentage,
+                   u.first_name AS user_first_name, u.last_name AS user_last_name,
+                   chain.origin_id, chain.depth
+            FROM chain
+            JOIN {adviser_table} a ON a.id = chain.adviser_id
+            JOIN {user_table} u ON u.id = a.user_id
+            ORDER BY chain.origin_id, chain.depth
+        """
+        for adviser in Adviser.objects.raw(query, [*batch, MAX_HIERARCHY_DEPTH]):
+            chain = chains[adviser.origin_id]
+            link = AdviserLink(
+                adviser.id, adviser.parent_adviser_id, adviser.fee_percentage,
+                _full_name(adviser.user_first_name, adviser.user_last_name),
+            )
+            # Цепочка обрывается на первом повторе (цикл в иерархии)
+            if not any(existing.id == link.id for existing in chain) and len(chain) == adviser.depth:
+                chain.append(link)
+    return chains
+
+
+def get_ancestor_chains(adviser_ids):
+    """
+    Возвращает словарь {adviser_id: [консультант, его руководитель, ..., верхний уровень]}.
+
+    Цепочки берутся из кэша; недостающие загружаются одним запросом
+    сразу для всех консультантов, поэтому стоимость не зависит от глубины иерархии.
+    """
+    adviser_ids = set(adviser_ids)
+    if not adviser_ids:
+        return {}
+    version = _chain_version()
+    keys = {_chain_key(version, adviser_id): adviser_id for adviser_id in adviser_ids}
+    cached = cache.get_many(keys.keys())
+    chains = {keys[key]: [AdviserLink(*link) for link in value] for key, value in cached.items()}
+
+    missing = adviser_ids - chains.keys()
+    if missing:
+        loaded = _load_ancestor_chains(missing)
+        cache.set_many(
+            {_chain_key(version, adviser_id): [tuple(link) for link in chain] for adviser_id, chain in loaded.items()},
+            timeout=CHAIN_CACHE_TIMEOUT,
+        )
+        chains.update(loaded)
+    return chains
+
+
+def get_ancestor_chain(adviser_id):
+    """Цепочка руководителей для одного консультанта (см. get_ancestor_chains)."""
+    return get_ancestor_chains([adviser_id])[adviser_id]
+
+
+# --- Closure-таблица иерархии ---
+
+def descendant_ids_subquery(adviser):
+    """Подзапрос с id консультанта и всех его подчиненных любого уровня."""
+    return AdviserHierarchy.objects.filter(ancestor=adviser).values('descendant_id')
+
+
+def is_in_subtree(root_id, adviser_id):
+    """Входит ли adviser_id в поддерево root_id (включая сам root_id)."""
+    return AdviserHierarchy.objects.filter(ancestor_id=root_id, descendant_id=adviser_id).exists()
+
+
+@transaction.atomic
+def move_subtree(adviser_id, new_parent_id, batch_size=1000):
+    """
+    Переносит поддерево консультанта под нового руководителя (или в корень при None).
+    Связи поддерева с прежними руководителями удаляются, с новыми — создаются
+    декартовым произведением (предки нового руководителя) x (поддерево).
+    """
+    AdviserHierarchy.objects.get_or_create(ancestor_id=adviser_id, descendant_id=adviser_id, defaults={'depth': 0})
+    subtree = list(AdviserHierarchy.objects.filter(ancestor_id=adviser_id).values_list('descendant_id', 'depth'))
+    subtree_ids = [descendant_id for descendant_id, _ in subtree]
+
+    AdviserHierarchy.objects.filter(descendant_id__in=subtree_ids).exclude(ancestor_id__in=subtree_ids).delete()
+    if new_parent_id is None:
+        return
+
+    ancestors = AdviserHierarchy.objects.filter(descendant_id=new_parent_id).values_list('ancestor_id', 'depth')
+    AdviserHierarchy.objects.bulk_create(
+        [
+            AdviserHierarchy(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=ancestor_depth + depth + 1)
+            for ancestor_id, ancestor_depth in ancestors
+            for descendant_id, depth in subtree
+        ],
+        batch_size=batch_size,
+    )
+
+
+@transaction.atomic
+def rebuild_hierarchy(batch_size=1000):
+    """
+    Полностью перестраивает closure-таблицу по полю parent_adviser.
+    Возвращает количество созданных связей.
+    """
+    parents = dict(Adviser.objects.values_list('id', 'parent_adviser_id'))
+    children = defaultdict(list)
+    for adviser_id, parent_id in parents.items():
+        children[parent_id].append(adviser_id)
+
+    AdviserHierarchy.objects.all().delete()
+    created = 0
+    links = []
+    # Обход от корней; консультанты в циклах (без корня) получают только связь с собой
+    roots = [adviser_id for adviser_id, parent_id in parents.items() if parent_id is None or parent_id not in parents]
+    ancestors_of = {root: [] for root in roots}
+    queue = list(roots)
+    while queue:
+        adviser_id = queue.pop()
+        chain = [adviser_id] + ancestors_of[adviser_id]
+        links.extend(
+            AdviserHierarchy(ancestor_id=ancestor_id, descendant_id=adviser_id, depth=depth)
+            for depth, ancestor_id in enumerate(chain)
+        )
+        for child_id in children[adviser_id]:
+            ancestors_of[child_id] = chain
+            queue.append(child_id)
+        if len(links) >= batch_size:
+            created += len(AdviserHierarchy.objects.bulk_create(links, batch_size=batch_size))
+            links = []
+
+    cyclic = parents.keys() - ancestors_of.keys()
+    links.extend(AdviserHierarchy(ancestor_id=adviser_id, descendant_id=adviser_id, depth=0) for adviser_id in cyclic)
+    created += len(AdviserHierarchy.objects.bulk_create(links, batch_size=batch_size))
+    return created
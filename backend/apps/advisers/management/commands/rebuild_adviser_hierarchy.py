@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from backend.apps.advisers.hierarchy import invalidate_ancestor_chains, rebuild_hierarchy
+
+
+class Command(BaseCommand):
+    """
+    Полностью перестраивает closure-таблицу AdviserHierarchy по полю parent_adviser.
+    Нужна для существующих данных и после массовых изменений иерархии через update().
+    """
+    help = "Перестраивает closure-таблицу иерархии консультантов"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Размер пакета для bulk_create")
+
+    def handle(self, *args, **options):
+        self.stdout.write("Перестраиваем иерархию консультантов...")
+        created = rebuild_hierarchy(batch_size=options['batch_size'])
+        invalidate_ancestor_chains()
+        self.stdout.write(self.style.SUCCESS(f"Готово: создано {created} связей иерархии."))
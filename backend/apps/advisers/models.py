@@ -53,3 +53,28 @@ class Adviser(models.Model):
     class Meta:
         verbose_name = "Консультант"
         verbose_name_plural = "Консультанты"
+
+
+class AdviserHierarchy(models.Model):
+    """
+    Closure-таблица иерархии консультантов: по строке на каждую пару
+    (руководитель любого уровня, подчиненный), включая пару консультанта с самим собой.
+    Поддерживается сигналами при изменении parent_adviser; полная перестройка —
+    команда rebuild_adviser_hierarchy.
+    """
+    ancestor = models.ForeignKey(Adviser, on_delete=models.CASCADE, related_name='descendant_links')
+    descendant = models.ForeignKey(Adviser, on_delete=models.CASCADE, related_name='ancestor_links')
+    depth = models.PositiveIntegerField(help_text="0 — сам консультант, 1 — прямой руководитель и т.д.")
+
+    class Meta:
+        verbose_name = "Связь иерархии консультантов"
+        verbose_name_plural = "Иерархия консультантов"
+        constraints = [
+            models.UniqueConstraint(fields=['ancestor', 'descendant'], name='unique_adviser_hierarchy_link'),
+        ]
+        indexes = [
+            models.Index(fields=['descendant', 'depth']),
+        ]
+
+    def __str__(self):
+        return f"{self.ancestor_id} -> {self.descendant_id} ({self.depth})"
@@ -5,7 +5,7 @@ from .models import Adviser
 class RecursiveAdviserSerializer(serializers.Serializer):
     """Вспомогательный сериализатор для рекурсивного отображения руководителя."""
     def to_representation(self, value):
-        serializer = self.parent.parent.__class__(value, context=self.context)
+        serializer = self.parent.__class__(value, context=self.context)
         return serializer.data
 
 
@@ -1,8 +1,17 @@
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
 
+from .hierarchy import invalidate_ancestor_chains, is_in_subtree, move_subtree
+from .models import Adviser
+
+# Поля консультанта, от которых зависят закэшированные цепочки руководителей
+HIERARCHY_FIELDS = ('parent_adviser_id', 'fee_percentage')
+
+
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def create_auth_token(sender, instance=None, created=False, **kwargs):
     """
@@ -11,3 +20,49 @@ def create_auth_token(sender, instance=None, created=False, **kwargs):
     if created:
         Token.objects.create(user=instance)
 
+
+@receiver(pre_save, sender=Adviser)
+def track_hierarchy_change(sender, instance, **kwargs):
+    """
+    Запоминает, изменились ли поля иерархии, чтобы после сохранения
+    инвалидировать кэш цепочек руководителей.
+    """
+    if instance.pk is None:
+        instance._hierarchy_changed = instance.parent_adviser_id is not None
+        return
+
+    old_values = Adviser.objects.filter(pk=instance.pk).values(*HIERARCHY_FIELDS).first()
+    instance._hierarchy_changed = old_values is None or any(
+        old_values[field] != getattr(instance, field) for field in HIERARCHY_FIELDS
+    )
+    instance._parent_changed = old_values is None or old_values['parent_adviser_id'] != instance.parent_adviser_id
+
+    if instance._parent_changed and instance.parent_adviser_id and is_in_subtree(instance.pk, instance.parent_adviser_id):
+        raise ValidationError("Нельзя назначить руководителем собственного подчиненного.")
+
+
+@receiver(post_save, sender=Adviser)
+def update_hierarchy_closure(sender, instance, created, **kwargs):
+    """Поддерживает closure-таблицу AdviserHierarchy при создании и смене руководителя."""
+    if created or getattr(instance, '_parent_changed', True):
+        move_subtree(instance.pk, instance.parent_adviser_id)
+
+
+@receiver(pre_delete, sender=Adviser)
+def detach_subordinates(sender, instance, **kwargs):
+    """
+    При удалении консультанта его подчиненные становятся корнями (parent_adviser
+    обнуляется через SET_NULL без сигналов), поэтому их поддеревья отвязываем заранее.
+    """
+    for subordinate_id in instance.subordinates.values_list('id', flat=True):
+        move_subtree(subordinate_id, None)
+
+
+@receiver(post_save, sender=Adviser)
+@receiver(post_delete, sender=Adviser)
+def invalidate_hierarchy_cache(sender, instance, **kwargs):
+    """Инвалидирует цепочки сразу и повторно после коммита (на случай конкурентного чтения)."""
+    if kwargs.get('signal') is post_save and not getattr(instance, '_hierarchy_changed', True):
+        return
+    invalidate_ancestor_chains()
+    transaction.on_commit(invalidate_ancestor_chains)
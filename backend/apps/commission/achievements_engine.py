@@ -1,16 +1,149 @@
-from .models import Deal, Badge, Achievement
+"""
+Достижения консультантов.
+
+Счетчики AdviserAchievementCounters выводятся из месячных продаж консультанта
+(AdviserMonthlySales) одним чтением его месяцев. Сохранение комиссии их не
+трогает: RollupDeltas (rollups.py) после коммита ставит задачу record_sales_task,
+которая пересчитывает счетчики затронутых консультантов и проверяет значки.
+Пересчет идемпотентен, поэтому повтор или запоздание задачи ничего не портят.
+
+Определения значков загружаются один раз и живут в памяти процесса;
+их актуальность определяется версией в общем кэше, которую меняет любое
+изменение значков (signals.py). Проверка любого числа значков для пачки
+консультантов стоит постоянного числа запросов: счетчики, уже выданные
+значки и один bulk INSERT новых.
+"""
+import uuid
+from collections import defaultdict, namedtuple
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Achievement, AdviserAchievementCounters, AdviserMonthlySales, Badge
+
+
+BADGES_VERSION_KEY = 'commission:badges:version'
+
+BadgeDefinition = namedtuple('BadgeDefinition', ['id', 'metric', 'threshold'])
+
+_badges = {'version': None, 'badges': None}
+
+
+def _badges_version():
+    version = cache.get(BADGES_VERSION_KEY)
+    if version is None:
+        cache.add(BADGES_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(BADGES_VERSION_KEY)
+    return version
+
+
+def invalidate_badges():
+    """Помечает загруженные определения значков устаревшими во всех процессах."""
+    cache.set(BADGES_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def get_badges():
+    """Активные значки текущей версии (перезагружаются при изменении значков)."""
+    version = _badges_version()
+    if _badges['version'] != version:
+        _badges['badges'] = [
+            BadgeDefinition(*row)
+            for row in Badge.objects.filter(is_active=True).order_by('id').values_list('id', 'metric', 'threshold')
+        ]
+        _badges['version'] = version
+    return _badges['badges']
+
+
+def month_streaks(months):
+    """(текущая серия, лучшая серия) по месяцам с продажами, отсортированным по убыванию."""
+    runs, previous = [], None
+    for month in months:
+        index = month.year * 12 + month.month
+        if previous is not None and index == previous - 1:
+            runs[-1] += 1
+        else:
+            runs.append(1)
+        previous = index
+    return (runs[0] if runs else 0), max(runs, default=0)
+
+
+def refresh_counters(adviser_ids):
+    """
+    Пересчитывает счетчики консультантов (число сделок, объем, серии месяцев)
+    по их месячным продажам: одно чтение и один bulk upsert на весь набор.
+    """
+    months, totals = defaultdict(list), defaultdict(lambda: [0, Decimal('0')])
+    rows = AdviserMonthlySales.objects.filter(adviser_id__in=adviser_ids, commission_count__gt=0).order_by(
+        'adviser_id', '-month'
+    ).values_list('adviser_id', 'month', 'commission_count', 'net_total')
+    for adviser_id, month, commission_count, net_total in rows:
+        months[adviser_id].append(month)
+        totals[adviser_id][0] += commission_count
+        totals[adviser_id][1] += net_total
+    counters = []
+    for adviser_id in sorted(adviser_ids):
+        current, best = month_streaks(months[adviser_id])
+        commission_count, net_volume = totals[adviser_id]
+        counters.append(AdviserAchievementCounters(
+            adviser_id=adviser_id, commission_count=commission_count, net_volume=net_volume,
+            month_streak=current, best_month_streak=best,
+        ))
+    AdviserAchievementCounters.objects.bulk_create(
+        counters,
+        update_conflicts=True,
+        unique_fields=['adviser'],
+        update_fields=['commission_count', 'net_volume', 'month_streak', 'best_month_streak'],
+    )
+
+
+def award_achievements(adviser_ids):
+    """Присуждает консультантам заработанные значки. Возвращает новые достижения."""
+    badges = get_badges()
+    if not badges or not adviser_ids:
+        return []
+    metrics = [metric for metric, _ in Badge.Metric.choices]
+    earned = set()
+    for adviser_id, *values in AdviserAchievementCounters.objects.filter(adviser_id__in=adviser_ids).values_list(
+        'adviser_id', *metrics
+    ):
+        counters = dict(zip(metrics, values))
+        earned.update((adviser_id, badge.id) for badge in badges if counters[badge.metric] >= badge.threshold)
+    if not earned:
+        return []
+    existing = set(Achievement.objects.filter(
+        adviser_id__in={adviser_id for adviser_id, _ in earned},
+        badge_id__in={badge_id for _, badge_id in earned},
+    ).values_list('adviser_id', 'badge_id'))
+    awards = [Achievement(adviser_id=adviser_id, badge_id=badge_id) for adviser_id, badge_id in sorted(earned - existing)]
+    return Achievement.objects.bulk_create(awards, ignore_conflicts=True)
+
+
+def record_sales(adviser_ids):
+    """
+    Вызывается задачей record_sales_task после изменения месячных продаж:
+    пересчитывает счетчики консультантов `adviser_ids` и проверяет их значки.
+    """
+    adviser_ids = list(adviser_ids)
+    refresh_counters(adviser_ids)
+    return award_achievements(adviser_ids)
+
 
 def check_for_new_achievements(user):
     """
     Проверяет и присваивает пользователю новые достижения.
     """
-    # Пример 1: Значок за первую сделку
-    try:
-        first_deal_badge = Badge.objects.get(name="First Deal")
-        if Deal.objects.filter(user=user).count() == 1:
-             # Проверяем, что у пользователя еще нет этого значка
-            if not Achievement.objects.filter(user=user, badge=first_deal_badge).exists():
-                Achievement.objects.create(user=user, badge=first_deal_badge)
-    except Badge.DoesNotExist:
-        # Создаем значок, если его нет
-        Badge.objects.create(name="First Deal", description="Awarded for creating your first deal.", icon="fas fa-handshake")
+    adviser = getattr(user, 'adviser_profile', None)
+    if adviser is None:
+        return []
+    return award_achievements([adviser.id])
+
+
+@transaction.atomic
+def rebuild_counters(batch_size=1000):
+    """Пересобирает счетчики достижений по месячным продажам. Возвращает количество строк."""
+    adviser_ids = list(AdviserMonthlySales.objects.order_by('adviser_id').values_list('adviser_id', flat=True).distinct())
+    AdviserAchievementCounters.objects.all().delete()
+    for start in range(0, len(adviser_ids), batch_size):
+        refresh_counters(adviser_ids[start:start + batch_size])
+    return len(adviser_ids)
@@ -43,8 +43,9 @@ class CommissionAdmin(admin.ModelAdmin):
 
 @admin.register(Advance)
 class AdvanceAdmin(admin.ModelAdmin):
-    list_display = ('adviser', 'amount', 'date_issued', 'is_fully_repaid')
+    list_display = ('adviser', 'amount', 'outstanding_balance', 'date_issued', 'is_fully_repaid')
     list_filter = ('is_fully_repaid', 'adviser')
+    readonly_fields = ('outstanding_balance', 'is_fully_repaid')
 
 # Простая регистрация для остальных моделей
 admin.site.register(Repayment)
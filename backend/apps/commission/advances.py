@@ -0,0 +1,198 @@
+"""
+Реестр авансов консультантов.
+
+У каждого аванса хранится остаток к погашению (Advance.outstanding_balance):
+сумма аванса минус погашения. Остаток меняется при записи и удалении
+погашений (signals.py) одним UPDATE строки аванса; когда он доходит до нуля,
+аванс автоматически помечается погашенным. Непогашенный остаток консультанта
+(AdviserAdvanceBalance) — сумма остатков его открытых авансов — меняется
+на ту же разницу, поэтому профиль и экраны финансов читают готовые суммы,
+не агрегируя погашения.
+
+Изменения через update() и bulk_create сигналов не вызывают — после них
+реестр пересобирается командой rebuild_advance_ledger.
+"""
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+
+from .models import Advance, AdviserAdvanceBalance, Repayment
+
+
+def open_balance(balance):
+    """Часть остатка аванса, которая входит в долг консультанта."""
+    return balance if balance > 0 else Decimal('0.00')
+
+
+def _apply_adviser_delta(adviser_id, old_balance, new_balance):
+    """Переносит в остаток консультанта изменение остатка одного аванса."""
+    balance_delta = open_balance(new_balance) - open_balance(old_balance)
+    count_delta = int(new_balance > 0) - int(old_balance > 0)
+    if not balance_delta and not count_delta:
+        return
+    changes = {
+        'outstanding_balance': F('outstanding_balance') + balance_delta,
+        'open_advances': F('open_advances') + count_delta,
+    }
+    balances = AdviserAdvanceBalance.objects.filter(adviser_id=adviser_id)
+    if balances.update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            AdviserAdvanceBalance.objects.create(
+                adviser_id=adviser_id, outstanding_balance=balance_delta, open_advances=count_delta,
+            )
+    except IntegrityError:
+        # Строку успела создать параллельная транзакция
+        balances.update(**changes)
+
+
+def prepare_advance(advance):
+    """
+    Вызывается перед сохранением аванса (Advance.save — в транзакции): выставляет
+    остаток и признак погашения с учетом уже внесенных погашений. Строка аванса
+    блокируется, как в record_repayment, чтобы параллельное погашение не было
+    перезаписано остатком, прочитанным до него. Возвращает прежнее состояние аванса или None.
+    """
+    previous = None
+    if advance.pk is not None:
+        previous = Advance.objects.select_for_update().filter(pk=advance.pk).values(
+            'adviser_id', 'amount', 'outstanding_balance'
+        ).first()
+    amount = Decimal(advance.amount)
+    if previous:
+        advance.outstanding_balance = previous['outstanding_balance'] + amount - previous['amount']
+    else:
+        advance.outstanding_balance = amount
+    advance.is_fully_repaid = advance.outstanding_balance <= 0
+    return previous
+
+
+def record_advance(advance, previous):
+    """Вызывается после сохранения аванса: переносит изменение остатка в остаток консультанта."""
+    if previous and previous['adviser_id'] == advance.adviser_id:
+        _apply_adviser_delta(advance.adviser_id, previous['outstanding_balance'], advance.outstanding_balance)
+        return
+    if previous:
+        _apply_adviser_delta(previous['adviser_id'], previous['outstanding_balance'], Decimal('0.00'))
+    _apply_adviser_delta(advance.adviser_id, Decimal('0.00'), advance.outstanding_balance)
+
+
+def record_repayment(advance_id, amount):
+    """
+    Вносит погашение (отрицательная сумма — отмену погашения) в остаток аванса
+    и консультанта. Строка аванса блокируется, чтобы параллельные погашения
+    не потеряли друг друга.
+    """
+    with transaction.atomic():
+        advance = Advance.objects.select_for_update().filter(pk=advance_id).values(
+            'adviser_id', 'outstanding_balance'
+        ).first()
+        if advance is None:
+            return
+        balance = advance['outstanding_balance'] - Decimal(amount)
+        Advance.objects.filter(pk=advance_id).update(outstanding_balance=balance, is_fully_repaid=balance <= 0)
+        _apply_adviser_delta(advance['adviser_id'], advance['outstanding_balance'], balance)
+
+
+def refresh_adviser_balances(adviser_ids):
+    """Пересчитывает остатки консультантов по остаткам их открытых авансов."""
+    adviser_ids = {adviser_id for adviser_id in adviser_ids if adviser_id is not None}
+    if not adviser_ids:
+        return
+    totals = {
+        row['adviser_id']: row
+        for row in Advance.objects.filter(adviser_id__in=adviser_ids, is_fully_repaid=False).values(
+            'adviser_id'
+        ).annotate(outstanding_balance=Sum('outstanding_balance'), open_advances=Count('id')).order_by()
+    }
+    AdviserAdvanceBalance.objects.bulk_create(
+        [
+            AdviserAdvanceBalance(
+                adviser_id=adviser_id,
+                outstanding_balance=totals[adviser_id]['outstanding_balance'] if adviser_id in totals else 0,
+                open_advances=totals[adviser_id]['open_advances'] if adviser_id in totals else 0,
+            )
+            for adviser_id in sorted(adviser_ids)
+        ],
+        update_conflicts=True,
+        unique_fields=['adviser'],
+        update_fields=['outstanding_balance', 'open_advances'],
+    )
+
+
+def advisers_with_outstanding_advances():
+    """Консультанты с непогашенными авансами, по убыванию долга (частичный индекс по остатку)."""
+    return AdviserAdvanceBalance.objects.filter(outstanding_balance__gt=0).select_related(
+        'adviser__user'
+    ).order_by('-outstanding_balance', '-adviser')
+
+
+# --- Полный пересчет и сверка ---
+
+def compute_advance_balances():
+    """Считает остатки авансов по погашениям: {advance_id: (adviser_id, остаток)}."""
+    repaid = dict(
+        Repayment.objects.values('advance_id').annotate(total=Sum('amount')).order_by().values_list('advance_id', 'total')
+    )
+    return {
+        advance_id: (adviser_id, amount - repaid.get(advance_id, 0))
+        for advance_id, adviser_id, amount in Advance.objects.values_list('id', 'adviser_id', 'amount').iterator()
+    }
+
+
+def compute_adviser_balances(advance_balances):
+    """Остатки консультантов по остаткам авансов: {adviser_id: (остаток, открытых авансов)}."""
+    balances = {}
+    for adviser_id, balance in advance_balances.values():
+        if balance > 0:
+            total, count = balances.get(adviser_id, (0, 0))
+            balances[adviser_id] = (total + balance, count + 1)
+    return balances
+
+
+@transaction.atomic
+def rebuild_advance_ledger(batch_size=1000):
+    """Пересобирает остатки авансов и консультантов по погашениям. Возвращает число измененных авансов."""
+    advance_balances = compute_advance_balances()
+    changed = []
+    for advance_id, balance, is_fully_repaid in Advance.objects.values_list(
+        'id', 'outstanding_balance', 'is_fully_repaid'
+    ).iterator():
+        expected = advance_balances[advance_id][1]
+        if (balance, is_fully_repaid) != (expected, expected <= 0):
+            changed.append(Advance(pk=advance_id, outstanding_balance=expected, is_fully_repaid=expected <= 0))
+    Advance.objects.bulk_update(changed, ['outstanding_balance', 'is_fully_repaid'], batch_size=batch_size)
+
+    AdviserAdvanceBalance.objects.all().delete()
+    AdviserAdvanceBalance.objects.bulk_create(
+        [
+            AdviserAdvanceBalance(adviser_id=adviser_id, outstanding_balance=total, open_advances=count)
+            for adviser_id, (total, count) in compute_adviser_balances(advance_balances).items()
+        ],
+        batch_size=batch_size,
+    )
+    return len(changed)
+
+
+def check_advance_ledger():
+    """Сверяет реестр с погашениями. Возвращает [(ключ, ожидалось, в реестре)]."""
+    advance_balances = compute_advance_balances()
+    mismatches = [
+        (f'advance {advance_id}', advance_balances[advance_id][1], balance)
+        for advance_id, balance in Advance.objects.values_list('id', 'outstanding_balance').iterator()
+        if balance != advance_balances[advance_id][1]
+    ]
+    expected = compute_adviser_balances(advance_balances)
+    stored = {
+        adviser_id: (total, count)
+        for adviser_id, total, count in AdviserAdvanceBalance.objects.values_list(
+            'adviser_id', 'outstanding_balance', 'open_advances'
+        )
+        if total or count
+    }
+    for adviser_id in sorted(expected.keys() | stored.keys()):
+        if expected.get(adviser_id) != stored.get(adviser_id):
+            mismatches.append((f'adviser {adviser_id}', expected.get(adviser_id), stored.get(adviser_id)))
+    return mismatches
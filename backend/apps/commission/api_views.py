@@ -1,20 +1,28 @@
 """
 [IDE FIX] Ошибки "Unresolved reference"? См. INTERPRETER_SETUP.md в корне проекта.
 """
+import csv
 from decimal import Decimal
-from django.db.models import Sum, Count, Q
+from django.db.models import Q
+from django.http import StreamingHttpResponse
 from rest_framework import viewsets, permissions, views, serializers
+from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser, MultiPartParser
 from rest_framework.response import Response
-from .models import Commission, Retention, Clawback, CommissionSplit, Advance, Repayment, Bonus, VestingSchedule, ScheduledPayout, ReferralFee, Override
-from backend.apps.advisers.models import Adviser
+from .models import Commission, Retention, Clawback, CommissionSplit, Advance, Repayment, Bonus, VestingSchedule, ScheduledPayout, ReferralFee, Override, PayoutRun, PayoutLine
 from .serializers import (
     CommissionSerializer, RetentionSerializer, ClawbackSerializer,
-    CommissionSplitSerializer, AdvanceSerializer, RepaymentSerializer,
-    BonusSerializer, VestingScheduleSerializer, ScheduledPayoutSerializer,
-    ReferralFeeSerializer, OverrideSerializer
+    CommissionSplitSerializer, AdvanceSerializer, RepaymentSerializer, AdviserAdvanceBalanceSerializer,
+    BonusSerializer, VestingScheduleSerializer, ScheduledPayoutSerializer, PayoutRunSerializer, PayoutLineSerializer,
+    ReferralFeeSerializer, OverrideSerializer, CommissionFlatSerializer, flat_commission_values
 )
-from backend.apps.advisers.serializers import AdviserSerializer
+from backend.apps.advisers.hierarchy import descendant_ids_subquery
+from backend.apps.core.pagination import KeysetPagination
 from backend.apps.core.permissions import IsOwnerOrManager
+from .advances import advisers_with_outstanding_advances
+from .calculator import build_payout_plans, calculate_payout, calculate_batch, parse_batch_rows, read_csv_rows
+from .profile import build_profile_payload, get_profile_cache_stats, get_profile_payload
+from .rollups import get_commission_statistics, get_top_performers
 
 
 def get_commissions_for_user(user):
@@ -30,16 +38,13 @@ def get_commissions_for_user(user):
 
     if hasattr(user, 'adviser_profile'):
         user_adviser = user.adviser_profile
-        # Консультант видит свои комиссии + оверрайды, где он получатель
-        direct_commissions = Q(adviser=user_adviser)
-        override_commissions = Q(overrides__recipient=user_adviser)
-
-        # Менеджер ��ополнительно видит комиссии своих подчиненных
-        subordinate_advisers = user_adviser.subordinates.all()
-        if subordinate_advisers.exists():
-            direct_commissions |= Q(adviser__in=subordinate_advisers)
-
-        return base_queryset.filter(direct_commissions | override_commissions).distinct()
+        # Консультант видит свои комиссии и комиссии всего своего поддерева (closure-таблица),
+        # а также комиссии, по которым он получает оверрайд. Оба условия — полусоединения
+        # по индексам, поэтому JOIN с размножением строк и DISTINCT не нужны.
+        return base_queryset.filter(
+            Q(adviser_id__in=descendant_ids_subquery(user_adviser))
+            | Q(id__in=Override.objects.filter(recipient=user_adviser).values('commission_id'))
+        )
 
     return Commission.objects.none()
 
@@ -50,12 +55,27 @@ class CommissionViewSet(viewsets.ReadOnlyModelViewSet):
     - Администраторы видят все.
     - Менеджеры видят свои комиссии и комиссии своей команды.
     - Консультанты видят только свои.
+    Список с ?view=flat отдается плоским представлением (CommissionFlatSerializer)
+    одним запросом вместо вложенных сериализаторов.
     """
     serializer_class = CommissionSerializer
     permission_classes = [permissions.IsAuthenticated, IsOwnerOrManager]
+    pagination_class = KeysetPagination
+    keyset_ordering = ('-date_received', '-id')
+
+    def _is_flat(self):
+        return self.action == 'list' and self.request.query_params.get('view') == 'flat'
 
     def get_queryset(self):
-        return get_commissions_for_user(self.request.user)
+        queryset = get_commissions_for_user(self.request.user)
+        if self._is_flat():
+            return flat_commission_values(queryset)
+        return queryset
+
+    def get_serializer_class(self):
+        if self._is_flat():
+            return CommissionFlatSerializer
+        return super().get_serializer_class()
 
 
 class OverrideViewSet(viewsets.ReadOnlyModelViewSet):
@@ -109,6 +129,35 @@ class RepaymentViewSet(viewsets.ModelViewSet):
     serializer_class = RepaymentSerializer
     permission_classes = [permissions.IsAdminUser]
 
+class OutstandingAdvanceViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Консультанты с непогашенными авансами по убыванию долга.
+    Читает готовые остатки (AdviserAdvanceBalance) по частичному индексу, погашения не агрегируются.
+    """
+    serializer_class = AdviserAdvanceBalanceSerializer
+    permission_classes = [permissions.IsAdminUser]
+    pagination_class = KeysetPagination
+    keyset_ordering = ('-outstanding_balance', '-adviser')
+
+    def get_queryset(self):
+        return advisers_with_outstanding_advances()
+
+class PayoutRunViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Запуски выплат (payouts.py) — только чтение, запуски неизменяемы.
+    Строки запуска: /payout-runs/<id>/lines/.
+    """
+    queryset = PayoutRun.objects.all()
+    serializer_class = PayoutRunSerializer
+    permission_classes = [permissions.IsAdminUser]
+    pagination_class = KeysetPagination
+
+    @action(detail=True)
+    def lines(self, request, pk=None):
+        queryset = PayoutLine.objects.filter(run=self.get_object())
+        page = self.paginate_queryset(queryset)
+        return self.get_paginated_response(PayoutLineSerializer(page, many=True).data)
+
 class VestingScheduleViewSet(viewsets.ModelViewSet):
     queryset = VestingSchedule.objects.all()
     serializer_class = VestingScheduleSerializer
@@ -124,21 +173,12 @@ class ScheduledPayoutViewSet(viewsets.ModelViewSet):
 class CommissionStatisticsAPIView(views.APIView):
     """
     Предоставляет сводную статистику по комиссиям в зависимости от роли пользователя.
+    Читает дневные итоги (CommissionDailyRollup), а не всю таблицу комиссий.
     """
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request, *args, **kwargs):
-        queryset = get_commissions_for_user(request.user)
-        stats = queryset.aggregate(
-            total_net_commission=Sum('net_commission'),
-            total_adviser_payout=Sum('adviser_fee_amount'),
-            transaction_count=Count('id')
-        )
-        return Response({
-            "total_net_commission": stats.get('total_net_commission') or 0,
-            "total_adviser_payout": stats.get('total_adviser_payout') or 0,
-            "transaction_count": stats.get('transaction_count') or 0,
-        })
+        return Response(get_commission_statistics(request.user))
 
 class TopPerformersAPIView(views.APIView):
     """
@@ -147,17 +187,8 @@ class TopPerformersAPIView(views.APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request, *args, **kwargs):
-        queryset = get_commissions_for_user(request.user)
-        # Агрегируем вознаграждения по каждому консультанту
-        top_performers = queryset.values(
-            'adviser__user__first_name',
-            'adviser__user__last_name'
-        ).annotate(
-            total_fees=Sum('adviser_fee_amount')
-        ).order_by('-total_fees')
-
-        # Ограничим вывод топ-10
-        return Response(top_performers[:10])
+        # Агрегируем вознаграждения по каждому консультанту из дневных итогов, топ-10
+        return Response(get_top_performers(request.user, limit=10))
 
 class CommissionCalculatorAPIView(views.APIView):
     """
@@ -178,56 +209,93 @@ class CommissionCalculatorAPIView(views.APIView):
         net_commission = data['net_commission']
         adviser_id = data['adviser_id']
 
-        try:
-            adviser = Adviser.objects.select_related('user', 'parent_adviser__user').get(id=adviser_id)
-        except Adviser.DoesNotExist:
+        plan = build_payout_plans([adviser_id]).get(adviser_id)
+        if plan is None:
             return Response({"error": "Консультант не найден."}, status=404)
 
-        calculation_details = []
-        total_payout = Decimal('0.00')
-
-        # 1. Прямое вознаграждение
-        direct_fee = net_commission * (adviser.fee_percentage / 100)
-        total_payout += direct_fee
-        calculation_details.append({
-            "adviser": adviser.user.get_full_name(),
-            "type": "DIRECT",
-            "fee_percentage": adviser.fee_percentage,
-            "calculated_fee": direct_fee
+        # Прямое вознаграждение и оверрайды по цепочке руководителей
+        total_payout, calculation_details = calculate_payout(net_commission, plan)
+
+        return Response({
+            "source_net_commission": net_commission,
+            "total_payout": total_payout,
+            "payout_breakdown": calculation_details
         })
 
-        # 2. Оверрайдные вознаграждения
-        current_adviser = adviser
-        last_fee_percentage = adviser.fee_percentage
 
-        while current_adviser.parent_adviser:
-            manager = current_adviser.parent_adviser
-            override_percentage = manager.fee_percentage - last_fee_percentage
+class CommissionCalculatorBatchAPIView(views.APIView):
+    """
+    Пакетный вариант калькулятора комиссий.
+    Принимает JSON-массив объектов {net_commission, adviser_id} (или {"rows": [...]})
+    либо CSV-файл в поле `file` с теми же колонками.
+    Цепочки всех консультантов разрешаются одним запросом.
+    С параметром `?output=csv` результат отдается потоковым CSV.
+    """
+    permission_classes = [permissions.IsAdminUser]
+    parser_classes = [JSONParser, MultiPartParser]
+
+    CSV_HEADER = ['row', 'adviser_id', 'recipient', 'type', 'fee_percentage', 'override_percentage', 'calculated_fee']
+
+    def post(self, request, *args, **kwargs):
+        if 'file' in request.FILES:
+            raw_rows = read_csv_rows(request.FILES['file'])
+        elif isinstance(request.data, list):
+            raw_rows = request.data
+        elif isinstance(request.data, dict) and isinstance(request.data.get('rows'), list):
+            raw_rows = request.data['rows']
+        else:
+            return Response({"error": "Ожидается JSON-массив строк или CSV-файл в поле 'file'."}, status=400)
+
+        try:
+            rows, errors = parse_batch_rows(raw_rows)
+        except (UnicodeDecodeError, csv.Error) as e:
+            return Response({"error": f"Не удалось прочитать CSV: {e}"}, status=400)
+        if errors and not rows:
+            return Response({"errors": errors}, status=400)
 
-            if override_percentage > 0:
-                override_fee = net_commission * (override_percentage / 100)
-                total_payout += override_fee
-                calculation_details.append({
-                    "adviser": manager.user.get_full_name(),
-                    "type": "OVERRIDE",
-                    "fee_percentage": manager.fee_percentage,
-                    "override_percentage": override_percentage,
-                    "calculated_fee": override_fee
-                })
+        results, not_found = calculate_batch(rows)
+        errors += not_found
 
-            current_adviser = manager
-            last_fee_percentage = manager.fee_percentage
+        if request.query_params.get('output') == 'csv':
+            return self._stream_csv(results, errors)
 
+        results = list(results)
         return Response({
-            "source_net_commission": net_commission,
-            "total_payout": total_payout,
-            "payout_breakdown": calculation_details
+            "count": len(results),
+            "total_payout": sum((result['total_payout'] for result in results), Decimal('0.00')),
+            "results": results,
+            "errors": errors,
         })
 
+    def _stream_csv(self, results, errors):
+        """Отдает по строке CSV на каждую выплату, не собирая ответ в памяти."""
+        writer = csv.writer(_Echo())
+
+        def lines():
+            yield writer.writerow(self.CSV_HEADER)
+            for result in results:
+                for share in result['payout_breakdown']:
+                    yield writer.writerow([
+                        result['row'], result['adviser_id'], share['adviser'], share['type'],
+                        share['fee_percentage'], share.get('override_percentage', ''), share['calculated_fee'],
+                    ])
+
+        response = StreamingHttpResponse(lines(), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="commission_calculation.csv"'
+        response['X-Row-Errors'] = str(len(errors))
+        return response
+
+
+class _Echo:
+    """Псевдо-файл для csv.writer: возвращает строку вместо записи."""
+    def write(self, value):
+        return value
+
 
 class MyProfileAPIView(views.APIView):
     """
     Возвращает сводную информацию для залогиненного пользователя.
+    Ответ кэшируется на консультанта (см. profile.py), заголовок X-Cache показывает HIT/MISS.
     """
     permission_classes = [permissions.IsAuthenticated]
 
@@ -236,43 +304,19 @@ class MyProfileAPIView(views.APIView):
         if not hasattr(user, 'adviser_profile'):
             return Response({"error": "Профиль консультанта не найден."}, status=404)
 
-        adviser_profile = user.adviser_profile
-        commissions_qs = get_commissions_for_user(user)
-
-        # 1. Профиль пользователя
-        profile_data = AdviserSerializer(adviser_profile).data
-
-        # 2. Статистика
-        stats = commissions_qs.aggregate(
-            total_net_commission=Sum('net_commission'),
-            total_adviser_payout=Sum('adviser_fee_amount'),
-            transaction_count=Count('id')
-        )
-        statistics_data = {
-            "total_net_commission": stats.get('total_net_commission') or 0,
-            "total_adviser_payout": stats.get('total_adviser_payout') or 0,
-            "transaction_count": stats.get('transaction_count') or 0,
-        }
-
-        # 3. Последние 5 комиссий
-        recent_commissions = commissions_qs.order_by('-date_received')[:5]
-        recent_commissions_data = CommissionSerializer(recent_commissions, many=True).data
+        # Сотрудник видит все комиссии, такой профиль устаревал бы при любой записи — не кэшируем
+        if user.is_staff:
+            return Response(build_profile_payload(user, user.adviser_profile.pk))
 
-        # 4. Финансовая сводка (Авансы и Удержания)
-        total_advances = adviser_profile.advances.filter(is_fully_repaid=False).aggregate(total=Sum('amount'))['total'] or 0
-        total_repayments = Repayment.objects.filter(advance__adviser=adviser_profile, advance__is_fully_repaid=False).aggregate(total=Sum('amount'))['total'] or 0
-        outstanding_advances = total_advances - total_repayments
+        payload, cache_hit = get_profile_payload(user, user.adviser_profile.pk)
+        return Response(payload, headers={'X-Cache': 'HIT' if cache_hit else 'MISS'})
 
-        total_retentions = Retention.objects.filter(commission__adviser=adviser_profile, is_released=False).aggregate(total=Sum('amount'))['total'] or 0
 
-        financial_summary = {
-            "outstanding_advances": outstanding_advances,
-            "total_retentions": total_retentions,
-        }
+class ProfileCacheStatsAPIView(views.APIView):
+    """
+    Счетчики попаданий и промахов кэша MyProfileAPIView.
+    """
+    permission_classes = [permissions.IsAdminUser]
 
-        return Response({
-            "profile": profile_data,
-            "statistics": statistics_data,
-            "recent_commissions": recent_commissions_data,
-            "financial_summary": financial_summary,
-        })
+    def get(self, request, *args, **kwargs):
+        return Response(get_profile_cache_stats())
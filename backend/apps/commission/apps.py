@@ -5,3 +5,7 @@ class CommissionConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'backend.apps.commission'
     verbose_name = "Финансы и Комиссии"
+
+    def ready(self):
+        # Подключаем сигналы обновления дневных итогов
+        import backend.apps.commission.signals
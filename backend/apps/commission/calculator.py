@@ -0,0 +1,122 @@
+"""
+Расчет прямого вознаграждения и оверрайдов без сохранения в БД.
+
+Для каждого консультанта один раз строится "план выплат" — список получателей
+и их ставок по цепочке руководителей. Дальше расчет любой строки сводится
+к умножению чистой комиссии на готовые ставки, без обращений к БД.
+"""
+import csv
+import io
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+
+from backend.apps.advisers.hierarchy import get_ancestor_chains
+
+
+PayoutShare = namedtuple('PayoutShare', ['adviser', 'type', 'fee_percentage', 'override_percentage'])
+
+# Ограничение размера одного пакетного расчета
+MAX_BATCH_ROWS = 100000
+
+
+def build_payout_plans(adviser_ids):
+    """Возвращает {adviser_id: [PayoutShare, ...]} для найденных консультантов."""
+    plans = {}
+    for adviser_id, chain in get_ancestor_chains(adviser_ids).items():
+        if not chain:
+            continue
+        adviser = chain[0]
+        plan = [PayoutShare(adviser, 'DIRECT', adviser.fee_percentage, None)]
+        last_fee_percentage = adviser.fee_percentage
+        for manager in chain[1:]:
+            override_percentage = manager.fee_percentage - last_fee_percentage
+            if override_percentage > 0:
+                plan.append(PayoutShare(manager, 'OVERRIDE', manager.fee_percentage, override_percentage))
+            last_fee_percentage = manager.fee_percentage
+        plans[adviser_id] = plan
+    return plans
+
+
+def calculate_payout(net_commission, plan):
+    """Применяет план выплат к сумме. Возвращает (total_payout, payout_breakdown)."""
+    total_payout = Decimal('0.00')
+    breakdown = []
+    for share in plan:
+        if share.type == 'DIRECT':
+            fee = net_commission * (share.fee_percentage / 100)
+            details = {
+                "adviser": share.adviser.full_name,
+                "type": share.type,
+                "fee_percentage": share.fee_percentage,
+                "calculated_fee": fee,
+            }
+        else:
+            fee = net_commission * (share.override_percentage / 100)
+            details = {
+                "adviser": share.adviser.full_name,
+                "type": share.type,
+                "fee_percentage": share.fee_percentage,
+                "override_percentage": share.override_percentage,
+                "calculated_fee": fee,
+            }
+        total_payout += fee
+        breakdown.append(details)
+    return total_payout, breakdown
+
+
+def parse_batch_rows(rows):
+    """
+    Проверяет строки пакетного расчета.
+    Принимает итерируемое словарей с ключами net_commission и adviser_id.
+    Возвращает (валидные строки [(номер, net_commission, adviser_id)], ошибки).
+    """
+    parsed, errors = [], []
+    for index, row in enumerate(rows, start=1):
+        if index > MAX_BATCH_ROWS:
+            errors.append(f"Превышен лимит в {MAX_BATCH_ROWS} строк.")
+            break
+        try:
+            net_commission = Decimal(str(row['net_commission']).strip())
+            adviser_id = int(row['adviser_id'])
+            if not net_commission.is_finite():
+                raise InvalidOperation
+            parsed.append((index, net_commission, adviser_id))
+        except (KeyError, TypeError):
+            errors.append(f"Строка {index}: требуются поля 'net_commission' и 'adviser_id'.")
+        except (ValueError, InvalidOperation):
+            errors.append(f"Строка {index}: некорректное значение 'net_commission' или 'adviser_id'.")
+    return parsed, errors
+
+
+def read_csv_rows(uploaded_file):
+    """Потоково читает загруженный CSV с колонками net_commission, adviser_id."""
+    return csv.DictReader(io.TextIOWrapper(uploaded_file, encoding='utf-8', newline=''))
+
+
+def calculate_batch(rows):
+    """
+    Рассчитывает выплаты для всех строк.
+    Цепочки всех консультантов пакета разрешаются одним запросом.
+    Возвращает (ленивый генератор результатов, ошибки по строкам).
+    """
+    plans = build_payout_plans({adviser_id for _, _, adviser_id in rows})
+    errors = [
+        f"Строка {index}: Консультант {adviser_id} не найден."
+        for index, _, adviser_id in rows if adviser_id not in plans
+    ]
+
+    def results():
+        for index, net_commission, adviser_id in rows:
+            plan = plans.get(adviser_id)
+            if plan is None:
+                continue
+            total_payout, breakdown = calculate_payout(net_commission, plan)
+            yield {
+                "row": index,
+                "adviser_id": adviser_id,
+                "source_net_commission": net_commission,
+                "total_payout": total_payout,
+                "payout_breakdown": breakdown,
+            }
+
+    return results(), errors
@@ -1,24 +1,45 @@
+import asyncio
 import json
+
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 
+from .deal_events import deal_groups_for_user
+
+# Интервал, за который события для клиента собираются в одно сообщение (секунды)
+DEAL_COALESCE_INTERVAL = 0.5
+
+
 class DealConsumer(AsyncWebsocketConsumer):
+    """
+    Websocket с событиями о сделках. Клиент подписывается на свои группы
+    (см. deal_events.py), а события, пришедшие за coalesce_interval,
+    отправляются ему одним сообщением {'type': 'deals', 'messages': [...]}.
+    """
+    coalesce_interval = DEAL_COALESCE_INTERVAL
+
     async def connect(self):
-        self.room_group_name = 'deals'
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            await self.close()
+            return
 
-        # Join room group
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        self.deal_groups = await database_sync_to_async(deal_groups_for_user)(user)
+        self._pending = {}
+        self._flush_task = None
+
+        # Join room groups
+        for group in self.deal_groups:
+            await self.channel_layer.group_add(group, self.channel_name)
 
         await self.accept()
 
     async def disconnect(self, close_code):
-        # Leave room group
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+        # Leave room groups
+        for group in getattr(self, 'deal_groups', []):
+            await self.channel_layer.group_discard(group, self.channel_name)
+        if getattr(self, '_flush_task', None):
+            self._flush_task.cancel()
 
     # Receive message from WebSocket
     async def receive(self, text_data):
@@ -26,9 +47,27 @@ class DealConsumer(AsyncWebsocketConsumer):
 
     # Receive message from room group
     async def deal_notification(self, event):
-        message = event['message']
+        self._queue([event['message']])
+
+    async def deal_batch(self, event):
+        self._queue(event['messages'])
+
+    def _queue(self, messages):
+        # Одно событие может прийти через несколько групп (например, staff-руководителю)
+        for message in messages:
+            key = (message['event'], message['id']) if isinstance(message, dict) and 'id' in message else id(message)
+            self._pending[key] = message
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.coalesce_interval)
+        await self.flush()
 
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'message': message
-        }))
+    async def flush(self):
+        self._flush_task = None
+        messages = list(self._pending.values())
+        self._pending = {}
+        if messages:
+            # Send message to WebSocket
+            await self.send(text_data=json.dumps({'type': 'deals', 'messages': messages}))
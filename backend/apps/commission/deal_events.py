@@ -0,0 +1,89 @@
+"""
+Рассылка событий о сделках (комиссиях) по websocket (consumers.DealConsumer).
+
+Группы каналов строятся по иерархии консультантов:
+- deals.adviser.<id> — собственные сделки консультанта;
+- deals.team.<id> — сделки всех подчиненных руководителя любого уровня;
+- deals.all — все сделки (для staff).
+
+Получатели события определяются по закэшированной цепочке руководителей
+(advisers.hierarchy), а события пачки (например, импорта) группируются:
+в каждую группу уходит одно сообщение со списком событий.
+"""
+import logging
+from collections import defaultdict
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from backend.apps.advisers.hierarchy import get_ancestor_chains
+
+
+logger = logging.getLogger(__name__)
+
+ALL_DEALS_GROUP = 'deals.all'
+
+
+def adviser_group(adviser_id):
+    return f'deals.adviser.{adviser_id}'
+
+
+def team_group(manager_id):
+    return f'deals.team.{manager_id}'
+
+
+def deal_groups_for_user(user):
+    """Группы, в которые входит websocket-клиент пользователя."""
+    groups = [ALL_DEALS_GROUP] if user.is_staff else []
+    adviser = getattr(user, 'adviser_profile', None)
+    if adviser is not None:
+        groups += [adviser_group(adviser.id), team_group(adviser.id)]
+    return groups
+
+
+def deal_event(commission, event='created'):
+    """Данные события для клиента (без дополнительных запросов)."""
+    return {
+        'event': event,
+        'id': commission.pk,
+        'adviser_id': commission.adviser_id,
+        'commission_type': commission.commission_type,
+        'net_commission': str(commission.net_commission),
+        'adviser_fee_amount': str(commission.adviser_fee_amount),
+        'date_received': str(commission.date_received),
+    }
+
+
+def group_events(events):
+    """Раскладывает события по группам получателей: {группа: [события]}."""
+    grouped = defaultdict(list)
+    chains = get_ancestor_chains({event['adviser_id'] for event in events})
+    for event in events:
+        chain = chains.get(event['adviser_id']) or []
+        grouped[adviser_group(event['adviser_id'])].append(event)
+        for manager in chain[1:]:
+            grouped[team_group(manager.id)].append(event)
+        grouped[ALL_DEALS_GROUP].append(event)
+    return grouped
+
+
+async def send_group_events(channel_layer, grouped):
+    """Отправляет по одному сообщению deal.batch в каждую группу."""
+    for group, events in grouped.items():
+        await channel_layer.group_send(group, {'type': 'deal.batch', 'messages': events})
+
+
+def publish_deal_events(commissions, event='created'):
+    """
+    Публикует события по комиссиям. Без настроенного channel layer ничего не делает.
+    Вызывается после коммита: недоступность брокера (Redis) не должна превращать
+    уже сохраненную комиссию в ошибку, поэтому сбой отправки только логируется.
+    """
+    channel_layer = get_channel_layer()
+    events = [deal_event(commission, event) for commission in commissions]
+    if channel_layer is None or not events:
+        return
+    try:
+        async_to_sync(send_group_events)(channel_layer, group_events(events))
+    except Exception:
+        logger.exception(f"Не удалось опубликовать события о сделках ({len(events)} шт.)")
@@ -0,0 +1,215 @@
+"""
+Потоковый импорт комиссий из CSV чанками с массовой записью в БД.
+"""
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from backend.apps.advisers.hierarchy import get_ancestor_chains
+from backend.apps.advisers.models import Adviser
+from backend.apps.policies.models import Policy
+from backend.apps.products.models import Product
+from .deal_events import publish_deal_events
+from .models import Commission, Override
+from .profile import invalidate_adviser_profiles, invalidate_commission_profiles
+from .rollups import RollupDeltas, commission_rollup_values, rollup_key
+from .rules_engine import apply_rules
+
+
+REQUIRED_HEADERS = (
+    'policy_number', 'adviser_username', 'product_name', 'provider',
+    'gross_commission', 'net_commission', 'date_received',
+)
+
+# Поля, которые перезаписываются у уже существующей комиссии (аналог defaults в update_or_create)
+COMMISSION_UPDATE_FIELDS = [
+    'product', 'adviser', 'gross_commission', 'net_commission', 'adviser_fee_percentage',
+    'adviser_fee_amount', 'date_received', 'commission_type', 'payment_status', 'updated_at',
+]
+
+
+class QueryCounter:
+    """Обертка для connection.execute_wrapper, считающая выполненные запросы."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def iter_chunks(reader, chunk_size):
+    """Разбивает DictReader на чанки [(номер строки, строка), ...]."""
+    rows = enumerate(reader, start=2)  # +2, т.к. DictReader начинает после заголовка
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _parse_row(row):
+    policy_number = (row.get('policy_number') or '').strip()
+    if not policy_number:
+        raise ValueError("Отсутствует обязательное значение 'policy_number'.")
+    return {
+        'policy_number': policy_number,
+        'adviser_username': (row.get('adviser_username') or '').strip(),
+        'product_name': (row.get('product_name') or '').strip(),
+        'provider': (row.get('provider') or '').strip(),
+        'gross_commission': Decimal(row['gross_commission']),
+        'net_commission': Decimal(row['net_commission']),
+        'date_received': datetime.strptime(row['date_received'].strip(), "%Y-%m-%d").date(),
+    }
+
+
+class CommissionCSVImporter:
+    """
+    Импортирует строки CSV чанками.
+    На каждый чанк консультанты, продукты, полисы и комиссии загружаются
+    одним запросом на модель, а запись идет через bulk_create/bulk_update
+    в отдельной транзакции, поэтому число запросов не зависит от размера чанка.
+    """
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+
+    def import_chunk(self, chunk):
+        """
+        Обрабатывает один чанк и возвращает статистику:
+        created, updated, overrides, skipped, errors, queries.
+        """
+        stats = {'created': 0, 'updated': 0, 'overrides': 0, 'skipped': [], 'errors': [], 'queries': 0}
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter), transaction.atomic():
+            self._import_chunk(chunk, stats)
+        stats['queries'] = counter.count
+        return stats
+
+    def _import_chunk(self, chunk, stats):
+        parsed = []
+        for line_num, row in chunk:
+            try:
+                parsed.append((line_num, _parse_row(row)))
+            except (KeyError, ValueError, InvalidOperation) as e:
+                stats['errors'].append(f"Строка {line_num}: Ошибка данных - {e}")
+
+        advisers = {
+            username: (adviser_id, fee_percentage)
+            for username, adviser_id, fee_percentage in Adviser.objects.filter(
+                user__username__in={data['adviser_username'] for _, data in parsed}
+            ).values_list('user__username', 'id', 'fee_percentage')
+        }
+        products = {}
+        for product_id, name in Product.objects.filter(
+            name__in={data['product_name'] for _, data in parsed}
+        ).order_by('-id').values_list('id', 'name'):
+            products[name] = product_id  # при дублях имен берется самый ранний продукт
+
+        rows = []
+        for line_num, data in parsed:
+            if data['adviser_username'] not in advisers:
+                stats['skipped'].append(f'Строка {line_num}: Консультант "{data["adviser_username"]}" не найден.')
+            elif data['product_name'] not in products:
+                stats['skipped'].append(f'Строка {line_num}: Продукт "{data["product_name"]}" не найден.')
+            else:
+                rows.append(data)
+
+        policies = self._get_or_create_policies(rows, advisers)
+
+        existing = Commission.objects.in_bulk(
+            [policies[data['policy_number']].id for data in rows], field_name='policy_id'
+        )
+        previous = {commission.pk: commission_rollup_values(commission) for commission in existing.values()}
+        to_create, to_update = {}, {}
+        now = timezone.now()
+        for data in rows:
+            policy = policies[data['policy_number']]
+            adviser_id, fee_percentage = advisers[data['adviser_username']]
+            commission = existing.get(policy.id) or Commission(policy=policy)
+            commission.product_id = products[data['product_name']]
+            commission.adviser_id = adviser_id
+            commission.gross_commission = data['gross_commission']
+            commission.net_commission = data['net_commission']
+            commission.adviser_fee_percentage = fee_percentage
+            commission.adviser_fee_amount = Commission.calculate_adviser_fee(data['net_commission'], fee_percentage)
+            commission.date_received = policy.date_issued
+            commission.commission_type = Commission.CommissionType.DIRECT
+            commission.payment_status = Commission.PaymentStatus.PENDING
+            commission.updated_at = now
+            # Повторы полиса внутри чанка: как и при построчном update_or_create, побеждает последняя строка
+            if commission.pk:
+                to_update[policy.id] = commission
+            else:
+                to_create[policy.id] = commission
+
+        created = Commission.objects.bulk_create(to_create.values(), batch_size=self.batch_size)
+        Commission.objects.bulk_update(to_update.values(), COMMISSION_UPDATE_FIELDS, batch_size=self.batch_size)
+
+        # bulk_create не вызывает save(), поэтому оверрайды для новых прямых комиссий создаем сами
+        chains = get_ancestor_chains({commission.adviser_id for commission in created})
+        overrides = [
+            override
+            for commission in created
+            for override in commission.build_overrides(chains[commission.adviser_id])
+        ]
+        Override.objects.bulk_create(overrides, batch_size=self.batch_size)
+
+        self._update_rollups(created, to_update.values(), previous, overrides)
+        apply_rules(created, batch_size=self.batch_size)
+        invalidate_adviser_profiles({commission.adviser_id for commission in created})
+        if to_update:
+            invalidate_commission_profiles(
+                [commission.pk for commission in to_update.values()],
+                {values['adviser_id'] for values in previous.values()} | {c.adviser_id for c in to_update.values()},
+            )
+
+        updated = list(to_update.values())
+
+        def publish():
+            # Одно сообщение на группу получателей за весь чанк
+            publish_deal_events(created)
+            publish_deal_events(updated, 'updated')
+
+        transaction.on_commit(publish)
+
+        stats['created'] += len(created)
+        stats['updated'] += len(to_update)
+        stats['overrides'] += len(overrides)
+
+    def _update_rollups(self, created, updated, previous, overrides):
+        """Массовая запись не вызывает сигналы, поэтому дневные итоги обновляем сами."""
+        deltas = RollupDeltas()
+        moves = {}
+        for commission in updated:
+            old_values, new_values = previous[commission.pk], commission_rollup_values(commission)
+            deltas.add_commission(old_values, sign=-1)
+            deltas.add_commission(new_values)
+            if rollup_key(old_values) != rollup_key(new_values):
+                moves[commission.pk] = (rollup_key(old_values), rollup_key(new_values))
+        deltas.move_modifiers(moves)
+        for commission in created:
+            deltas.add_commission(commission_rollup_values(commission))
+        for override in overrides:
+            deltas.add_modifier(rollup_key(commission_rollup_values(override.commission)), 'override_total', override.amount)
+        deltas.apply()
+
+    def _get_or_create_policies(self, rows, advisers):
+        """Аналог Policy.get_or_create для всех номеров полисов чанка."""
+        policies = Policy.objects.in_bulk({data['policy_number'] for data in rows}, field_name='policy_number')
+        new_policies = {}
+        for data in rows:
+            if data['policy_number'] not in policies and data['policy_number'] not in new_policies:
+                new_policies[data['policy_number']] = Policy(
+                    policy_number=data['policy_number'],
+                    adviser_id=advisers[data['adviser_username']][0],
+                    provider=data['provider'],
+                    date_issued=data['date_received'],
+                )
+        for policy in Policy.objects.bulk_create(new_policies.values(), batch_size=self.batch_size):
+            policies[policy.policy_number] = policy
+        return policies
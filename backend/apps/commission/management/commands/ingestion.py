@@ -1,15 +1,14 @@
 import csv
-from decimal import Decimal
-from datetime import datetime
-from django.core.management.base import BaseCommand
-from django.contrib.auth import get_user_model
+import sys
+import time
 
-from backend.apps.advisers.models import Adviser
-from backend.apps.commission.models import Commission
-from backend.apps.products.models import Product
-from backend.apps.policies.models import Policy
+from django.core.management.base import BaseCommand, CommandError
+
+from backend.apps.commission.ingestion import CommissionCSVImporter, REQUIRED_HEADERS, iter_chunks
+
+# Файл по умолчанию, если путь не передан (прежнее поведение команды)
+DEFAULT_FILE_PATH = "C:\\Users\\piese\\PcharmProjects\\commission-tracker\\data\\commissions.csv"
 
-User = get_user_model()
 
 class Command(BaseCommand):
     """
@@ -17,58 +16,73 @@ class Command(BaseCommand):
     Предполагается, что в CSV есть колонки:
     policy_number, adviser_username, product_name, provider,
     gross_commission, net_commission, date_received
+
+    Файл читается потоково и обрабатывается чанками: каждый чанк пишется
+    массовыми запросами в отдельной транзакции.
     """
     help = "Загружает данные о транзакциях из CSV файла"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'file_path', nargs='?', default=DEFAULT_FILE_PATH,
+            help="Путь к CSV файлу или '-' для чтения из stdin (по умолчанию — DEFAULT_FILE_PATH)",
+        )
+        parser.add_argument('--chunk-size', type=int, default=5000, help="Количество строк в одной транзакции")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Размер пакета для bulk_create/bulk_update")
+
     def handle(self, *args, **options):
-        # Укажите правильный путь к вашему файлу
-        file_path = "C:\\Users\\piese\\PcharmProjects\\commission-tracker\\data\\commissions.csv"
-        self.stdout.write(self.style.SUCCESS(f"Начинаем имп��рт из {file_path}"))
-
-        with open(file_path, "r", encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                try:
-                    # 1. Находим консультанта (пропускаем, если не найден)
-                    adviser = Adviser.objects.get(user__username=row["adviser_username"])
-
-                    # 2. Находим или создаем продукт
-                    product, _ = Product.objects.get_or_create(name=row["product_name"])
-
-                    # 3. Находим или создаем полис
-                    policy, created = Policy.objects.get_or_create(
-                        policy_number=row["policy_number"],
-                        defaults={
-                            'adviser': adviser,
-                            'provider': row["provider"],
-                            'date_issued': datetime.strptime(row["date_received"], "%Y-%m-%d").date(),
-                        }
-                    )
-                    if created:
-                        self.stdout.write(f"Созда�� полис: {policy.policy_number}")
-
-                    # 4. Создаем или обновляем комиссию
-                    commission, created = Commission.objects.update_or_create(
-                        policy=policy,
-                        defaults={
-                            'product': product,
-                            'adviser': adviser,
-                            'gross_commission': Decimal(row["gross_commission"]),
-                            'net_commission': Decimal(row["net_commission"]),
-                            'adviser_fee_percentage': adviser.fee_percentage,
-                            'date_received': policy.date_issued,
-                            'commission_type': Commission.CommissionType.DIRECT,
-                            'payment_status': Commission.PaymentStatus.PENDING,
-                        }
-                    )
-
-                    action = "Создана" if created else "Обновлена"
-                    self.stdout.write(f"{action} комиссия для полиса {policy.policy_number}")
-
-                except Adviser.DoesNotExist:
-                    self.stdout.write(self.style.WARNING(f'Пропущен: Консультант "{row["adviser_username"]}" не найден.'))
-                    continue
-                except Exception as e:
-                    self.stdout.write(self.style.ERROR(f'Ошибка в строке {reader.line_num}: {e}'))
-
-        self.stdout.write(self.style.SUCCESS("Импорт завершен."))
+        file_path = options['file_path']
+        if options['chunk_size'] < 1 or options['batch_size'] < 1:
+            raise CommandError("--chunk-size и --batch-size должны быть положительными.")
+
+        self.stdout.write(self.style.SUCCESS(f"Начинаем импорт из {'stdin' if file_path == '-' else file_path}"))
+
+        if file_path == '-':
+            self._import(sys.stdin, options)
+        else:
+            with open(file_path, "r", encoding='utf-8', newline='') as f:
+                self._import(f, options)
+
+    def _import(self, f, options):
+        reader = csv.DictReader(f)
+        missing = [header for header in REQUIRED_HEADERS if header not in (reader.fieldnames or [])]
+        if missing:
+            raise CommandError(f"Отсутствуют обязательные заголовки в CSV файле: {', '.join(missing)}.")
+
+        importer = CommissionCSVImporter(batch_size=options['batch_size'])
+        totals = {'rows': 0, 'created': 0, 'updated': 0, 'overrides': 0, 'skipped': 0, 'errors': 0, 'queries': 0}
+        chunk_count = 0
+        started = time.monotonic()
+
+        for chunk in iter_chunks(reader, options['chunk_size']):
+            chunk_count += 1
+            stats = importer.import_chunk(chunk)
+
+            for message in stats['skipped']:
+                self.stdout.write(self.style.WARNING(f"Пропущен: {message}"))
+            for message in stats['errors']:
+                self.stdout.write(self.style.ERROR(message))
+
+            totals['rows'] += len(chunk)
+            totals['skipped'] += len(stats['skipped'])
+            totals['errors'] += len(stats['errors'])
+            for key in ('created', 'updated', 'overrides', 'queries'):
+                totals[key] += stats[key]
+
+            self.stdout.write(
+                f"Чанк {chunk_count}: строк {len(chunk)}, создано {stats['created']}, "
+                f"обновлено {stats['updated']}, оверрайдов {stats['overrides']}, запросов {stats['queries']}"
+            )
+
+        elapsed = time.monotonic() - started
+        rows_per_sec = totals['rows'] / elapsed if elapsed else 0
+        queries_per_chunk = totals['queries'] / chunk_count if chunk_count else 0
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Импорт завершен: строк {totals['rows']}, создано {totals['created']}, обновлено {totals['updated']}, "
+            f"оверрайдов {totals['overrides']}, пропущено {totals['skipped']}, ошибок {totals['errors']}."
+        ))
+        self.stdout.write(
+            f"Производительность: {rows_per_sec:.0f} строк/сек за {elapsed:.2f} сек, "
+            f"{queries_per_chunk:.1f} запросов на чанк ({chunk_count} чанков)."
+        )
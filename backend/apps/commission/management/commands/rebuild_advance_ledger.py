@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from backend.apps.commission.advances import check_advance_ledger, rebuild_advance_ledger
+
+
+class Command(BaseCommand):
+    """
+    Пересобирает остатки авансов и консультантов (advances.py) по таблице
+    погашений или, с --check, только сверяет их. Нужна для исторических
+    авансов и после изменений через update() или bulk_create.
+    """
+    help = "Пересобирает или сверяет остатки по авансам"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help="Только сверить, ничего не меняя")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Размер пакета для bulk_update/bulk_create")
+
+    def handle(self, *args, **options):
+        if options['check']:
+            mismatches = check_advance_ledger()
+            for key, expected, actual in mismatches:
+                self.stdout.write(self.style.ERROR(f"Расхождение {key}: ожидалось {expected}, в реестре {actual}"))
+            if mismatches:
+                raise CommandError(f"Найдено расхождений: {len(mismatches)}.")
+            self.stdout.write(self.style.SUCCESS("Остатки по авансам совпадают с погашениями."))
+            return
+
+        self.stdout.write("Пересобираем остатки по авансам...")
+        changed = rebuild_advance_ledger(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Готово: исправлено авансов: {changed}."))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from backend.apps.commission.rollups import check_rollups, rebuild_rollups
+
+
+class Command(BaseCommand):
+    """
+    Пересобирает дневные итоги CommissionDailyRollup по таблицам комиссий и модификаторов
+    или, с --check, только сверяет их. Нужна для существующих данных и после
+    изменений через update(), которые не вызывают сигналы.
+    """
+    help = "Пересобирает или сверяет дневные итоги по комиссиям"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help="Только сверить итоги, ничего не меняя")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Размер пакета для bulk_create")
+
+    def handle(self, *args, **options):
+        if options['check']:
+            mismatches = check_rollups()
+            for key, expected, actual in mismatches:
+                self.stdout.write(self.style.ERROR(f"Расхождение {key}: ожидалось {expected}, в итогах {actual}"))
+            if mismatches:
+                raise CommandError(f"Найдено расхождений: {len(mismatches)}.")
+            self.stdout.write(self.style.SUCCESS("Итоги совпадают с исходными данными."))
+            return
+
+        self.stdout.write("Пересобираем дневные итоги по комиссиям...")
+        created = rebuild_rollups(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Готово: создано {created} строк итогов."))
@@ -0,0 +1,43 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from backend.apps.commission.achievements_engine import rebuild_counters
+from backend.apps.commission.rollups import check_monthly_sales, rebuild_monthly_sales
+
+
+class Command(BaseCommand):
+    """
+    Пересобирает месячные продажи консультантов AdviserMonthlySales по таблице
+    Commission — все или начиная с заданного месяца — или, с --check, только
+    сверяет их. Нужна для исторических месяцев и после изменений через update().
+    Счетчики достижений, которые выводятся из месячных продаж, пересобираются следом.
+    """
+    help = "Пересобирает или сверяет месячные продажи консультантов"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help="Первый пересобираемый месяц (YYYY-MM)")
+        parser.add_argument('--check', action='store_true', help="Только сверить, ничего не меняя")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Размер пакета для bulk_create")
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = datetime.strptime(options['since'], '%Y-%m').date()
+            except ValueError:
+                raise CommandError(f"Неверный месяц: {options['since']}, ожидается YYYY-MM.")
+
+        if options['check']:
+            mismatches = check_monthly_sales(since)
+            for key, expected, actual in mismatches:
+                self.stdout.write(self.style.ERROR(f"Расхождение {key}: ожидалось {expected}, в итогах {actual}"))
+            if mismatches:
+                raise CommandError(f"Найдено расхождений: {len(mismatches)}.")
+            self.stdout.write(self.style.SUCCESS("Месячные продажи совпадают с исходными данными."))
+            return
+
+        self.stdout.write("Пересобираем месячные продажи консультантов...")
+        created = rebuild_monthly_sales(since, batch_size=options['batch_size'])
+        counters = rebuild_counters(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Готово: создано {created} строк, счетчиков достижений: {counters}."))
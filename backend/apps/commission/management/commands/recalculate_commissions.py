@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from backend.apps.commission.recalculation import recalculate_commissions
+
+
+class Command(BaseCommand):
+    """
+    Пересчитывает вознаграждения и бонусы правил комиссий за период и/или
+    по консультантам после изменения ставок или правил. Расчет идет по частям,
+    разбитым по консультантам, в текущем процессе или с --workers N в пуле
+    из N процессов; запись — пакетная.
+    С --dry-run только показывает, какие суммы изменятся.
+    """
+    help = "Пакетно пересчитывает комиссии за период"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='date_from', help="Начало периода (YYYY-MM-DD)")
+        parser.add_argument('--to', dest='date_to', help="Конец периода включительно (YYYY-MM-DD)")
+        parser.add_argument('--adviser', dest='adviser_ids', type=int, action='append', help="ID консультанта (можно несколько)")
+        parser.add_argument('--refresh-rates', action='store_true', help="Взять текущие ставки консультантов")
+        parser.add_argument('--dry-run', action='store_true', help="Показать изменения, ничего не записывая")
+        parser.add_argument('--workers', type=int, default=1, help="Число рабочих процессов (1 — без пула)")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Размер пакета для bulk-запросов")
+
+    def handle(self, *args, **options):
+        dates = {}
+        for name in ('date_from', 'date_to'):
+            if options[name]:
+                dates[name] = parse_date(options[name])
+                if dates[name] is None:
+                    raise CommandError(f"Неверная дата: {options[name]}")
+        if options['workers'] < 1 or options['batch_size'] < 1:
+            raise CommandError("--workers и --batch-size должны быть положительными.")
+
+        report = recalculate_commissions(
+            adviser_ids=options['adviser_ids'],
+            refresh_rates=options['refresh_rates'],
+            dry_run=options['dry_run'],
+            workers=options['workers'],
+            batch_size=options['batch_size'],
+            **dates,
+        )
+
+        if options['dry_run']:
+            for change in report['fee_changes']:
+                self.stdout.write(
+                    f"Комиссия {change.commission_id} (консультант {change.adviser_id}): "
+                    f"вознаграждение {change.old} -> {change.new}"
+                )
+            for change in report['bonus_changes']:
+                self.stdout.write(
+                    f"Комиссия {change.commission_id} (консультант {change.adviser_id}): "
+                    f"бонус правила {change.rule_id} {change.old or '-'} -> {change.new or '-'}"
+                )
+
+        verb = "Будет изменено" if options['dry_run'] else "Изменено"
+        self.stdout.write(self.style.SUCCESS(
+            f"Проверено комиссий: {report['commissions']}. {verb}: ставок {report['rate_changes']}, "
+            f"вознаграждений {len(report['fee_changes'])}, бонусов {len(report['bonus_changes'])}."
+        ))
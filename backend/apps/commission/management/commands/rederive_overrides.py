@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from backend.apps.advisers.models import Adviser
+from backend.apps.commission.overrides import OVERRIDE_CHUNK_SIZE, rederive_overrides
+
+
+class Command(BaseCommand):
+    """
+    Пересчитывает оверрайды прямых комиссий поддерева консультанта по текущей
+    иерархии и ставкам (overrides.py) — частями, с записью только различий.
+    Без --from окно начинается с первого дня текущего месяца.
+    """
+    help = "Пересчитывает оверрайды поддерева консультанта"
+
+    def add_arguments(self, parser):
+        parser.add_argument('adviser_id', type=int, help="ID консультанта, у которого изменились ставка или руководитель")
+        parser.add_argument('--from', dest='effective_from', help="Начало окна (YYYY-MM-DD)")
+        parser.add_argument('--to', dest='effective_to', help="Конец окна включительно (YYYY-MM-DD)")
+        parser.add_argument('--chunk-size', type=int, default=OVERRIDE_CHUNK_SIZE, help="Комиссий в одной транзакции")
+
+    def handle(self, *args, **options):
+        if not Adviser.objects.filter(pk=options['adviser_id']).exists():
+            raise CommandError(f"Консультант {options['adviser_id']} не найден.")
+        dates = {}
+        for name in ('effective_from', 'effective_to'):
+            if options[name]:
+                dates[name] = parse_date(options[name])
+                if dates[name] is None:
+                    raise CommandError(f"Неверная дата: {options[name]}")
+        if options['chunk_size'] < 1:
+            raise CommandError("--chunk-size должен быть положительным.")
+
+        report = rederive_overrides(options['adviser_id'], chunk_size=options['chunk_size'], **dates)
+        self.stdout.write(self.style.SUCCESS(
+            f"Комиссий: {report['commissions']}, оверрайдов создано {report['created']}, "
+            f"изменено {report['updated']}, удалено {report['deleted']}."
+        ))
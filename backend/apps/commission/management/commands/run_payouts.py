@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from backend.apps.commission.payouts import PAYOUT_PARTITION_SIZE, execute_payout_run
+
+
+class Command(BaseCommand):
+    """
+    Выполняет запуск выплат консультантам за период (payouts.py): составляющие
+    считаются агрегирующими запросами по частям консультантов, части — в
+    нескольких потоках. Результат сохраняется неизменяемым запуском со строками.
+    """
+    help = "Рассчитывает выплаты консультантам за период"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='period_start', required=True, help="Начало периода (YYYY-MM-DD)")
+        parser.add_argument('--to', dest='period_end', required=True, help="Конец периода включительно (YYYY-MM-DD)")
+        parser.add_argument('--workers', type=int, default=4, help="Число потоков")
+        parser.add_argument('--partition-size', type=int, default=PAYOUT_PARTITION_SIZE, help="Консультантов в части")
+
+    def handle(self, *args, **options):
+        period_start, period_end = parse_date(options['period_start']), parse_date(options['period_end'])
+        if period_start is None or period_end is None or period_start > period_end:
+            raise CommandError("Укажите корректный период --from/--to (YYYY-MM-DD).")
+        if options['workers'] < 1 or options['partition_size'] < 1:
+            raise CommandError("--workers и --partition-size должны быть положительными.")
+
+        run = execute_payout_run(
+            period_start, period_end, workers=options['workers'], partition_size=options['partition_size'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Запуск {run.pk}: консультантов {run.adviser_count}, к выплате {run.total_payable}."
+        ))
@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
-from django.db import models
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
 from django.core.validators import MinValueValidator, MaxValueValidator
 from decimal import Decimal
 
 from backend.apps.policies.models import Policy
 from backend.apps.advisers.models import Adviser
+from backend.apps.advisers.hierarchy import get_ancestor_chain
 from backend.apps.products.models import Product
 
 
@@ -78,39 +81,68 @@ class Commission(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Keyset-пагинация списков
+            models.Index(fields=['date_received', 'id']),
+        ]
+
+    @staticmethod
+    def calculate_adviser_fee(net_commission, fee_percentage):
+        """Вознаграждение консультанта от чистой комиссии."""
+        return net_commission * (fee_percentage / Decimal(100))
+
     def save(self, *args, **kwargs):
         # Автоматически рассчитываем вознаграждение консультанта
-        self.adviser_fee_amount = self.net_commission * (self.adviser_fee_percentage / Decimal(100))
+        self.adviser_fee_amount = self.calculate_adviser_fee(self.net_commission, self.adviser_fee_percentage)
 
         is_new = self._state.adding
         super().save(*args, **kwargs)
 
         # Если это новая прямая комиссия, создаем оверрайды для руководителей
+        # и начисляем бонусы по правилам (rules_engine.py)
         if is_new and self.commission_type == self.CommissionType.DIRECT:
             self.create_overrides()
+            from .rules_engine import apply_rules
+            apply_rules([self])
 
     def create_overrides(self):
-        """Создает оверрайдные комиссии для иерархии руководителей."""
-        current_adviser = self.adviser
+        """
+        Создает оверрайдные комиссии для иерархии руководителей.
+        Цепочка берется из кэша иерархии, все оверрайды пишутся одним INSERT,
+        сумма оверрайдов добавляется в дневные итоги (rollups.py).
+        """
+        from .rollups import RollupDeltas, commission_rollup_values, rollup_key
+
+        chain = get_ancestor_chain(self.adviser_id)
+        overrides = Override.objects.bulk_create(self.build_overrides(chain))
+        # bulk_create не вызывает сигналы, поэтому дневные итоги обновляем сами
+        deltas = RollupDeltas()
+        key = rollup_key(commission_rollup_values(self))
+        for override in overrides:
+            deltas.add_modifier(key, 'override_total', override.amount)
+        deltas.apply()
+        return overrides
+
+    def build_overrides(self, chain):
+        """
+        Возвращает несохраненные оверрайды для цепочки руководителей.
+        `chain` — цепочка из advisers.hierarchy: сам консультант, затем его руководители.
+        """
+        overrides = []
         last_fee_percentage = self.adviser_fee_percentage
-
-        while current_adviser and current_adviser.parent_adviser:
-            manager = current_adviser.parent_adviser
-
-            # Ов��ррайд = (процент менеджера - процент подчиненного) * чистая комиссия
+        for subordinate, manager in zip(chain, chain[1:]):
+            # Оверрайд = (процент менеджера - процент подчиненного) * чистая комиссия
             override_percentage = manager.fee_percentage - last_fee_percentage
             if override_percentage > 0:
-                override_amount = self.net_commission * (override_percentage / 100)
-
-                Override.objects.create(
+                overrides.append(Override(
                     commission=self,
-                    recipient=manager,
-                    amount=override_amount,
-                    reason=f"Override from {current_adviser.user.get_full_name()}"
-                )
-
-            current_adviser = manager
+                    recipient_id=manager.id,
+                    amount=self.net_commission * (override_percentage / 100),
+                    reason=f"Override from {subordinate.full_name}"
+                ))
             last_fee_percentage = manager.fee_percentage
+        return overrides
 
     def __str__(self):
         return f"Commission for {self.policy.policy_number}"
@@ -161,6 +193,16 @@ class Bonus(CommissionModifier):
     """
     kpi_type = models.CharField(max_length=100, blank=True, help_text="e.g., New Business Volume, Cross-sell")
     kpi_achieved = models.BooleanField(default=False)
+    rule = models.ForeignKey(
+        'CommissionRule', on_delete=models.SET_NULL, null=True, blank=True, related_name='bonuses',
+        help_text="Правило, начислившее бонус (пусто для бонусов, внесенных вручную)."
+    )
+
+    class Meta:
+        constraints = [
+            # Одно правило начисляет не больше одного бонуса на комиссию (ключ для bulk upsert)
+            models.UniqueConstraint(fields=['commission', 'rule'], name='unique_bonus_per_commission_rule'),
+        ]
 
 
 class Override(CommissionModifier):
@@ -201,6 +243,21 @@ class Advance(models.Model):
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     date_issued = models.DateField()
     is_fully_repaid = models.BooleanField(default=False)
+    outstanding_balance = models.DecimalField(
+        max_digits=10, decimal_places=2, default=0,
+        help_text="Остаток к погашению: сумма аванса минус погашения. Ведется автоматически (advances.py).",
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['adviser'], condition=models.Q(is_fully_repaid=False), name='advance_open_by_adviser'),
+        ]
+
+    def save(self, *args, **kwargs):
+        # Остаток выставляется в pre_save по заблокированной строке (advances.prepare_advance);
+        # блокировка держится до записи аванса и остатка консультанта
+        with transaction.atomic():
+            super().save(*args, **kwargs)
 
 class Repayment(models.Model):
     """Погашение аванса, обычно из комиссии."""
@@ -209,6 +266,29 @@ class Repayment(models.Model):
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     date_repaid = models.DateField()
 
+class AdviserAdvanceBalance(models.Model):
+    """
+    Непогашенный остаток авансов консультанта: сумма outstanding_balance
+    его открытых авансов. Ведется вместе с остатками авансов (advances.py);
+    по частичному индексу выбираются консультанты с долгом без чтения погашений.
+    """
+    adviser = models.OneToOneField(
+        Adviser, on_delete=models.CASCADE, primary_key=True, related_name='advance_balance'
+    )
+    outstanding_balance = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    open_advances = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['-outstanding_balance'], condition=models.Q(outstanding_balance__gt=0),
+                name='adviser_outstanding_advances',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.adviser_id}: {self.outstanding_balance}"
+
 class VestingSchedule(models.Model):
     """График вестинга для бонусов или других отложенных выплат."""
     name = models.CharField(max_length=255)
@@ -222,3 +302,242 @@ class ScheduledPayout(models.Model):
     payout_date = models.DateField()
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     is_paid = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['schedule', 'commission', 'payout_date'], name='unique_scheduled_payout',
+            ),
+        ]
+        indexes = [
+            # Поиск наступивших невыплаченных выплат (vesting.py)
+            models.Index(fields=['is_paid', 'payout_date'], name='scheduled_payout_due'),
+        ]
+
+
+class CommissionDailyRollup(models.Model):
+    """
+    Дневные итоги по комиссиям консультанта в разрезе типа и статуса выплаты.
+    Поддерживаются инкрементально (см. rollups.py) и используются статистическими
+    эндпоинтами вместо агрегации по всей таблице Commission.
+    """
+    adviser = models.ForeignKey(Adviser, on_delete=models.CASCADE, related_name='commission_rollups')
+    day = models.DateField()
+    commission_type = models.CharField(max_length=10, choices=Commission.CommissionType.choices)
+    payment_status = models.CharField(max_length=20, choices=Commission.PaymentStatus.choices)
+
+    commission_count = models.IntegerField(default=0)
+    gross_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    net_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    fee_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    retention_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    clawback_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    bonus_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    override_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    referral_fee_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['adviser', 'day', 'commission_type', 'payment_status'],
+                name='unique_commission_daily_rollup',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['day']),
+        ]
+
+    def __str__(self):
+        return f"{self.adviser_id} {self.day} {self.commission_type}/{self.payment_status}"
+
+
+class AdviserMonthlySales(models.Model):
+    """
+    Накопительный итог продаж консультанта за месяц (прямые комиссии, net_commission).
+    Поддерживается вместе с дневными итогами (rollups.py) и питает счетчики
+    достижений. KPI правил PERFORMANCE считается с начала месяца по дату
+    комиссии, поэтому читает дневные итоги, а не эту таблицу.
+    """
+    adviser = models.ForeignKey(Adviser, on_delete=models.CASCADE, related_name='monthly_sales')
+    month = models.DateField(help_text="Первый день месяца.")
+    commission_count = models.IntegerField(default=0)
+    net_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['adviser', 'month'], name='unique_adviser_monthly_sales'),
+        ]
+
+    def __str__(self):
+        return f"{self.adviser_id} {self.month:%Y-%m}: {self.net_total}"
+
+
+class AdviserAchievementCounters(models.Model):
+    """
+    Счетчики консультанта для достижений: число прямых комиссий, объем продаж
+    и серия месяцев подряд с продажами. Пересчитываются по месячным продажам
+    после коммита (achievements_engine.py), значки проверяются по ним.
+    """
+    adviser = models.OneToOneField(
+        Adviser, on_delete=models.CASCADE, primary_key=True, related_name='achievement_counters'
+    )
+    commission_count = models.IntegerField(default=0)
+    net_volume = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    month_streak = models.IntegerField(default=0, help_text="Месяцев подряд с продажами, по последний месяц с продажами.")
+    best_month_streak = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.adviser_id}: {self.commission_count} / {self.net_volume}"
+
+
+class Badge(models.Model):
+    """Значок, который присуждается при достижении порога по одному из счетчиков."""
+    class Metric(models.TextChoices):
+        COMMISSION_COUNT = 'commission_count', 'Количество сделок'
+        NET_VOLUME = 'net_volume', 'Объем продаж'
+        MONTH_STREAK = 'month_streak', 'Месяцев подряд с продажами'
+
+    name = models.CharField(max_length=100, unique=True)
+    description = models.TextField(blank=True)
+    icon = models.CharField(max_length=100, blank=True)
+    metric = models.CharField(max_length=20, choices=Metric.choices)
+    threshold = models.DecimalField(max_digits=16, decimal_places=2)
+    is_active = models.BooleanField(default=True)
+
+    def __str__(self):
+        return self.name
+
+
+class Achievement(models.Model):
+    """Присужденный консультанту значок."""
+    adviser = models.ForeignKey(Adviser, on_delete=models.CASCADE, related_name='achievements')
+    badge = models.ForeignKey(Badge, on_delete=models.CASCADE, related_name='achievements')
+    awarded_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['adviser', 'badge'], name='unique_adviser_badge'),
+        ]
+
+    def __str__(self):
+        return f"{self.badge} for {self.adviser_id}"
+
+
+class CommissionRuleSet(models.Model):
+    """
+    Набор правил начисления бонусов. Активные наборы, действующие на дату
+    комиссии, применяются движком правил (rules_engine.py).
+    """
+    name = models.CharField(max_length=100)
+    is_active = models.BooleanField(default=True)
+    valid_from = models.DateField(null=True, blank=True)
+    valid_to = models.DateField(null=True, blank=True)
+    priority = models.PositiveIntegerField(default=0, help_text="Наборы применяются в порядке возрастания.")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['priority', 'id']
+
+    def __str__(self):
+        return self.name
+
+
+class CommissionRule(models.Model):
+    """
+    Правило бонуса: при выполнении условия консультант получает
+    rate от своего вознаграждения (adviser_fee_amount) отдельным бонусом.
+    """
+    class RuleType(models.TextChoices):
+        PRODUCT_CATEGORY = 'PRODUCT_CATEGORY', 'Категория продукта'
+        PERFORMANCE = 'PERFORMANCE', 'Продажи за месяц'
+        NET_THRESHOLD = 'NET_THRESHOLD', 'Крупная комиссия'
+
+    rule_set = models.ForeignKey(CommissionRuleSet, on_delete=models.CASCADE, related_name='rules')
+    name = models.CharField(max_length=100)
+    rule_type = models.CharField(max_length=20, choices=RuleType.choices)
+    rate = models.DecimalField(
+        max_digits=6, decimal_places=4,
+        validators=[MinValueValidator(Decimal('0'))],
+        help_text="Доля вознаграждения консультанта, например 0.05 = 5%."
+    )
+    threshold = models.DecimalField(
+        max_digits=12, decimal_places=2, null=True, blank=True,
+        help_text="Порог для PERFORMANCE (продажи за месяц) и NET_THRESHOLD (чистая комиссия)."
+    )
+    categories = models.JSONField(default=list, blank=True, help_text="Названия категорий продуктов для PRODUCT_CATEGORY.")
+    is_active = models.BooleanField(default=True)
+
+    def __str__(self):
+        return f"{self.rule_set.name}: {self.name}"
+
+
+class PayoutRun(models.Model):
+    """
+    Расчет выплат консультантам за период (payouts.py). После завершения
+    запуск и его строки не меняются: повторный расчет создает новый запуск.
+    """
+    class Status(models.TextChoices):
+        RUNNING = 'RUNNING', 'Выполняется'
+        COMPLETED = 'COMPLETED', 'Завершен'
+        FAILED = 'FAILED', 'Ошибка'
+
+    period_start = models.DateField()
+    period_end = models.DateField()
+    status = models.CharField(max_length=20, choices=Status.choices, default=Status.RUNNING)
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    adviser_count = models.IntegerField(default=0)
+    total_payable = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+
+    class Meta:
+        ordering = ['-created_at', '-id']
+
+    def save(self, *args, **kwargs):
+        # Состояние запуска меняет только движок расчета (update() по статусу)
+        if not self._state.adding:
+            raise ValidationError("Запуск выплат нельзя изменить.")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValidationError("Запуск выплат нельзя удалить.")
+
+    def __str__(self):
+        return f"Payout run {self.pk}: {self.period_start} - {self.period_end}"
+
+
+class PayoutLine(models.Model):
+    """
+    Итог выплаты консультанту в запуске: вознаграждение минус удержания,
+    плюс бонусы и полученные оверрайды, минус возвраты и погашения авансов,
+    плюс доли разделенных комиссий. Строки только создаются.
+    """
+    run = models.ForeignKey(PayoutRun, on_delete=models.PROTECT, related_name='lines')
+    adviser = models.ForeignKey(Adviser, on_delete=models.PROTECT, related_name='payout_lines')
+    fee_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    retention_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    clawback_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    bonus_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    override_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    split_total = models.DecimalField(
+        max_digits=14, decimal_places=2, default=0,
+        help_text="Полученные доли разделенных комиссий минус отданные.",
+    )
+    repayment_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    net_payable = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['run', 'adviser'], name='unique_payout_line'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValidationError("Строку запуска выплат нельзя изменить.")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValidationError("Строку запуска выплат нельзя удалить.")
+
+    def __str__(self):
+        return f"{self.adviser_id} in run {self.run_id}: {self.net_payable}"
@@ -0,0 +1,123 @@
+"""
+Пересчет оверрайдов после изменения иерархии или ставок консультантов.
+
+Оверрайды комиссии строятся по цепочке руководителей (Commission.build_overrides)
+в момент создания комиссии. Когда у консультанта меняется fee_percentage или
+parent_adviser, устаревают оверрайды прямых комиссий всего его поддерева.
+Такие комиссии находятся через closure-таблицу иерархии и обрабатываются
+частями по id, каждая часть — в своей короткой транзакции: нужные оверрайды
+строятся по актуальным цепочкам и сравниваются с существующими, в БД уходят
+только различия (bulk_create новых, bulk_update измененных, удаление лишних),
+разница сумм вносится в дневные итоги (rollups.py).
+
+Пересчитываются только комиссии, полученные в окне дат (по умолчанию —
+с начала текущего месяца): оверрайды прошлых периодов уже выплачены.
+"""
+from collections import namedtuple
+
+from django.db import transaction
+from django.utils import timezone
+
+from backend.apps.advisers.hierarchy import descendant_ids_subquery, get_ancestor_chains
+from .models import Commission, Override
+from .profile import invalidate_adviser_profiles
+from .rollups import CENT, COMMISSION_KEY_FIELDS, RollupDeltas, rollup_key
+
+
+# Сколько комиссий обрабатывается в одной транзакции
+OVERRIDE_CHUNK_SIZE = 500
+
+OVERRIDE_COMMISSION_FIELDS = ('id', 'net_commission', 'adviser_fee_percentage') + COMMISSION_KEY_FIELDS
+
+OverrideChanges = namedtuple('OverrideChanges', ['created', 'updated', 'deleted'])
+
+
+def default_effective_from():
+    """Начало окна пересчета по умолчанию — первый день текущего месяца."""
+    return timezone.now().date().replace(day=1)
+
+
+def affected_commissions(adviser_id, effective_from, effective_to=None):
+    """Прямые комиссии консультанта и всего его поддерева, полученные в окне дат."""
+    commissions = Commission.objects.filter(
+        adviser_id__in=descendant_ids_subquery(adviser_id),
+        commission_type=Commission.CommissionType.DIRECT,
+        date_received__gte=effective_from,
+    )
+    if effective_to:
+        commissions = commissions.filter(date_received__lte=effective_to)
+    return commissions
+
+
+def rederive_chunk(rows):
+    """
+    Приводит оверрайды комиссий `rows` (словари OVERRIDE_COMMISSION_FIELDS)
+    к актуальной иерархии. Возвращает OverrideChanges.
+    """
+    chains = get_ancestor_chains({row['adviser_id'] for row in rows})
+    keys, desired = {}, {}
+    for row in rows:
+        keys[row['id']] = rollup_key(row)
+        commission = Commission(
+            pk=row['id'], adviser_id=row['adviser_id'],
+            net_commission=row['net_commission'], adviser_fee_percentage=row['adviser_fee_percentage'],
+        )
+        for override in commission.build_overrides(chains[row['adviser_id']]):
+            override.amount = override.amount.quantize(CENT)
+            desired[(row['id'], override.recipient_id)] = override
+
+    existing, stale = {}, []
+    for pk, commission_id, recipient_id, amount, reason in Override.objects.filter(
+        commission_id__in=keys
+    ).order_by('id').values_list('pk', 'commission_id', 'recipient_id', 'amount', 'reason'):
+        key = (commission_id, recipient_id)
+        if key in desired and key not in existing:
+            existing[key] = (pk, amount, reason)
+        else:
+            stale.append(pk)
+
+    created, updated = [], []
+    deltas = RollupDeltas()
+    for key, override in desired.items():
+        if key not in existing:
+            created.append(override)
+            deltas.add_modifier(keys[key[0]], 'override_total', override.amount)
+            continue
+        pk, amount, reason = existing[key]
+        if (amount, reason) != (override.amount, override.reason):
+            override.pk = pk
+            updated.append(override)
+            deltas.add_modifier(keys[key[0]], 'override_total', override.amount - amount)
+
+    # bulk_create и bulk_update не вызывают сигналы: разницу в дневные итоги вносим сами
+    Override.objects.bulk_create(created)
+    Override.objects.bulk_update(updated, ['amount', 'reason'])
+    deltas.apply()
+    # Удаление идет через delete() с сигналами, итоги и профили обновятся там
+    if stale:
+        Override.objects.filter(pk__in=stale).delete()
+
+    recipients = {override.recipient_id for override in created + updated}
+    invalidate_adviser_profiles(recipients | {row['adviser_id'] for row in rows})
+    return OverrideChanges(len(created), len(updated), len(stale))
+
+
+def rederive_overrides(adviser_id, effective_from=None, effective_to=None, chunk_size=OVERRIDE_CHUNK_SIZE):
+    """
+    Пересчитывает оверрайды комиссий поддерева консультанта в окне дат частями
+    по `chunk_size` комиссий, каждая часть — в отдельной транзакции.
+    Возвращает {'commissions', 'created', 'updated', 'deleted'}.
+    """
+    commissions = affected_commissions(adviser_id, effective_from or default_effective_from(), effective_to)
+    report = dict.fromkeys(('commissions', 'created', 'updated', 'deleted'), 0)
+    last_id = 0
+    while True:
+        rows = list(commissions.filter(id__gt=last_id).order_by('id').values(*OVERRIDE_COMMISSION_FIELDS)[:chunk_size])
+        if not rows:
+            return report
+        with transaction.atomic():
+            changes = rederive_chunk(rows)
+        report['commissions'] += len(rows)
+        for field, count in changes._asdict().items():
+            report[field] += count
+        last_id = rows[-1]['id']
@@ -0,0 +1,199 @@
+"""
+Расчет выплат консультантам за период (PayoutRun / PayoutLine).
+
+К выплате консультанту:
+    вознаграждение по его комиссиям (adviser_fee_amount)
+    - невыплаченные удержания (Retention, is_released=False)
+    - возвраты (Clawback, по модулю суммы)
+    + бонусы
+    + оверрайды, полученные от комиссий подчиненных
+    + доли разделенных комиссий, полученные от других, - отданные другим
+    - погашения авансов, внесенные в периоде.
+
+В период входят неотмененные комиссии с датой получения в его границах.
+Возвраты (Clawback) берутся по дате их создания в периоде, без условий на
+исходную комиссию: обычно она отменена и относится к одному из прошлых периодов.
+Каждая составляющая считается одним агрегирующим запросом с группировкой
+по консультанту, а не сериализацией комиссий. Консультанты делятся на
+части, части независимы и считаются параллельно: потоками
+(execute_payout_run) или подзадачами Celery (tasks.run_payouts_task).
+Строки части пишутся одним bulk_create; когда посчитаны все части,
+запуск получает итоги и становится неизменяемым.
+"""
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.db.models import Q, Sum
+from django.db.models.functions import Abs
+from django.utils import timezone
+
+from backend.apps.advisers.models import Adviser
+from .models import (
+    Bonus, Clawback, Commission, CommissionSplit, Override, PayoutLine, PayoutRun, Repayment, Retention,
+)
+from .rollups import CENT
+
+
+# Сколько консультантов считает одна часть
+PAYOUT_PARTITION_SIZE = 500
+
+PAYOUT_COMPONENTS = [
+    'fee_total', 'retention_total', 'clawback_total', 'bonus_total',
+    'override_total', 'split_total', 'repayment_total',
+]
+
+
+def _period_commissions(prefix, period_start, period_end):
+    """Условие "комиссия входит в период" для запроса со стороны модели через `prefix`."""
+    return Q(**{
+        f'{prefix}date_received__gte': period_start,
+        f'{prefix}date_received__lte': period_end,
+    }) & ~Q(**{f'{prefix}payment_status': Commission.PaymentStatus.CANCELLED})
+
+
+def _created_in_period(period_start, period_end):
+    """Условие "создано в периоде" через границы дней, чтобы сравнение шло по индексу, а не по __date."""
+    start = timezone.make_aware(datetime.combine(period_start, time.min))
+    end = timezone.make_aware(datetime.combine(period_end + timedelta(days=1), time.min))
+    return Q(created_at__gte=start, created_at__lt=end)
+
+
+def _totals(queryset, adviser_field, amount):
+    return queryset.values(adviser_field).annotate(total=Sum(amount)).order_by().values_list(adviser_field, 'total')
+
+
+def component_totals(period_start, period_end, adviser_ids):
+    """
+    Составляющие выплаты консультантов `adviser_ids` за период:
+    {adviser_id: {составляющая: сумма}}, по запросу на составляющую.
+    """
+    period = _period_commissions('', period_start, period_end)
+    via_commission = _period_commissions('commission__', period_start, period_end)
+    sources = [
+        ('fee_total', 1, _totals(
+            Commission.objects.filter(period, adviser_id__in=adviser_ids), 'adviser_id', 'adviser_fee_amount'
+        )),
+        ('retention_total', 1, _totals(
+            Retention.objects.filter(via_commission, commission__adviser_id__in=adviser_ids, is_released=False),
+            'commission__adviser_id', 'amount',
+        )),
+        ('clawback_total', 1, _totals(
+            Clawback.objects.filter(_created_in_period(period_start, period_end), commission__adviser_id__in=adviser_ids),
+            'commission__adviser_id', Abs('amount'),
+        )),
+        ('bonus_total', 1, _totals(
+            Bonus.objects.filter(via_commission, commission__adviser_id__in=adviser_ids),
+            'commission__adviser_id', 'amount',
+        )),
+        ('override_total', 1, _totals(
+            Override.objects.filter(via_commission, recipient_id__in=adviser_ids), 'recipient_id', 'amount'
+        )),
+        ('split_total', 1, _totals(
+            CommissionSplit.objects.filter(via_commission, adviser_id__in=adviser_ids), 'adviser_id', 'split_amount'
+        )),
+        ('split_total', -1, _totals(
+            CommissionSplit.objects.filter(via_commission, commission__adviser_id__in=adviser_ids),
+            'commission__adviser_id', 'split_amount',
+        )),
+        ('repayment_total', 1, _totals(
+            Repayment.objects.filter(
+                advance__adviser_id__in=adviser_ids, date_repaid__gte=period_start, date_repaid__lte=period_end,
+            ),
+            'advance__adviser_id', 'amount',
+        )),
+    ]
+    totals = defaultdict(lambda: dict.fromkeys(PAYOUT_COMPONENTS, Decimal('0.00')))
+    for component, sign, rows in sources:
+        for adviser_id, total in rows:
+            totals[adviser_id][component] += sign * Decimal(total or 0)
+    return totals
+
+
+def net_payable(components):
+    """Сумма к выплате по составляющим."""
+    return (
+        components['fee_total'] - components['retention_total'] - components['clawback_total']
+        + components['bonus_total'] + components['override_total'] + components['split_total']
+        - components['repayment_total']
+    ).quantize(CENT)
+
+
+def adviser_partitions(partition_size=PAYOUT_PARTITION_SIZE):
+    """Идентификаторы всех консультантов, поделенные на части."""
+    ids = list(Adviser.objects.order_by('id').values_list('id', flat=True))
+    return [ids[i:i + partition_size] for i in range(0, len(ids), partition_size)]
+
+
+def start_payout_run(period_start, period_end, created_by_id=None):
+    return PayoutRun.objects.create(period_start=period_start, period_end=period_end, created_by_id=created_by_id)
+
+
+def compute_payout_partition(run_id, adviser_ids):
+    """
+    Считает и записывает строки запуска для части консультантов.
+    Повтор части (например, после сбоя подзадачи) не создает дублей.
+    Возвращает количество строк.
+    """
+    run = PayoutRun.objects.get(pk=run_id)
+    if run.status != PayoutRun.Status.RUNNING:
+        raise ValueError(f"Запуск выплат {run_id} уже завершен.")
+    lines = [
+        PayoutLine(
+            run_id=run_id, adviser_id=adviser_id, net_payable=net_payable(components),
+            **{component: total.quantize(CENT) for component, total in components.items()},
+        )
+        for adviser_id, components in sorted(component_totals(run.period_start, run.period_end, adviser_ids).items())
+    ]
+    PayoutLine.objects.bulk_create(lines, ignore_conflicts=True)
+    return len(lines)
+
+
+def complete_payout_run(run_id):
+    """Подводит итоги запуска по его строкам и закрывает его для изменений."""
+    totals = PayoutLine.objects.filter(run_id=run_id).aggregate(total=Sum('net_payable'))
+    PayoutRun.objects.filter(pk=run_id, status=PayoutRun.Status.RUNNING).update(
+        status=PayoutRun.Status.COMPLETED,
+        completed_at=timezone.now(),
+        adviser_count=PayoutLine.objects.filter(run_id=run_id).count(),
+        total_payable=totals['total'] or 0,
+    )
+    return PayoutRun.objects.get(pk=run_id)
+
+
+def fail_payout_run(run_id):
+    PayoutRun.objects.filter(pk=run_id, status=PayoutRun.Status.RUNNING).update(
+        status=PayoutRun.Status.FAILED, completed_at=timezone.now(),
+    )
+
+
+def _compute_in_thread(run_id, adviser_ids):
+    try:
+        return compute_payout_partition(run_id, adviser_ids)
+    finally:
+        # У каждого потока свое соединение с БД
+        connection.close()
+
+
+def execute_payout_run(period_start, period_end, created_by_id=None, workers=1, partition_size=PAYOUT_PARTITION_SIZE):
+    """
+    Выполняет запуск выплат целиком в текущем процессе; с workers > 1 части
+    считаются параллельно в потоках, каждый со своим соединением с БД.
+    Возвращает завершенный запуск.
+    """
+    run = start_payout_run(period_start, period_end, created_by_id)
+    partitions = adviser_partitions(partition_size)
+    try:
+        # Внутри внешней транзакции потоки не видели бы ее данных — считаем последовательно
+        if workers > 1 and len(partitions) > 1 and not transaction.get_connection().in_atomic_block:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(_compute_in_thread, [run.pk] * len(partitions), partitions))
+        else:
+            for partition in partitions:
+                compute_payout_partition(run.pk, partition)
+    except Exception:
+        fail_payout_run(run.pk)
+        raise
+    return complete_payout_run(run.pk)
@@ -0,0 +1,126 @@
+"""
+Сводка для страницы профиля консультанта (MyProfileAPIView).
+
+Профиль и финансовая сводка читаются одним запросом с подзапросами
+(непогашенные авансы — готовым остатком из advances.py), статистика —
+из дневных итогов (rollups.py). Готовый ответ кэшируется на консультанта; ключ содержит версию иерархии, поэтому перенос
+поддерева сбрасывает все профили сразу. Записи комиссий, модификаторов,
+авансов и погашений сбрасывают профили затронутых консультантов (signals.py).
+"""
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db.models import DecimalField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from backend.apps.advisers.hierarchy import get_ancestor_chains, get_hierarchy_version
+from backend.apps.advisers.models import Adviser
+from backend.apps.advisers.serializers import AdviserSerializer
+from .models import AdviserAdvanceBalance, Override, Retention
+from .rollups import get_commission_statistics
+from .serializers import CommissionSerializer
+
+
+PROFILE_CACHE_TIMEOUT = 5 * 60
+PROFILE_HITS_KEY = 'commission:profile:hits'
+PROFILE_MISSES_KEY = 'commission:profile:misses'
+RECENT_COMMISSIONS_LIMIT = 5
+
+
+def _profile_key(version, adviser_id):
+    return f'commission:profile:{version}:{adviser_id}'
+
+
+def _sum_subquery(queryset, group_by):
+    """Сумма amount по queryset, сгруппированная по внешнему консультанту, 0 при отсутствии строк."""
+    total = queryset.values(group_by).annotate(total=Sum('amount')).values('total')
+    return Coalesce(
+        Subquery(total, output_field=DecimalField(max_digits=14, decimal_places=2)),
+        Value(Decimal('0.00')),
+        output_field=DecimalField(max_digits=14, decimal_places=2),
+    )
+
+
+def _increment(key):
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Ключ вытеснен между add и incr
+        cache.set(key, 1, timeout=None)
+
+
+def get_profile_cache_stats():
+    """Счетчики попаданий и промахов кэша профиля."""
+    return {
+        'hits': cache.get(PROFILE_HITS_KEY, 0),
+        'misses': cache.get(PROFILE_MISSES_KEY, 0),
+    }
+
+
+def invalidate_adviser_profiles(adviser_ids, with_managers=True):
+    """
+    Сбрасывает кэш профиля консультантов. С with_managers сбрасываются и профили
+    всех их руководителей: статистика и последние комиссии руководителя
+    включают комиссии поддерева.
+    """
+    adviser_ids = {adviser_id for adviser_id in adviser_ids if adviser_id is not None}
+    if not adviser_ids:
+        return
+    if with_managers:
+        adviser_ids |= {link.id for chain in get_ancestor_chains(adviser_ids).values() for link in chain}
+    version = get_hierarchy_version()
+    cache.delete_many([_profile_key(version, adviser_id) for adviser_id in adviser_ids])
+
+
+def invalidate_commission_profiles(commission_ids, adviser_ids=()):
+    """Сбрасывает профили всех, кто видит комиссии: консультантов, их руководителей и получателей оверрайдов."""
+    recipients = Override.objects.filter(commission_id__in=commission_ids).values_list('recipient_id', flat=True)
+    invalidate_adviser_profiles(set(adviser_ids) | set(recipients))
+
+
+def build_profile_payload(user, adviser_id):
+    """Собирает ответ MyProfileAPIView без кэша."""
+    adviser_profile = Adviser.objects.select_related('user', 'parent_adviser__user').annotate(
+        outstanding_advances=Coalesce(
+            Subquery(AdviserAdvanceBalance.objects.filter(adviser=OuterRef('pk')).values('outstanding_balance')),
+            Value(Decimal('0.00')),
+            output_field=DecimalField(max_digits=14, decimal_places=2),
+        ),
+        total_retentions=_sum_subquery(
+            Retention.objects.filter(commission__adviser=OuterRef('pk'), is_released=False), 'commission__adviser'
+        ),
+    ).get(pk=adviser_id)
+
+    # Импорт здесь, чтобы избежать цикла api_views -> profile -> api_views
+    from .api_views import get_commissions_for_user
+
+    recent_commissions = get_commissions_for_user(user).select_related(
+        'product__category', 'adviser__parent_adviser__user'
+    ).prefetch_related(
+        'retentions', 'clawbacks', 'bonuss', 'referralfees'
+    ).order_by('-date_received')[:RECENT_COMMISSIONS_LIMIT]
+
+    return {
+        "profile": AdviserSerializer(adviser_profile).data,
+        "statistics": get_commission_statistics(user),
+        "recent_commissions": CommissionSerializer(recent_commissions, many=True).data,
+        "financial_summary": {
+            "outstanding_advances": adviser_profile.outstanding_advances,
+            "total_retentions": adviser_profile.total_retentions,
+        },
+    }
+
+
+def get_profile_payload(user, adviser_id):
+    """Возвращает (ответ профиля, попадание в кэш)."""
+    key = _profile_key(get_hierarchy_version(), adviser_id)
+    payload = cache.get(key)
+    if payload is not None:
+        _increment(PROFILE_HITS_KEY)
+        return payload, True
+
+    _increment(PROFILE_MISSES_KEY)
+    payload = build_profile_payload(user, adviser_id)
+    cache.set(key, payload, timeout=PROFILE_CACHE_TIMEOUT)
+    return payload, False
@@ -0,0 +1,217 @@
+"""
+Пакетный пересчет комиссий за период после изменения ставок или правил.
+
+Вместо пересохранения комиссий по одной (с побочными эффектами save()
+и сигналами на каждую строку) данные загружаются заранее несколькими
+запросами, делятся на части по консультантам и считаются в пуле процессов:
+рабочий процесс получает определения правил и готовые данные, к БД
+не обращается. Результат сравнивается с текущими значениями и записывается
+пакетно — bulk_update вознаграждений и bulk upsert бонусов правил,
+с обновлением дневных итогов (rollups.py).
+
+В режиме dry_run возвращается только разница, без записи.
+"""
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from django.db import transaction
+
+from .models import Bonus, Commission
+from .profile import invalidate_commission_profiles
+from .recalculation_worker import init_recalculation_worker
+from .rollups import CENT, RollupDeltas, rollup_key
+from .rules_engine import (
+    EvaluationContext,
+    RuleEvaluator,
+    existing_rule_bonuses,
+    get_evaluator,
+    load_category_names,
+    load_daily_sales,
+    write_rule_bonuses,
+)
+
+
+# Данные комиссии, которых достаточно для пересчета (передаются в рабочие процессы)
+CommissionRow = namedtuple('CommissionRow', [
+    'pk', 'adviser_id', 'product_id', 'commission_type', 'payment_status', 'date_received',
+    'net_commission', 'adviser_fee_percentage', 'adviser_fee_amount',
+])
+
+FeeChange = namedtuple('FeeChange', ['commission_id', 'adviser_id', 'old', 'new'])
+BonusChange = namedtuple('BonusChange', ['commission_id', 'adviser_id', 'rule_id', 'old', 'new'])
+
+# Примерный размер части (число комиссий); консультант целиком попадает в одну часть
+PARTITION_SIZE = 5000
+
+_worker = {}
+
+
+def _init_worker(definitions, category_names):
+    """Компилирует правила в рабочем процессе (без обращения к БД)."""
+    _worker['evaluator'] = RuleEvaluator(definitions)
+    _worker['category_names'] = category_names
+
+
+def _evaluate_partition(partition):
+    """Считает часть: [(commission_id, вознаграждение, {rule_id: сумма бонуса})]."""
+    rows, daily_sales = partition
+    evaluator = _worker['evaluator']
+    context = EvaluationContext(_worker['category_names'], daily_sales)
+    results = []
+    for row in rows:
+        fee = Commission.calculate_adviser_fee(row.net_commission, row.adviser_fee_percentage).quantize(CENT)
+        bonuses = {}
+        # Правила применяются только к прямым комиссиям, как и при создании
+        if row.commission_type == Commission.CommissionType.DIRECT:
+            bonuses = {
+                rule.id: amount
+                for rule, amount in evaluator.matches(row._replace(adviser_fee_amount=fee), context)
+            }
+        results.append((row.pk, fee, bonuses))
+    return results
+
+
+def _load_rows(date_from, date_to, adviser_ids, refresh_rates):
+    """
+    Загружает строки комиссий одним запросом. Возвращает (строки, {commission_id: новая ставка})
+    — второе заполняется при refresh_rates для комиссий, ставка которых отличается от текущей.
+    """
+    queryset = Commission.objects.all()
+    if date_from:
+        queryset = queryset.filter(date_received__gte=date_from)
+    if date_to:
+        queryset = queryset.filter(date_received__lte=date_to)
+    if adviser_ids is not None:
+        queryset = queryset.filter(adviser_id__in=adviser_ids)
+    rows, new_rates = [], {}
+    values = queryset.order_by('adviser_id', 'date_received', 'pk').values_list(
+        *CommissionRow._fields, 'adviser__fee_percentage'
+    )
+    for *fields, current_rate in values:
+        row = CommissionRow(*fields)
+        if refresh_rates and current_rate != row.adviser_fee_percentage:
+            new_rates[row.pk] = current_rate
+            row = row._replace(adviser_fee_percentage=current_rate)
+        rows.append(row)
+    return rows, new_rates
+
+
+def partition_by_adviser(rows, partition_size=PARTITION_SIZE):
+    """Делит строки (отсортированные по консультанту) на части, не разрывая консультанта."""
+    partitions, current = [], []
+    for row in rows:
+        if len(current) >= partition_size and current[-1].adviser_id != row.adviser_id:
+            partitions.append(current)
+            current = []
+        current.append(row)
+    if current:
+        partitions.append(current)
+    return partitions
+
+
+def _evaluate(partitions, evaluator, category_names, workers):
+    initargs = (evaluator.definitions, category_names)
+    if workers > 1 and len(partitions) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_recalculation_worker, initargs=initargs) as pool:
+            for results in pool.map(_evaluate_partition, partitions):
+                yield from results
+    else:
+        _init_worker(*initargs)
+        for partition in partitions:
+            yield from _evaluate_partition(partition)
+
+
+def recalculate_commissions(date_from=None, date_to=None, adviser_ids=None, refresh_rates=False,
+                            dry_run=False, workers=1, batch_size=1000, partition_size=PARTITION_SIZE):
+    """
+    Пересчитывает вознаграждения консультантов и бонусы правил комиссий за период
+    и/или по консультантам. С refresh_rates ставка берется текущая из профиля консультанта.
+    Возвращает словарь: число комиссий, число измененных ставок и списки FeeChange/BonusChange.
+    """
+    rows, new_rates = _load_rows(date_from, date_to, adviser_ids, refresh_rates)
+    report = {'commissions': len(rows), 'rate_changes': len(new_rates), 'fee_changes': [], 'bonus_changes': []}
+    if not rows:
+        return report
+
+    evaluator = get_evaluator()
+    category_names, daily_sales = {}, {}
+    if evaluator.rules:
+        category_names = load_category_names({row.product_id for row in rows})
+        daily_sales = load_daily_sales(
+            {row.adviser_id for row in rows},
+            min(row.date_received for row in rows),
+            max(row.date_received for row in rows),
+        )
+    partitions = [
+        (part, {adviser_id: daily_sales[adviser_id] for adviser_id in {row.adviser_id for row in part} if adviser_id in daily_sales})
+        for part in partition_by_adviser(rows, partition_size)
+    ]
+
+    by_id = {row.pk: row for row in rows}
+    existing = existing_rule_bonuses(list(by_id)) if not evaluator.is_noop else {}
+    existing_by_commission = defaultdict(dict)
+    for (commission_id, rule_id), (_, amount) in existing.items():
+        existing_by_commission[commission_id][rule_id] = amount
+
+    new_fees, new_bonuses = {}, {}
+    for commission_id, fee, bonuses in _evaluate(partitions, evaluator, category_names, workers):
+        row = by_id[commission_id]
+        if fee != row.adviser_fee_amount:
+            new_fees[commission_id] = fee
+            report['fee_changes'].append(FeeChange(commission_id, row.adviser_id, row.adviser_fee_amount, fee))
+        old_bonuses = existing_by_commission.get(commission_id, {})
+        for rule_id in sorted(old_bonuses.keys() | bonuses.keys()):
+            old, new = old_bonuses.get(rule_id), bonuses.get(rule_id)
+            if old != new:
+                report['bonus_changes'].append(BonusChange(commission_id, row.adviser_id, rule_id, old, new))
+                new_bonuses[commission_id, rule_id] = new
+
+    if dry_run or not (new_fees or new_rates or new_bonuses):
+        return report
+
+    with transaction.atomic():
+        _write(by_id, new_fees, new_rates, new_bonuses, existing, evaluator, batch_size)
+    changed = {change.commission_id for change in report['fee_changes'] + report['bonus_changes']}
+    if changed:
+        invalidate_commission_profiles(list(changed), {by_id[pk].adviser_id for pk in changed})
+    return report
+
+
+def _write(by_id, new_fees, new_rates, new_bonuses, existing, evaluator, batch_size):
+    keys = {pk: rollup_key(row._asdict()) for pk, row in by_id.items()}
+
+    Commission.objects.bulk_update(
+        [
+            Commission(pk=pk, adviser_fee_amount=new_fees.get(pk, by_id[pk].adviser_fee_amount),
+                       adviser_fee_percentage=by_id[pk].adviser_fee_percentage)
+            for pk in new_fees.keys() | new_rates.keys()
+        ],
+        ['adviser_fee_amount', 'adviser_fee_percentage'],
+        batch_size=batch_size,
+    )
+    # bulk_update не вызывает сигналы: разницу вознаграждений вносим в итоги сами
+    deltas = RollupDeltas()
+    for pk, fee in new_fees.items():
+        deltas.add_modifier(keys[pk], 'fee_total', fee - by_id[pk].adviser_fee_amount)
+    deltas.apply()
+
+    rules = {rule.id: rule for rule in evaluator.rules}
+    bonuses = [
+        Bonus(
+            commission_id=commission_id,
+            rule_id=rule_id,
+            amount=amount,
+            reason=f"Rule: {rules[rule_id].name}",
+            kpi_type=rules[rule_id].rule_type,
+            kpi_achieved=True,
+        )
+        for (commission_id, rule_id), amount in new_bonuses.items()
+        if amount is not None
+    ]
+    write_rule_bonuses(
+        bonuses,
+        previous={key: existing[key][1] for key in new_bonuses if key in existing},
+        stale=[existing[key][0] for key, amount in new_bonuses.items() if amount is None],
+        keys=keys,
+        batch_size=batch_size,
+    )
@@ -0,0 +1,14 @@
+"""
+Инициализация рабочих процессов пула пакетного пересчета (recalculation.py).
+
+Модуль не импортирует модели на уровне модуля: при запуске пула через spawn
+(Windows, macOS) дочерний процесс импортирует его до настройки Django.
+"""
+import django
+
+
+def init_recalculation_worker(*initargs):
+    """Настраивает Django в дочернем процессе и компилирует в нем правила."""
+    django.setup()
+    from .recalculation import _init_worker
+    _init_worker(*initargs)
@@ -0,0 +1,353 @@
+"""
+Дневные итоги по комиссиям консультантов (CommissionDailyRollup).
+
+Итоги ведутся по ключу (консультант, день, тип комиссии, статус выплаты)
+и обновляются инкрементально: при сохранении или удалении комиссии либо
+модификатора к строке итогов прибавляется разница между новым и прежним
+состоянием. Статистические эндпоинты читают итоги вместо агрегации
+по всей таблице Commission.
+
+Вместе с дневными итогами RollupDeltas ведет месячные продажи консультантов
+(AdviserMonthlySales); счетчики достижений по ним пересчитываются после
+коммита задачей record_sales_task (achievements_engine.py).
+
+Массовые операции (bulk_create/bulk_update) сигналов не вызывают,
+поэтому такие места сами собирают RollupDeltas и применяют их.
+Полный пересчет и сверка — rebuild_rollups() и check_rollups(),
+для месячных продаж — rebuild_monthly_sales() и check_monthly_sales().
+"""
+import logging
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import TruncMonth
+
+from backend.apps.advisers.hierarchy import descendant_ids_subquery
+from .models import (
+    AdviserMonthlySales, Bonus, Clawback, Commission, CommissionDailyRollup, Override, ReferralFee, Retention,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Поля комиссии, образующие ключ строки итогов
+COMMISSION_KEY_FIELDS = ('adviser_id', 'date_received', 'commission_type', 'payment_status')
+ROLLUP_KEY_FIELDS = ('adviser_id', 'day', 'commission_type', 'payment_status')
+
+# Поле комиссии -> поле итогов
+COMMISSION_TOTAL_FIELDS = {
+    'gross_commission': 'gross_total',
+    'net_commission': 'net_total',
+    'adviser_fee_amount': 'fee_total',
+}
+COMMISSION_ROLLUP_FIELDS = COMMISSION_KEY_FIELDS + tuple(COMMISSION_TOTAL_FIELDS)
+
+# Модель модификатора -> поле итогов с суммой его amount
+MODIFIER_TOTAL_FIELDS = {
+    Retention: 'retention_total',
+    Clawback: 'clawback_total',
+    Bonus: 'bonus_total',
+    Override: 'override_total',
+    ReferralFee: 'referral_fee_total',
+}
+
+TOTAL_FIELDS = ('commission_count', *COMMISSION_TOTAL_FIELDS.values(), *MODIFIER_TOTAL_FIELDS.values())
+
+MONTHLY_SALES_FIELDS = ('commission_count', 'net_total')
+
+CENT = Decimal('0.01')
+
+
+def _amount(value):
+    """Сумма в том виде, в котором она хранится в DecimalField(decimal_places=2)."""
+    return Decimal(str(value or 0)).quantize(CENT)
+
+
+def rollup_key(values):
+    """Ключ итогов по словарю полей комиссии (см. COMMISSION_KEY_FIELDS)."""
+    date_received = Commission._meta.get_field('date_received').to_python(values['date_received'])
+    return values['adviser_id'], date_received, values['commission_type'], values['payment_status']
+
+
+def month_key(adviser_id, day):
+    """Ключ месячных продаж: (консультант, первый день месяца)."""
+    return adviser_id, day.replace(day=1)
+
+
+def commission_rollup_values(commission):
+    """Значения полей комиссии, влияющих на итоги."""
+    return {field: getattr(commission, field) for field in COMMISSION_ROLLUP_FIELDS}
+
+
+def modifier_totals(commission_ids):
+    """Возвращает {commission_id: {поле итогов: сумма модификаторов}}, по запросу на тип модификатора."""
+    totals = defaultdict(dict)
+    for model, total_field in MODIFIER_TOTAL_FIELDS.items():
+        rows = model.objects.filter(commission_id__in=commission_ids).values('commission_id').annotate(
+            total=Sum('amount')
+        ).order_by()
+        for row in rows:
+            totals[row['commission_id']][total_field] = row['total']
+    return totals
+
+
+class RollupDeltas:
+    """Накапливает изменения итогов по ключам и применяет их одним UPDATE на ключ."""
+
+    def __init__(self):
+        self._deltas = defaultdict(lambda: defaultdict(Decimal))
+        self._monthly = defaultdict(lambda: defaultdict(Decimal))
+
+    def add_commission(self, values, sign=1):
+        """Учитывает комиссию (sign=1) или снимает ее прежнее состояние (sign=-1)."""
+        key = rollup_key(values)
+        delta = self._deltas[key]
+        delta['commission_count'] += sign
+        for field, total_field in COMMISSION_TOTAL_FIELDS.items():
+            delta[total_field] += sign * _amount(values[field])
+        # Продажами консультанта считаются только прямые комиссии
+        if values['commission_type'] == Commission.CommissionType.DIRECT:
+            monthly = self._monthly[month_key(values['adviser_id'], key[1])]
+            monthly['commission_count'] += sign
+            monthly['net_total'] += sign * _amount(values['net_commission'])
+
+    def add_modifier(self, key, total_field, amount, sign=1):
+        self._deltas[key][total_field] += sign * _amount(amount)
+
+    def move_modifiers(self, moves):
+        """
+        Переносит суммы модификаторов комиссий, у которых изменился ключ.
+        `moves` — {commission_id: (прежний ключ, новый ключ)}.
+        """
+        if not moves:
+            return
+        for commission_id, totals in modifier_totals(list(moves)).items():
+            old_key, new_key = moves[commission_id]
+            for total_field, amount in totals.items():
+                self.add_modifier(old_key, total_field, amount, sign=-1)
+                self.add_modifier(new_key, total_field, amount)
+
+    def apply(self):
+        for key, delta in self._deltas.items():
+            _apply_delta(CommissionDailyRollup, dict(zip(ROLLUP_KEY_FIELDS, key)), delta)
+
+        sellers = set()
+        for (adviser_id, month), delta in self._monthly.items():
+            _apply_delta(AdviserMonthlySales, {'adviser_id': adviser_id, 'month': month}, delta)
+            if any(delta.values()):
+                sellers.add(adviser_id)
+        if sellers:
+            # Счетчики и значки — вне пути сохранения, одной задачей на пачку после коммита
+            adviser_ids = sorted(sellers)
+            transaction.on_commit(lambda: dispatch_record_sales(adviser_ids))
+
+        self._deltas.clear()
+        self._monthly.clear()
+
+
+def dispatch_record_sales(adviser_ids):
+    """
+    Ставит задачу пересчета счетчиков достижений. Вызывается после коммита:
+    недоступный брокер не должен превращать уже сохраненную комиссию в ошибку,
+    а счетчики восстанавливаются командой rebuild_monthly_sales.
+    """
+    from .tasks import record_sales_task
+    try:
+        record_sales_task.delay(adviser_ids)
+    except Exception:
+        logger.exception(f"Не удалось поставить пересчет счетчиков достижений консультантов {adviser_ids}")
+
+
+def _apply_delta(model, lookup, delta):
+    """
+    Прибавляет изменения к строке итогов одним UPDATE, создавая строку при необходимости.
+    Возвращает True, если строка была создана.
+    """
+    delta = {field: value for field, value in delta.items() if value}
+    if not delta:
+        return False
+    changes = {field: F(field) + value for field, value in delta.items()}
+    if model.objects.filter(**lookup).update(**changes):
+        return False
+    # Строка итогов появляется только вместе с первой комиссией ключа;
+    # отрицательные изменения без строки (например, каскадное удаление
+    # консультанта вместе с итогами) пропускаются.
+    if delta.get('commission_count', 0) <= 0:
+        return False
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **delta)
+    except IntegrityError:
+        # Строку успела создать параллельная транзакция
+        model.objects.filter(**lookup).update(**changes)
+    return True
+
+
+# --- Полный пересчет и сверка ---
+
+def compute_rollups():
+    """Считает итоги по исходным таблицам: {ключ: {поле итогов: значение}}."""
+    rollups = defaultdict(lambda: dict.fromkeys(TOTAL_FIELDS, 0))
+    commission_rows = Commission.objects.values(*COMMISSION_KEY_FIELDS).annotate(
+        commission_count=Count('id'),
+        **{total_field: Sum(field) for field, total_field in COMMISSION_TOTAL_FIELDS.items()},
+    ).order_by()
+    for row in commission_rows:
+        totals = rollups[rollup_key(row)]
+        for field in ('commission_count', *COMMISSION_TOTAL_FIELDS.values()):
+            totals[field] = row[field]
+
+    key_lookups = [f'commission__{field}' for field in COMMISSION_KEY_FIELDS]
+    for model, total_field in MODIFIER_TOTAL_FIELDS.items():
+        for row in model.objects.values(*key_lookups).annotate(total=Sum('amount')).order_by():
+            key = rollup_key({field: row[lookup] for field, lookup in zip(COMMISSION_KEY_FIELDS, key_lookups)})
+            rollups[key][total_field] = row['total']
+    return rollups
+
+
+@transaction.atomic
+def rebuild_rollups(batch_size=1000):
+    """Полностью пересобирает таблицу итогов. Возвращает количество строк."""
+    rollups = compute_rollups()
+    CommissionDailyRollup.objects.all().delete()
+    created = CommissionDailyRollup.objects.bulk_create(
+        [CommissionDailyRollup(**dict(zip(ROLLUP_KEY_FIELDS, key)), **totals) for key, totals in rollups.items()],
+        batch_size=batch_size,
+    )
+    return len(created)
+
+
+def check_rollups():
+    """
+    Сверяет таблицу итогов с исходными данными.
+    Возвращает список расхождений [(ключ, ожидаемые итоги, фактические итоги)].
+    """
+    expected = compute_rollups()
+    actual = {
+        tuple(row[field] for field in ROLLUP_KEY_FIELDS): {field: row[field] for field in TOTAL_FIELDS}
+        for row in CommissionDailyRollup.objects.values(*ROLLUP_KEY_FIELDS, *TOTAL_FIELDS)
+    }
+    empty = dict.fromkeys(TOTAL_FIELDS, 0)
+    mismatches = []
+    for key in expected.keys() | actual.keys():
+        expected_totals = expected.get(key, empty)
+        actual_totals = actual.get(key, empty)
+        if any(_amount(expected_totals[field]) != _amount(actual_totals[field]) for field in TOTAL_FIELDS):
+            mismatches.append((key, expected_totals, actual_totals))
+    return mismatches
+
+
+def compute_monthly_sales(since=None):
+    """Считает месячные продажи по таблице Commission: {(консультант, месяц): {поле: значение}}."""
+    commissions = Commission.objects.filter(commission_type=Commission.CommissionType.DIRECT)
+    if since:
+        commissions = commissions.filter(date_received__gte=since.replace(day=1))
+    rows = commissions.annotate(month=TruncMonth('date_received')).values('adviser_id', 'month').annotate(
+        commission_count=Count('id'), net_total=Sum('net_commission'),
+    ).order_by()
+    return {
+        month_key(row['adviser_id'], row['month']): {field: row[field] for field in MONTHLY_SALES_FIELDS}
+        for row in rows
+    }
+
+
+@transaction.atomic
+def rebuild_monthly_sales(since=None, batch_size=1000):
+    """
+    Пересобирает месячные продажи — все или начиная с месяца даты `since`.
+    Возвращает количество строк.
+    """
+    sales = compute_monthly_sales(since)
+    existing = AdviserMonthlySales.objects.all()
+    if since:
+        existing = existing.filter(month__gte=since.replace(day=1))
+    existing.delete()
+    created = AdviserMonthlySales.objects.bulk_create(
+        [
+            AdviserMonthlySales(adviser_id=adviser_id, month=month, **totals)
+            for (adviser_id, month), totals in sales.items()
+        ],
+        batch_size=batch_size,
+    )
+    return len(created)
+
+
+def check_monthly_sales(since=None):
+    """Сверяет месячные продажи с таблицей Commission. Возвращает список расхождений, как check_rollups()."""
+    expected = compute_monthly_sales(since)
+    actual_rows = AdviserMonthlySales.objects.all()
+    if since:
+        actual_rows = actual_rows.filter(month__gte=since.replace(day=1))
+    actual = {
+        (row['adviser_id'], row['month']): {field: row[field] for field in MONTHLY_SALES_FIELDS}
+        for row in actual_rows.values('adviser_id', 'month', *MONTHLY_SALES_FIELDS)
+    }
+    empty = dict.fromkeys(MONTHLY_SALES_FIELDS, 0)
+    mismatches = []
+    for key in expected.keys() | actual.keys():
+        expected_totals = expected.get(key, empty)
+        actual_totals = actual.get(key, empty)
+        if any(_amount(expected_totals[field]) != _amount(actual_totals[field]) for field in MONTHLY_SALES_FIELDS):
+            mismatches.append((key, expected_totals, actual_totals))
+    return mismatches
+
+
+# --- Чтение итогов в рамках доступа пользователя ---
+
+def get_visible_rollups(user):
+    """
+    Возвращает (итоги, комиссии вне итогов) в рамках доступа пользователя,
+    с той же видимостью, что и get_commissions_for_user.
+
+    Итоги ведутся по консультанту комиссии, поэтому поддерево берется из них,
+    а комиссии чужих консультантов, по которым пользователь получает оверрайд
+    (после переноса поддерева), досчитываются по таблице Commission.
+    """
+    rollups = CommissionDailyRollup.objects.filter(commission_count__gt=0)
+    if user.is_staff:
+        return rollups, Commission.objects.none()
+
+    if hasattr(user, 'adviser_profile'):
+        user_adviser = user.adviser_profile
+        subtree = descendant_ids_subquery(user_adviser)
+        extra = Commission.objects.filter(
+            Q(id__in=Override.objects.filter(recipient=user_adviser).values('commission_id'))
+            & ~Q(adviser_id__in=subtree)
+        )
+        return rollups.filter(adviser_id__in=subtree), extra
+
+    return rollups.none(), Commission.objects.none()
+
+
+def get_commission_statistics(user):
+    """Сумма чистых комиссий, вознаграждений и количество комиссий, доступных пользователю."""
+    rollups, extra = get_visible_rollups(user)
+    stats = rollups.aggregate(
+        total_net_commission=Sum('net_total'),
+        total_adviser_payout=Sum('fee_total'),
+        transaction_count=Sum('commission_count'),
+    )
+    extra_stats = extra.aggregate(
+        total_net_commission=Sum('net_commission'),
+        total_adviser_payout=Sum('adviser_fee_amount'),
+        transaction_count=Count('id'),
+    )
+    return {field: (stats[field] or 0) + (extra_stats[field] or 0) for field in stats}
+
+
+def get_top_performers(user, limit=10):
+    """Консультанты с наибольшей суммой вознаграждения в рамках доступа пользователя."""
+    rollups, extra = get_visible_rollups(user)
+    name_fields = ('adviser__user__first_name', 'adviser__user__last_name')
+    top_performers = rollups.values(*name_fields).annotate(total_fees=Sum('fee_total')).order_by('-total_fees')
+    extra_rows = list(extra.values(*name_fields).annotate(total_fees=Sum('adviser_fee_amount')).order_by())
+    if not extra_rows:
+        return list(top_performers[:limit])
+
+    totals = defaultdict(Decimal)
+    for row in [*top_performers, *extra_rows]:
+        totals[tuple(row[field] for field in name_fields)] += row['total_fees']
+    rows = [dict(zip(name_fields, names), total_fees=total) for names, total in totals.items()]
+    return sorted(rows, key=lambda row: row['total_fees'], reverse=True)[:limit]
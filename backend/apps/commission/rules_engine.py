@@ -1,125 +1,291 @@
+"""
+Движок правил начисления бонусов.
+
+Правила хранятся в БД (CommissionRuleSet / CommissionRule) и компилируются
+в RuleEvaluator — набор готовых проверок, которым не нужны обращения к БД
+за самими правилами. Скомпилированный вычислитель живет в памяти процесса,
+а его актуальность определяется версией правил в общем кэше: любое изменение
+правил (signals.py) меняет версию, и каждый процесс перекомпилирует
+правила при следующем обращении.
+
+apply_rules() применяет все правила к пачке комиссий за один проход
+и записывает бонусы одним bulk upsert по (commission, rule).
+"""
+import uuid
+from bisect import bisect_right
+from collections import defaultdict, namedtuple
 from decimal import Decimal
-from django.db.models import Sum
-from django.utils import timezone
-from .models import Deal, Commission, CommissionBonus
 
-# Определяем константы для KPI
-PERFORMANCE_KPI_THRESHOLD = Decimal('20000.00')  # Порог продаж в месяц
-PERFORMANCE_BONUS_RATE = Decimal('0.05')       # 5% бонус от базовой комиссии
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Prefetch, Sum
+
+from backend.apps.products.models import Product
+from .models import Bonus, Commission, CommissionDailyRollup, CommissionRule, CommissionRuleSet
+from .profile import invalidate_commission_profiles
+from .rollups import RollupDeltas, commission_rollup_values, rollup_key
+
+
+RULES_VERSION_KEY = 'commission:rules:version'
+
+CENT = Decimal('0.01')
+
+# Скомпилированное правило: условие получает (комиссию, контекст пачки)
+CompiledRule = namedtuple('CompiledRule', ['id', 'name', 'rule_type', 'rate', 'valid_from', 'valid_to', 'condition'])
+
+# Поля CommissionRule, из которых компилируется правило
+RULE_DEFINITION_FIELDS = ('id', 'name', 'rule_type', 'rate', 'threshold', 'categories')
+
+_compiled = {'version': None, 'evaluator': None}
+
+
+def _rules_version():
+    version = cache.get(RULES_VERSION_KEY)
+    if version is None:
+        cache.add(RULES_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(RULES_VERSION_KEY)
+    return version
+
 
-# Определяем константы для продуктовых модификаторов
-PRODUCT_MODIFIER_CATEGORIES = ['Инвестиции']     # Категории для бонуса
-PRODUCT_MODIFIER_BONUS_RATE = Decimal('0.02')  # 2% дополнительный бонус
+def invalidate_rules():
+    """Помечает скомпилированные правила устаревшими во всех процессах."""
+    cache.set(RULES_VERSION_KEY, uuid.uuid4().hex, timeout=None)
 
-def calculate_commission_amount(deal: Deal) -> Decimal:
+
+def _compile_condition(rule):
+    if rule['rule_type'] == CommissionRule.RuleType.PRODUCT_CATEGORY:
+        categories = frozenset(rule['categories'] or [])
+        return lambda commission, context: context.category_names.get(commission.product_id) in categories
+
+    threshold = rule['threshold'] if rule['threshold'] is not None else Decimal('0')
+    if rule['rule_type'] == CommissionRule.RuleType.PERFORMANCE:
+        return lambda commission, context: context.monthly_sales(commission) >= threshold
+    if rule['rule_type'] == CommissionRule.RuleType.NET_THRESHOLD:
+        return lambda commission, context: commission.net_commission >= threshold
+    raise ValueError(f"Неизвестный тип правила: {rule['rule_type']}")
+
+
+def load_category_names(product_ids):
+    """{product_id: название категории}."""
+    return dict(Product.objects.filter(id__in=product_ids).values_list('id', 'category__name'))
+
+
+def load_daily_sales(adviser_ids, date_from, date_to):
     """
-    Основной движок расчета комиссий.
-    Рассчитывает базовую комиссию и триггерит расчет всех бонусов.
+    Продажи консультантов по дням с начала месяца `date_from` по `date_to`:
+    {adviser_id: [(день, сумма net_commission), ...]} в порядке дат.
+    Продажи — прямые комиссии любого статуса, как в AdviserMonthlySales; читаются
+    из дневных итогов (CommissionDailyRollup) — строка на консультанта и день
+    вместо строки на комиссию.
     """
-    # TODO: Сделать этот движок более сложным, учитывая правила из CommissionRuleSet
+    daily_sales = defaultdict(list)
+    rows = CommissionDailyRollup.objects.filter(
+        adviser_id__in=adviser_ids,
+        commission_type=Commission.CommissionType.DIRECT,
+        day__gte=date_from.replace(day=1),
+        day__lte=date_to,
+    ).values('adviser_id', 'day').annotate(total=Sum('net_total')).order_by('day')
+    for row in rows:
+        daily_sales[row['adviser_id']].append((row['day'], row['total']))
+    return daily_sales
 
-    base_commission = deal.base_amount * (deal.commission_rate / Decimal('100.0'))
 
-    # Пример расширения: бонус для VIP-клиентов (включается в основную комиссию)
-    vip_bonus = Decimal('0')
-    if deal.client and deal.client.is_vip:
-        vip_bonus = base_commission * Decimal('0.1')  # +10% для VIP
+class EvaluationContext:
+    """
+    Данные, нужные условиям правил: категории продуктов и продажи консультантов
+    по дням. Либо загружаются для пачки комиссий (load), либо передаются готовыми
+    (например, в рабочий процесс пакетного пересчета).
+    """
 
-    direct_commission = base_commission + vip_bonus
+    def __init__(self, category_names=None, daily_sales=None):
+        self.category_names = category_names or {}
+        # Продажи с начала месяца на каждый день с продажами: {adviser_id: ([дни], [итог на день])}
+        self._month_to_date = {}
+        for adviser_id, days in (daily_sales or {}).items():
+            running, totals = Decimal('0'), []
+            for i, (day, total) in enumerate(days):
+                if i and (day.year, day.month) != (days[i - 1][0].year, days[i - 1][0].month):
+                    running = Decimal('0')
+                running += total
+                totals.append(running)
+            self._month_to_date[adviser_id] = ([day for day, _ in days], totals)
 
-    # Сохраняем или обновляем основную, прямую комиссию
-    commission, created = Commission.objects.update_or_create(
-        deal=deal,
-        defaults={
-            'user': deal.user,
-            'amount': direct_commission,
-            'status': Commission.Status.PENDING,  # Ожидает подтверждения
-        }
-    )
+    @classmethod
+    def load(cls, commissions, rule_types):
+        """Загружает данные пачки одним запросом на вид данных и только если их использует хоть одно правило."""
+        category_names, daily_sales = {}, {}
+        if CommissionRule.RuleType.PRODUCT_CATEGORY in rule_types:
+            category_names = load_category_names({c.product_id for c in commissions})
+        if CommissionRule.RuleType.PERFORMANCE in rule_types and commissions:
+            dates = [c.date_received for c in commissions]
+            daily_sales = load_daily_sales({c.adviser_id for c in commissions}, min(dates), max(dates))
+        return cls(category_names, daily_sales)
 
-    # --- РАСЧЕТ И СОЗДАНИЕ ОТДЕЛЬНЫХ БОНУСОВ ---
-    # 1. Бонус руководителю
-    _calculate_hierarchical_bonus(deal, base_commission)
-    # 2. Бонус за производительность
-    _calculate_performance_bonus(deal, base_commission)
-    # 3. Бонус за категорию продукта
-    _calculate_product_modifier_bonus(deal, base_commission)
+    def monthly_sales(self, commission):
+        """Продажи консультанта с начала месяца по дату комиссии включительно (двоичный поиск по дням)."""
+        days, totals = self._month_to_date.get(commission.adviser_id, ((), ()))
+        index = bisect_right(days, commission.date_received) - 1
+        if index < 0 or days[index] < commission.date_received.replace(day=1):
+            return Decimal('0')
+        return totals[index]
 
-    return direct_commission
 
-
-def _calculate_hierarchical_bonus(deal: Deal, base_commission_amount: Decimal):
+class RuleEvaluator:
     """
-    Начисляет бонус руководителю сотрудника, закрывшего сделку.
+    Набор скомпилированных правил. Собирается из определений правил —
+    словарей с простыми значениями (см. RULE_DEFINITION_FIELDS), поэтому
+    определения можно передать в другой процесс и скомпилировать там без БД.
     """
-    if not deal.user:
-        return
-
-    manager = deal.user.get_parent()
-    if manager:
-        bonus_rate = Decimal('0.10')  # 10% бонус для руководителя
-        bonus_amount = base_commission_amount * bonus_rate
-
-        CommissionBonus.objects.update_or_create(
-            deal=deal,
-            user=manager,
-            bonus_type='hierarchical',
-            defaults={
-                'bonus_amount': bonus_amount,
-                'qualified': True,
-            }
+
+    def __init__(self, definitions, has_rule_bonuses=True):
+        self.definitions = definitions
+        self.rules = [
+            CompiledRule(
+                rule['id'], rule['name'], rule['rule_type'], rule['rate'],
+                rule['valid_from'], rule['valid_to'], _compile_condition(rule),
+            )
+            for rule in definitions
+        ]
+        self.rule_types = {rule.rule_type for rule in self.rules}
+        # Без правил делать нечего, пока не осталось бонусов от отключенных правил
+        self.is_noop = not self.rules and not has_rule_bonuses
+
+    @classmethod
+    def compile(cls):
+        rule_sets = CommissionRuleSet.objects.filter(is_active=True).prefetch_related(
+            Prefetch('rules', queryset=CommissionRule.objects.filter(is_active=True).order_by('id'))
         )
+        definitions = [
+            {
+                **{field: getattr(rule, field) for field in RULE_DEFINITION_FIELDS},
+                'valid_from': rule_set.valid_from,
+                'valid_to': rule_set.valid_to,
+            }
+            for rule_set in rule_sets
+            for rule in rule_set.rules.all()
+        ]
+        has_rule_bonuses = bool(definitions) or Bonus.objects.filter(rule__isnull=False).exists()
+        return cls(definitions, has_rule_bonuses=has_rule_bonuses)
+
+    def matches(self, commission, context):
+        """Сработавшие для комиссии правила: пары (правило, сумма бонуса)."""
+        fee = Decimal(commission.adviser_fee_amount).quantize(CENT)
+        for rule in self.rules:
+            if rule.valid_from and commission.date_received < rule.valid_from:
+                continue
+            if rule.valid_to and commission.date_received > rule.valid_to:
+                continue
+            if rule.condition(commission, context):
+                yield rule, (fee * rule.rate).quantize(CENT)
+
+    def evaluate(self, commissions):
+        """Возвращает несохраненные бонусы для всех комиссий за один проход по правилам."""
+        if not self.rules:
+            return []
+        context = EvaluationContext.load(commissions, self.rule_types)
+        return [
+            Bonus(
+                commission=commission,
+                rule_id=rule.id,
+                amount=amount,
+                reason=f"Rule: {rule.name}",
+                kpi_type=rule.rule_type,
+                kpi_achieved=True,
+            )
+            for commission in commissions
+            for rule, amount in self.matches(commission, context)
+        ]
+
 
-def _calculate_performance_bonus(deal: Deal, base_commission_amount: Decimal):
+def _normalize(commission):
+    """Приводит поля, заданные строками (например, в objects.create), к типам модели."""
+    for field_name in ('date_received', 'net_commission', 'adviser_fee_amount'):
+        field = Commission._meta.get_field(field_name)
+        setattr(commission, field_name, field.to_python(getattr(commission, field_name)))
+    return commission
+
+
+def get_evaluator():
+    """Скомпилированные правила текущей версии (перекомпилируются при изменении правил)."""
+    version = _rules_version()
+    if _compiled['version'] != version:
+        _compiled['evaluator'] = RuleEvaluator.compile()
+        _compiled['version'] = version
+    return _compiled['evaluator']
+
+
+def apply_rules(commissions, batch_size=1000):
     """
-    Начисляет бонус за производительность, если сотрудник выполнил KPI по продажам за месяц.
+    Применяет правила к комиссиям и синхронизирует их бонусы:
+    начисленные создаются или обновляются одним bulk upsert,
+    бонусы правил, условия которых больше не выполняются, удаляются.
+    Возвращает список начисленных бонусов.
     """
-    user = deal.user
-    if not user:
-        return
-
-    # Получаем начало и конец текущего месяца для сделки
-    deal_date = deal.created_at.date() if deal.created_at else timezone.now().date()
-    start_of_month = deal_date.replace(day=1)
-
-    # Считаем сумму всех сделок пользователя за этот месяц (включая текущую)
-    monthly_sales = Deal.objects.filter(
-        user=user,
-        created_at__date__gte=start_of_month,
-        created_at__date__lte=deal_date
-    ).exclude(pk=deal.pk).aggregate(total=Sum('base_amount'))['total'] or Decimal('0')
-
-    # Проверяем, выполнен ли KPI с учетом текущей сделки
-    if (monthly_sales + deal.base_amount) >= PERFORMANCE_KPI_THRESHOLD:
-        bonus_amount = base_commission_amount * PERFORMANCE_BONUS_RATE
-
-        CommissionBonus.objects.update_or_create(
-            deal=deal,
-            user=user,  # Бонус начисляется самому сотруднику
-            bonus_type='performance',
-            defaults={
-                'bonus_amount': bonus_amount,
-                'qualified': True,
-            }
+    evaluator = get_evaluator()
+    if evaluator.is_noop:
+        return []
+    commissions = [_normalize(commission) for commission in commissions if commission.pk]
+    bonuses = evaluator.evaluate(commissions)
+    by_id = {commission.pk: commission for commission in commissions}
+    with transaction.atomic():
+        existing = existing_rule_bonuses(by_id)
+        new_keys = {(bonus.commission_id, bonus.rule_id) for bonus in bonuses}
+        stale = [pk for key, (pk, _) in existing.items() if key not in new_keys]
+        write_rule_bonuses(
+            bonuses,
+            previous={key: amount for key, (_, amount) in existing.items() if key in new_keys},
+            stale=stale,
+            keys={pk: rollup_key(commission_rollup_values(commission)) for pk, commission in by_id.items()},
+            batch_size=batch_size,
         )
+    if bonuses or stale:
+        invalidate_commission_profiles(list(by_id), {commission.adviser_id for commission in commissions})
+    return bonuses
+
 
-def _calculate_product_modifier_bonus(deal: Deal, base_commission_amount: Decimal):
+def existing_rule_bonuses(commission_ids):
+    """Бонусы правил комиссий: {(commission_id, rule_id): (pk бонуса, сумма)}."""
+    return {
+        (commission_id, rule_id): (pk, amount)
+        for pk, commission_id, rule_id, amount in Bonus.objects.filter(
+            commission_id__in=commission_ids, rule__isnull=False
+        ).values_list('pk', 'commission_id', 'rule_id', 'amount')
+    }
+
+
+def write_rule_bonuses(bonuses, previous, stale, keys, batch_size=1000):
     """
-    Начисляет бонус за продажу продукта из приоритетной категории.
+    Записывает бонусы правил одним bulk upsert по (commission, rule) и удаляет устаревшие.
+    `previous` — {(commission_id, rule_id): прежняя сумма} для уже существующих бонусов,
+    `stale` — pk удаляемых бонусов, `keys` — {commission_id: ключ дневных итогов}.
     """
-    product = deal.product
-    if not product or not product.category:
-        return
-
-    if product.category.name in PRODUCT_MODIFIER_CATEGORIES:
-        bonus_amount = base_commission_amount * PRODUCT_MODIFIER_BONUS_RATE
-
-        CommissionBonus.objects.update_or_create(
-            deal=deal,
-            user=deal.user, # Бонус начисляется самому сотруднику
-            bonus_type='product_modifier',
-            defaults={
-                'bonus_amount': bonus_amount,
-                'qualified': True,
-            }
-        )
+    Bonus.objects.bulk_create(
+        bonuses,
+        batch_size=batch_size,
+        update_conflicts=True,
+        unique_fields=['commission', 'rule'],
+        update_fields=['amount', 'reason', 'kpi_type', 'kpi_achieved'],
+    )
+
+    # bulk_create не вызывает сигналы: разницу в дневные итоги вносим сами
+    deltas = RollupDeltas()
+    for bonus in bonuses:
+        key = keys[bonus.commission_id]
+        previous_amount = previous.get((bonus.commission_id, bonus.rule_id))
+        if previous_amount is not None:
+            deltas.add_modifier(key, 'bonus_total', previous_amount, sign=-1)
+        deltas.add_modifier(key, 'bonus_total', bonus.amount)
+    deltas.apply()
+
+    # Удаление идет через delete() с сигналами, итоги обновятся там
+    if stale:
+        Bonus.objects.filter(pk__in=stale).delete()
+
+
+def calculate_commission_amount(commission):
+    """
+    Применяет правила к одной комиссии и возвращает прямое вознаграждение консультанта.
+    Бонусы по правилам начисляются отдельными записями Bonus.
+    """
+    apply_rules([commission])
+    return commission.adviser_fee_amount
@@ -1,5 +1,7 @@
+from django.db.models import Count, DecimalField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 from rest_framework import serializers
-from .models import Commission, CommissionModifier, Retention, Clawback, Bonus, Override, ReferralFee, CommissionSplit, Advance, Repayment, VestingSchedule, ScheduledPayout
+from .models import Commission, CommissionModifier, Retention, Clawback, Bonus, Override, ReferralFee, CommissionSplit, Advance, Repayment, AdviserAdvanceBalance, VestingSchedule, ScheduledPayout, PayoutRun, PayoutLine
 from backend.apps.advisers.serializers import AdviserSerializer
 from backend.apps.products.serializers import ProductSerializer
 from backend.apps.policies.serializers import PolicySerializer
@@ -52,7 +54,7 @@ class CommissionSerializer(serializers.ModelSerializer):
     product = ProductSerializer(read_only=True)
     retentions = RetentionSerializer(many=True, read_only=True)
     clawbacks = ClawbackSerializer(many=True, read_only=True)
-    bonuses = BonusSerializer(many=True, read_only=True)
+    bonuses = BonusSerializer(source='bonuss', many=True, read_only=True)
     overrides = OverrideSerializer(many=True, read_only=True)
     referralfees = ReferralFeeSerializer(many=True, read_only=True)
 
@@ -64,6 +66,74 @@ class CommissionSerializer(serializers.ModelSerializer):
             'date_received', 'retentions', 'clawbacks', 'bonuses', 'overrides', 'referralfees'
         )
 
+# Модификаторы, которые в плоском представлении сворачиваются в сумму и количество
+FLAT_MODIFIERS = {
+    'retention': Retention,
+    'clawback': Clawback,
+    'bonus': Bonus,
+    'override': Override,
+    'referral_fee': ReferralFee,
+}
+
+FLAT_COMMISSION_FIELDS = (
+    'id', 'policy__policy_number', 'product__name', 'adviser_id',
+    'adviser__user__first_name', 'adviser__user__last_name',
+    'gross_commission', 'net_commission', 'adviser_fee_percentage', 'adviser_fee_amount',
+    'payment_status', 'date_received',
+)
+
+
+def _modifier_subquery(model, aggregate):
+    subquery = model.objects.filter(commission=OuterRef('pk')).values('commission').annotate(
+        value=aggregate
+    ).values('value')
+    output_field = aggregate.output_field if isinstance(aggregate, Count) else DecimalField(max_digits=14, decimal_places=2)
+    return Coalesce(Subquery(subquery, output_field=output_field), Value(0), output_field=output_field)
+
+
+def flat_commission_values(queryset):
+    """
+    Плоское представление комиссий для CommissionFlatSerializer: values() по связанным
+    полям и подзапросы с суммой и количеством каждого типа модификаторов.
+    Весь список читается одним запросом, независимо от количества строк и модификаторов.
+    """
+    annotations = {}
+    for name, model in FLAT_MODIFIERS.items():
+        annotations[f'{name}_total'] = _modifier_subquery(model, Sum('amount'))
+        annotations[f'{name}_count'] = _modifier_subquery(model, Count('id'))
+    return queryset.prefetch_related(None).values(*FLAT_COMMISSION_FIELDS).annotate(**annotations)
+
+
+class CommissionFlatSerializer(serializers.Serializer):
+    """
+    Облегченное представление комиссии для списков (?view=flat).
+    Работает со словарями из flat_commission_values, без вложенных объектов.
+    """
+    id = serializers.IntegerField()
+    policy_number = serializers.CharField(source='policy__policy_number')
+    product_name = serializers.CharField(source='product__name')
+    adviser_id = serializers.IntegerField()
+    adviser_name = serializers.SerializerMethodField()
+    gross_commission = serializers.DecimalField(max_digits=10, decimal_places=2)
+    net_commission = serializers.DecimalField(max_digits=10, decimal_places=2)
+    adviser_fee_percentage = serializers.DecimalField(max_digits=5, decimal_places=2)
+    adviser_fee_amount = serializers.DecimalField(max_digits=10, decimal_places=2)
+    payment_status = serializers.CharField()
+    date_received = serializers.DateField()
+    retention_total = serializers.DecimalField(max_digits=14, decimal_places=2)
+    retention_count = serializers.IntegerField()
+    clawback_total = serializers.DecimalField(max_digits=14, decimal_places=2)
+    clawback_count = serializers.IntegerField()
+    bonus_total = serializers.DecimalField(max_digits=14, decimal_places=2)
+    bonus_count = serializers.IntegerField()
+    override_total = serializers.DecimalField(max_digits=14, decimal_places=2)
+    override_count = serializers.IntegerField()
+    referral_fee_total = serializers.DecimalField(max_digits=14, decimal_places=2)
+    referral_fee_count = serializers.IntegerField()
+
+    def get_adviser_name(self, obj):
+        return f"{obj['adviser__user__first_name']} {obj['adviser__user__last_name']}".strip()
+
 
 # --- Сериализаторы для новых моделей ---
 class CommissionSplitSerializer(serializers.ModelSerializer):
@@ -75,12 +145,34 @@ class AdvanceSerializer(serializers.ModelSerializer):
     class Meta:
         model = Advance
         fields = '__all__'
+        # Ведутся по погашениям (advances.py)
+        read_only_fields = ('outstanding_balance', 'is_fully_repaid')
 
 class RepaymentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Repayment
         fields = '__all__'
 
+class AdviserAdvanceBalanceSerializer(serializers.ModelSerializer):
+    adviser_name = serializers.SerializerMethodField()
+
+    class Meta:
+        model = AdviserAdvanceBalance
+        fields = ['adviser', 'adviser_name', 'outstanding_balance', 'open_advances']
+
+    def get_adviser_name(self, obj):
+        return obj.adviser.user.get_full_name() or obj.adviser.user.username
+
+class PayoutRunSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PayoutRun
+        fields = '__all__'
+
+class PayoutLineSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PayoutLine
+        fields = '__all__'
+
 class VestingScheduleSerializer(serializers.ModelSerializer):
     class Meta:
         model = VestingSchedule
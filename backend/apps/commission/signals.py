@@ -1,2 +1,217 @@
-# This file is deprecated. Logic has been moved to apps.insurances.signals
+"""
+Инкрементальное обновление дневных итогов (rollups.py) и сброс кэша профилей
+(profile.py) при сохранении и удалении комиссий, модификаторов, авансов и погашений,
+ведение остатков авансов (advances.py), а также сброс скомпилированных правил
+бонусов (rules_engine.py) и определений значков (achievements_engine.py);
+публикация событий о сделках (deal_events.py) и пересчет оверрайдов
+после изменения иерархии (overrides.py).
 
+Логика создания комиссий по полисам перенесена в apps.insurances.signals.
+"""
+import logging
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from backend.apps.advisers.models import Adviser
+from .achievements_engine import invalidate_badges
+from .advances import prepare_advance, record_advance, record_repayment, refresh_adviser_balances
+from .deal_events import publish_deal_events
+from .models import Advance, Badge, Commission, CommissionRule, CommissionRuleSet, Repayment
+from .profile import invalidate_adviser_profiles, invalidate_commission_profiles
+from .rules_engine import invalidate_rules
+from .tasks import rederive_overrides_task
+from .rollups import (
+    COMMISSION_KEY_FIELDS, COMMISSION_ROLLUP_FIELDS, MODIFIER_TOTAL_FIELDS,
+    RollupDeltas, commission_rollup_values, rollup_key,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(pre_save, sender=Commission)
+def remember_commission_rollup_values(sender, instance, **kwargs):
+    """Запоминает прежнее состояние комиссии, чтобы снять его с итогов."""
+    instance._rollup_previous = None
+    if instance.pk is not None:
+        instance._rollup_previous = Commission.objects.filter(pk=instance.pk).values(*COMMISSION_ROLLUP_FIELDS).first()
+
+
+@receiver(post_save, sender=Commission)
+def update_commission_rollup(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    deltas = RollupDeltas()
+    current = commission_rollup_values(instance)
+    previous = getattr(instance, '_rollup_previous', None)
+    if previous:
+        deltas.add_commission(previous, sign=-1)
+        # Смена консультанта, даты или статуса переносит и суммы модификаторов
+        if rollup_key(previous) != rollup_key(current):
+            deltas.move_modifiers({instance.pk: (rollup_key(previous), rollup_key(current))})
+    deltas.add_commission(current)
+    deltas.apply()
+
+    adviser_ids = {instance.adviser_id, previous['adviser_id'] if previous else None}
+    if created:
+        # Оверрайдов еще нет, их получатели — руководители консультанта
+        invalidate_adviser_profiles(adviser_ids)
+    else:
+        invalidate_commission_profiles([instance.pk], adviser_ids)
+
+    # Клиенты websocket узнают о сделке после фиксации транзакции
+    event = 'created' if created else 'updated'
+    transaction.on_commit(lambda: publish_deal_events([instance], event))
+
+
+@receiver(post_delete, sender=Commission)
+def remove_commission_rollup(sender, instance, **kwargs):
+    deltas = RollupDeltas()
+    deltas.add_commission(commission_rollup_values(instance), sign=-1)
+    deltas.apply()
+    # Оверрайды удалены раньше комиссии, их получатели сброшены в remove_modifier_rollup
+    invalidate_adviser_profiles([instance.adviser_id])
+
+
+def _commission_key(commission_id):
+    values = Commission.objects.filter(pk=commission_id).values(*COMMISSION_KEY_FIELDS).first()
+    return rollup_key(values) if values else None
+
+
+def remember_modifier_rollup_values(sender, instance, **kwargs):
+    instance._rollup_previous = None
+    if instance.pk is not None:
+        instance._rollup_previous = sender.objects.filter(pk=instance.pk).values('commission_id', 'amount').first()
+
+
+def update_modifier_rollup(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    total_field = MODIFIER_TOTAL_FIELDS[sender]
+    deltas = RollupDeltas()
+    previous = getattr(instance, '_rollup_previous', None)
+    if previous:
+        if previous['commission_id'] == instance.commission_id:
+            old_key = new_key = _commission_key(instance.commission_id)
+        else:
+            old_key, new_key = _commission_key(previous['commission_id']), _commission_key(instance.commission_id)
+        if old_key:
+            deltas.add_modifier(old_key, total_field, previous['amount'], sign=-1)
+    else:
+        new_key = _commission_key(instance.commission_id)
+    if new_key:
+        deltas.add_modifier(new_key, total_field, instance.amount)
+    deltas.apply()
+
+    commission_ids = {instance.commission_id, previous['commission_id'] if previous else None}
+    invalidate_commission_profiles(commission_ids, {new_key[0] if new_key else None, getattr(instance, 'recipient_id', None)})
+
+
+def remove_modifier_rollup(sender, instance, **kwargs):
+    # При каскадном удалении комиссии модификаторы удаляются раньше нее,
+    # поэтому ключ комиссии еще можно прочитать.
+    key = _commission_key(instance.commission_id)
+    if key:
+        deltas = RollupDeltas()
+        deltas.add_modifier(key, MODIFIER_TOTAL_FIELDS[sender], instance.amount, sign=-1)
+        deltas.apply()
+    invalidate_commission_profiles([instance.commission_id], {key[0] if key else None, getattr(instance, 'recipient_id', None)})
+
+
+for modifier_model in MODIFIER_TOTAL_FIELDS:
+    pre_save.connect(remember_modifier_rollup_values, sender=modifier_model)
+    post_save.connect(update_modifier_rollup, sender=modifier_model)
+    post_delete.connect(remove_modifier_rollup, sender=modifier_model)
+
+
+@receiver(pre_save, sender=Advance)
+def prepare_advance_balance(sender, instance, raw=False, **kwargs):
+    instance._ledger_previous = None if raw else prepare_advance(instance)
+
+
+@receiver(post_save, sender=Advance)
+def update_advance_ledger(sender, instance, raw=False, **kwargs):
+    previous = getattr(instance, '_ledger_previous', None)
+    if not raw:
+        record_advance(instance, previous)
+    # Авансы входят только в финансовую сводку самого консультанта
+    invalidate_adviser_profiles([instance.adviser_id, previous['adviser_id'] if previous else None], with_managers=False)
+
+
+@receiver(post_delete, sender=Advance)
+def remove_advance_ledger(sender, instance, **kwargs):
+    # Погашения удалены каскадно раньше аванса и уже вернули его остаток,
+    # поэтому остаток консультанта пересчитывается по оставшимся авансам
+    refresh_adviser_balances([instance.adviser_id])
+    invalidate_adviser_profiles([instance.adviser_id], with_managers=False)
+
+
+@receiver(pre_save, sender=Repayment)
+def remember_repayment_values(sender, instance, **kwargs):
+    instance._ledger_previous = None
+    if instance.pk is not None:
+        instance._ledger_previous = Repayment.objects.filter(pk=instance.pk).values('advance_id', 'amount').first()
+
+
+@receiver(post_save, sender=Repayment)
+def update_repayment_ledger(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    previous = getattr(instance, '_ledger_previous', None)
+    if previous:
+        record_repayment(previous['advance_id'], -previous['amount'])
+    record_repayment(instance.advance_id, instance.amount)
+    advance_ids = {instance.advance_id, previous['advance_id'] if previous else None}
+    invalidate_adviser_profiles(Advance.objects.filter(pk__in=advance_ids).values_list('adviser_id', flat=True), with_managers=False)
+
+
+@receiver(post_delete, sender=Repayment)
+def remove_repayment_ledger(sender, instance, **kwargs):
+    record_repayment(instance.advance_id, -instance.amount)
+    adviser_id = Advance.objects.filter(pk=instance.advance_id).values_list('adviser_id', flat=True).first()
+    invalidate_adviser_profiles([adviser_id], with_managers=False)
+
+
+@receiver(post_save, sender=Adviser)
+def invalidate_own_profile(sender, instance, **kwargs):
+    # Изменения иерархии меняют версию ключа профиля, здесь — остальные поля профиля
+    invalidate_adviser_profiles([instance.pk], with_managers=False)
+
+
+@receiver(post_save, sender=Adviser)
+def schedule_override_rederivation(sender, instance, created=False, raw=False, **kwargs):
+    # Смена ставки или руководителя (advisers.signals) делает устаревшими оверрайды поддерева
+    if created or raw or not getattr(instance, '_hierarchy_changed', False):
+        return
+    transaction.on_commit(lambda: _dispatch_override_rederivation(instance.pk))
+
+
+def _dispatch_override_rederivation(adviser_id):
+    # Изменение консультанта уже закоммичено: недоступный брокер не должен давать 500,
+    # но пропущенный пересчет нужно видеть, чтобы запустить rederive_overrides вручную
+    try:
+        rederive_overrides_task.delay(adviser_id)
+    except Exception:
+        logger.exception(
+            f"Не удалось поставить пересчет оверрайдов поддерева консультанта {adviser_id}; "
+            f"запустите manage.py rederive_overrides {adviser_id}"
+        )
+
+
+@receiver(post_save, sender=CommissionRuleSet)
+@receiver(post_delete, sender=CommissionRuleSet)
+@receiver(post_save, sender=CommissionRule)
+@receiver(post_delete, sender=CommissionRule)
+def invalidate_compiled_rules(sender, **kwargs):
+    """Сбрасывает правила сразу и повторно после коммита: процесс, прочитавший их до коммита, не закэширует старые."""
+    invalidate_rules()
+    transaction.on_commit(invalidate_rules)
+
+
+@receiver(post_save, sender=Badge)
+@receiver(post_delete, sender=Badge)
+def invalidate_badge_definitions(sender, **kwargs):
+    """Сбрасывает определения значков сразу и повторно после коммита (как invalidate_compiled_rules)."""
+    invalidate_badges()
+    transaction.on_commit(invalidate_badges)
@@ -1,81 +1,149 @@
-from celery import shared_task
-import time
 import logging
-from django.contrib.auth.models import User
-from .models import Deal
+from datetime import timedelta
+
+from celery import chord, group, shared_task
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from backend.apps.commission.achievements_engine import record_sales
+from backend.apps.commission.models import Commission
+from backend.apps.commission.overrides import rederive_overrides
+from backend.apps.commission.payouts import (
+    adviser_partitions, complete_payout_run, compute_payout_partition, fail_payout_run, start_payout_run,
+)
+from backend.apps.commission.recalculation import recalculate_commissions
+from backend.apps.commission.team_reports import send_team_reports
+from backend.apps.commission.vesting import mark_due_payouts
 
 logger = logging.getLogger(__name__)
 
+# Сколько консультантов пересчитывает одна подзадача
+RECALCULATION_ADVISERS_PER_TASK = 200
+
+
 @shared_task
-def notify_deal_creation(deal_id):
+def recalculate_commissions_task(date_from=None, date_to=None, adviser_ids=None, refresh_rates=False, dry_run=False):
     """
-    Имитирует отправку уведомления о новой сделке.
-    В реальном проекте здесь была бы отправка email или push-уведомлений.
+    Пакетный пересчет комиссий за период (recalculation.py).
+    Без adviser_ids задача делит консультантов периода на части и запускает
+    по подзадаче на часть: пулом процессов здесь служат воркеры Celery
+    (процессы prefork-воркера не могут порождать собственный пул).
     """
-    try:
-        deal = Deal.objects.get(id=deal_id)
-        logger.info(f"Обработка уведомления для сделки: {deal.title}")
-
-        # Имитация отправки уведомления
-        time.sleep(3)
-
-        logger.info(f"Уведомление успешно отправлено для сделки {deal.title} "
-                   f"пользователю {deal.user.username}")
-
-        return f"Уведомление для сделки '{deal.title}' отправлено"
-
-    except Deal.DoesNotExist:
-        logger.error(f"Сделка с ID {deal_id} не найдена")
-        return f"Ошибка: сделка с ID {deal_id} не найдена"
-    except Exception as e:
-        logger.error(f"Ошибка при отправке уведомления для сделки {deal_id}: {str(e)}")
-        return f"Ошибка при отправке уведомления: {str(e)}"
-from celery import shared_task
-from django.core.mail import send_mail
-from django.template.loader import render_to_string
-from django.utils import timezone
+    if adviser_ids is None:
+        commissions = Commission.objects.all()
+        if date_from:
+            commissions = commissions.filter(date_received__gte=date_from)
+        if date_to:
+            commissions = commissions.filter(date_received__lte=date_to)
+        ids = list(commissions.order_by('adviser_id').values_list('adviser_id', flat=True).distinct())
+        chunks = [ids[i:i + RECALCULATION_ADVISERS_PER_TASK] for i in range(0, len(ids), RECALCULATION_ADVISERS_PER_TASK)]
+        group(
+            recalculate_commissions_task.s(date_from, date_to, chunk, refresh_rates, dry_run) for chunk in chunks
+        ).apply_async()
+        return f"Запущено подзадач пересчета: {len(chunks)}."
+
+    report = recalculate_commissions(
+        date_from=date_from, date_to=date_to, adviser_ids=adviser_ids,
+        refresh_rates=refresh_rates, dry_run=dry_run,
+    )
+    for change in report['fee_changes']:
+        logger.info(f"Комиссия {change.commission_id}: вознаграждение {change.old} -> {change.new}")
+    for change in report['bonus_changes']:
+        logger.info(f"Комиссия {change.commission_id}: бонус правила {change.rule_id} {change.old} -> {change.new}")
+    return {
+        'commissions': report['commissions'],
+        'rate_changes': report['rate_changes'],
+        'fee_changes': len(report['fee_changes']),
+        'bonus_changes': len(report['bonus_changes']),
+        'dry_run': dry_run,
+    }
+
+@shared_task
+def send_team_commission_reports(manager_ids=None, date_from=None, date_to=None):
+    """
+    Рассылает руководителям отчеты по выплаченным комиссиям команд (team_reports.py)
+    за период, по умолчанию — за прошлый месяц. Все руководители обрабатываются
+    за один запуск, письма пачки идут через одно SMTP-соединение.
+    """
+    today = timezone.now().date()
+    if date_from is None and date_to is None:
+        date_to = today.replace(day=1) - timedelta(days=1)
+        date_from = date_to.replace(day=1)
+    else:
+        date_from, date_to = parse_date(date_from) if date_from else None, parse_date(date_to) if date_to else None
+    sent = send_team_reports(today, manager_ids=manager_ids, date_from=date_from, date_to=date_to)
+    return f"Sent {sent} team commission reports."
 
-from backend.apps.users.models import CustomUser
-from backend.apps.commission.models import Commission
 
 @shared_task
 def generate_and_send_commission_report(manager_id: int):
     """
     Генерирует отчет по комиссиям для команды менеджера и отправляет его на email.
     """
-    try:
-        manager = CustomUser.objects.get(id=manager_id)
-    except CustomUser.DoesNotExist:
-        # TODO: Добавить логирование
-        return f"Manager with id={manager_id} not found."
-
-    if not manager.email:
-        return f"Manager with id={manager_id} has no email."
-
-    team_members = manager.get_descendants(include_self=True)
-
-    # Собираем данные
-    commissions = Commission.objects.filter(user__in=team_members, status=Commission.Status.PAID)
-    total_amount = sum(c.amount for c in commissions)
-
-    context = {
-        'manager_name': manager.get_full_name() or manager.username,
-        'report_date': timezone.now().strftime('%d-%m-%Y'),
-        'commissions': commissions,
-        'total_amount': total_amount,
-    }
+    if not send_team_reports(timezone.now().date(), manager_ids=[manager_id]):
+        return f"Manager with id={manager_id} not found or has no email."
+    return f"Report sent to manager {manager_id} successfully."
+
+
+@shared_task
+def mark_due_scheduled_payouts(as_of=None):
+    """
+    Ежедневно отмечает наступившие выплаты по графикам вестинга (vesting.py)
+    выплаченными — порциями, без загрузки всех запланированных выплат.
+    """
+    marked = mark_due_payouts(parse_date(as_of) if as_of else None)
+    return f"Marked {marked} scheduled payouts as paid."
+
 
-    # Формируем тело письма из шаблона (пока просто строка)
-    # В будущем можно использовать HTML-шаблоны
-    subject = f"Commission Report for your team - {context['report_date']}"
-    message = render_to_string('commission/email/report_template.txt', context)
-
-    send_mail(
-        subject=subject,
-        message=message,
-        from_email='reports@uk-commission-panel.com',
-        recipient_list=[manager.email],
-        fail_silently=False,
+@shared_task
+def run_payouts_task(period_start, period_end, created_by_id=None):
+    """
+    Запуск выплат за период (payouts.py): по подзадаче на часть консультантов,
+    итоги подводятся, когда посчитаны все части. Возвращает id запуска.
+    """
+    run = start_payout_run(parse_date(period_start), parse_date(period_end), created_by_id)
+    chord(
+        (compute_payout_partition_task.s(run.pk, partition) for partition in adviser_partitions()),
+        complete_payout_run_task.si(run.pk),
+    ).on_error(fail_payout_run_task.si(run.pk)).apply_async()
+    return run.pk
+
+
+@shared_task
+def compute_payout_partition_task(run_id, adviser_ids):
+    return compute_payout_partition(run_id, adviser_ids)
+
+
+@shared_task
+def complete_payout_run_task(run_id):
+    run = complete_payout_run(run_id)
+    return f"Payout run {run.pk}: {run.adviser_count} advisers, total {run.total_payable}."
+
+
+@shared_task
+def fail_payout_run_task(run_id):
+    fail_payout_run(run_id)
+
+
+@shared_task
+def rederive_overrides_task(adviser_id, effective_from=None, effective_to=None):
+    """
+    Пересчитывает оверрайды комиссий поддерева консультанта после изменения
+    его ставки или руководителя (overrides.py): частями, с записью только различий.
+    """
+    report = rederive_overrides(
+        adviser_id,
+        effective_from=parse_date(effective_from) if effective_from else None,
+        effective_to=parse_date(effective_to) if effective_to else None,
     )
+    logger.info(f"Оверрайды поддерева консультанта {adviser_id} пересчитаны: {report}")
+    return report
+
 
-    return f"Report sent to {manager.email} successfully."
\ No newline at end of file
+@shared_task
+def record_sales_task(adviser_ids):
+    """
+    Пересчитывает счетчики достижений консультантов после изменения их продаж
+    и присуждает заработанные значки (achievements_engine.py).
+    """
+    return len(record_sales(adviser_ids))
@@ -0,0 +1,142 @@
+"""
+Отчеты руководителям по выплаченным комиссиям их команд.
+
+Итоги команды и разбивка по участникам считаются агрегацией по дневным
+итогам (CommissionDailyRollup) через closure-таблицу иерархии — одним
+запросом на пачку руководителей. Детальные строки не попадают в тело письма:
+они выгружаются итератором в CSV-вложение. Письма пачки отправляются
+через одно SMTP-соединение.
+"""
+import csv
+import io
+from collections import defaultdict
+
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import Q, Sum
+from django.template.loader import render_to_string
+
+from backend.apps.advisers.hierarchy import descendant_ids_subquery
+from backend.apps.advisers.models import Adviser, AdviserHierarchy
+from .models import Commission, CommissionDailyRollup
+
+
+REPORT_FROM_EMAIL = 'reports@uk-commission-panel.com'
+
+# Сколько писем отправляется через одно SMTP-соединение
+REPORT_BATCH_SIZE = 50
+
+CSV_HEADERS = [
+    'policy_number', 'adviser', 'product', 'date_received', 'date_paid_to_adviser',
+    'gross_commission', 'net_commission', 'adviser_fee_amount',
+]
+CSV_FIELDS = [
+    'policy__policy_number', 'adviser__user__username', 'product__name', 'date_received', 'date_paid_to_adviser',
+    'gross_commission', 'net_commission', 'adviser_fee_amount',
+]
+
+
+def get_report_managers(manager_ids=None):
+    """Консультанты с подчиненными и email — получатели отчетов."""
+    managers = Adviser.objects.filter(
+        id__in=AdviserHierarchy.objects.filter(depth__gt=0).values('ancestor_id'),
+    ).exclude(user__email='').select_related('user').order_by('id')
+    if manager_ids is not None:
+        managers = managers.filter(id__in=manager_ids)
+    return managers
+
+
+def _period_filter(prefix, date_from, date_to):
+    conditions = Q()
+    if date_from:
+        conditions &= Q(**{f'{prefix}__gte': date_from})
+    if date_to:
+        conditions &= Q(**{f'{prefix}__lte': date_to})
+    return conditions
+
+
+def team_member_totals(manager_ids, date_from=None, date_to=None):
+    """
+    Выплаченные комиссии участников команд одним запросом:
+    {manager_id: [{'adviser_id', 'name', 'commission_count', 'net_total', 'fee_total'}, ...]}.
+    """
+    rows = CommissionDailyRollup.objects.filter(
+        _period_filter('day', date_from, date_to),
+        payment_status=Commission.PaymentStatus.PAID,
+        commission_count__gt=0,
+        adviser__ancestor_links__ancestor_id__in=manager_ids,
+    ).values(
+        'adviser__ancestor_links__ancestor_id', 'adviser_id',
+        'adviser__user__first_name', 'adviser__user__last_name', 'adviser__user__username',
+    ).annotate(
+        commission_count=Sum('commission_count'), net_total=Sum('net_total'), fee_total=Sum('fee_total'),
+    ).order_by('adviser__ancestor_links__ancestor_id', '-fee_total', 'adviser_id')
+
+    totals = defaultdict(list)
+    for row in rows:
+        name = f"{row['adviser__user__first_name']} {row['adviser__user__last_name']}".strip()
+        totals[row['adviser__ancestor_links__ancestor_id']].append({
+            'adviser_id': row['adviser_id'],
+            'name': name or row['adviser__user__username'],
+            'commission_count': row['commission_count'],
+            'net_total': row['net_total'],
+            'fee_total': row['fee_total'],
+        })
+    return totals
+
+
+def write_team_csv(manager, output, date_from=None, date_to=None):
+    """Пишет детальные строки выплаченных комиссий команды в `output`, не загружая их целиком."""
+    writer = csv.writer(output)
+    writer.writerow(CSV_HEADERS)
+    commissions = Commission.objects.filter(
+        _period_filter('date_received', date_from, date_to),
+        adviser_id__in=descendant_ids_subquery(manager),
+        payment_status=Commission.PaymentStatus.PAID,
+    ).order_by('date_received', 'id').values_list(*CSV_FIELDS)
+    for row in commissions.iterator(chunk_size=2000):
+        writer.writerow(row)
+
+
+def build_report_message(manager, members, report_date, date_from=None, date_to=None, connection=None):
+    """Письмо руководителю: итоги и разбивка в теле, детальные строки — CSV-вложением."""
+    context = {
+        'manager_name': manager.user.get_full_name() or manager.user.username,
+        'report_date': report_date.strftime('%d-%m-%Y'),
+        'date_from': date_from,
+        'date_to': date_to,
+        'members': members,
+        'total_count': sum(member['commission_count'] for member in members),
+        'total_net': sum((member['net_total'] for member in members), 0),
+        'total_amount': sum((member['fee_total'] for member in members), 0),
+    }
+    message = EmailMessage(
+        subject=f"Commission Report for your team - {context['report_date']}",
+        body=render_to_string('commission/email/report_template.txt', context),
+        from_email=REPORT_FROM_EMAIL,
+        to=[manager.user.email],
+        connection=connection,
+    )
+    output = io.StringIO()
+    write_team_csv(manager, output, date_from, date_to)
+    message.attach(f"commission_report_{report_date:%Y-%m-%d}.csv", output.getvalue(), 'text/csv')
+    return message
+
+
+def send_team_reports(report_date, manager_ids=None, date_from=None, date_to=None, batch_size=REPORT_BATCH_SIZE):
+    """
+    Отправляет отчеты всем руководителям (или `manager_ids`) пачками:
+    по одному запросу итогов и одному SMTP-соединению на пачку.
+    Возвращает количество отправленных писем.
+    """
+    managers = list(get_report_managers(manager_ids))
+    sent = 0
+    for start in range(0, len(managers), batch_size):
+        batch = managers[start:start + batch_size]
+        totals = team_member_totals([manager.id for manager in batch], date_from, date_to)
+        with get_connection() as connection:
+            messages = [
+                build_report_message(manager, totals.get(manager.id, []), report_date, date_from, date_to, connection)
+                for manager in batch
+            ]
+            sent += connection.send_messages(messages) or 0
+    return sent
@@ -10,6 +10,7 @@ from rest_framework import status
 from backend.apps.advisers.models import Adviser
 from backend.apps.commission.models import Commission, Advance, Retention
 from backend.apps.policies.models import Policy
+from backend.apps.products.models import Product, ProductCategory
 
 User = get_user_model()
 
@@ -58,6 +59,8 @@ class IngestionCommandTest(TestCase):
             fee_percentage=Decimal('80.00'),
             start_date='2023-01-01'
         )
+        category = ProductCategory.objects.create(name='Test Category')
+        Product.objects.create(name='Test Product', category=category)
 
     @patch("builtins.open")
     def test_ingestion_command_creates_objects(self, mock_open):
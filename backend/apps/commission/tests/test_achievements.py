@@ -0,0 +1,139 @@
+from datetime import date
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+
+from backend.apps.advisers.models import Adviser
+from backend.apps.commission.achievements_engine import (
+    award_achievements, check_for_new_achievements, month_streaks, rebuild_counters,
+)
+from backend.apps.commission.models import Achievement, AdviserAchievementCounters, Badge, Commission
+from backend.apps.commission.tasks import record_sales_task
+from backend.apps.policies.models import Policy
+from backend.apps.products.models import Product, ProductCategory
+
+User = get_user_model()
+
+
+class AchievementTests(TestCase):
+
+    def setUp(self):
+        # Версия значков в кэше переживает откат транзакции теста
+        cache.clear()
+        # Счетчики и значки пересчитывает задача после коммита
+        conf = record_sales_task.app.conf
+        conf.task_always_eager = True
+        self.addCleanup(setattr, conf, 'task_always_eager', False)
+        self.advisers = []
+        for i in range(3):
+            user = User.objects.create_user(username=f'adviser{i}', password='password')
+            self.advisers.append(Adviser.objects.create(user=user, fee_percentage=Decimal('80.00'), start_date='2023-01-01'))
+        self.product = Product.objects.create(name='Term Life', category=ProductCategory.objects.create(name='Life'))
+
+    def _commission(self, adviser, number, day, net='1000.00'):
+        policy = Policy.objects.create(policy_number=number, adviser=adviser, provider='A', date_issued=day)
+        with self.captureOnCommitCallbacks(execute=True):
+            return Commission.objects.create(
+                policy=policy, product=self.product, adviser=adviser, gross_commission=Decimal(net),
+                net_commission=Decimal(net), adviser_fee_percentage=adviser.fee_percentage, date_received=day
+            )
+
+    def _badge(self, name, metric, threshold):
+        return Badge.objects.create(name=name, metric=metric, threshold=Decimal(threshold))
+
+    def _badges_of(self, adviser):
+        return set(Achievement.objects.filter(adviser=adviser).values_list('badge__name', flat=True))
+
+    def test_counters_follow_commission_events(self):
+        adviser = self.advisers[0]
+        first = self._commission(adviser, 'P-1', '2023-08-10')
+        self._commission(adviser, 'P-2', '2023-09-10', net='500.00')
+        self._commission(adviser, 'P-3', '2023-11-10')
+        counters = AdviserAchievementCounters.objects.get(adviser=adviser)
+        self.assertEqual((counters.commission_count, counters.net_volume), (3, Decimal('2500.00')))
+        self.assertEqual((counters.month_streak, counters.best_month_streak), (1, 2))
+
+        self._commission(adviser, 'P-4', '2023-10-01')
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        counters.refresh_from_db()
+        self.assertEqual((counters.commission_count, counters.net_volume), (3, Decimal('2500.00')))
+        self.assertEqual((counters.month_streak, counters.best_month_streak), (3, 3))
+
+        expected = (counters.commission_count, counters.net_volume, counters.month_streak, counters.best_month_streak)
+        rebuild_counters()
+        counters.refresh_from_db()
+        self.assertEqual(
+            (counters.commission_count, counters.net_volume, counters.month_streak, counters.best_month_streak), expected
+        )
+
+    def test_badges_are_awarded_once_on_threshold(self):
+        self._badge('First Deal', Badge.Metric.COMMISSION_COUNT, '1')
+        self._badge('Big Seller', Badge.Metric.NET_VOLUME, '1500')
+        self._badge('Two Months', Badge.Metric.MONTH_STREAK, '2')
+        adviser = self.advisers[0]
+
+        self._commission(adviser, 'P-1', '2023-09-10')
+        self.assertEqual(self._badges_of(adviser), {'First Deal'})
+        self._commission(adviser, 'P-2', '2023-10-10')
+        self.assertEqual(self._badges_of(adviser), {'First Deal', 'Big Seller', 'Two Months'})
+        self._commission(adviser, 'P-3', '2023-10-11')
+        self.assertEqual(Achievement.objects.filter(adviser=adviser).count(), 3)
+        self.assertEqual(check_for_new_achievements(adviser.user), [])
+
+    def test_checking_many_badges_costs_constant_queries(self):
+        for adviser in self.advisers:
+            self._commission(adviser, f'P-{adviser.pk}', '2023-10-10')
+        for i in range(20):
+            self._badge(f'Deals {i}', Badge.Metric.COMMISSION_COUNT, '1')
+        award_achievements([])  # загрузка определений значков
+
+        ids = [adviser.pk for adviser in self.advisers]
+        # Счетчики, уже выданные значки, один bulk INSERT
+        with self.assertNumQueries(3):
+            awards = award_achievements(ids)
+        self.assertEqual(len(awards), 60)
+        with self.assertNumQueries(2):
+            self.assertEqual(award_achievements(ids), [])
+
+    def test_commission_save_defers_counters_until_commit(self):
+        self._badge('First Deal', Badge.Metric.COMMISSION_COUNT, '1')
+        adviser = self.advisers[0]
+        policy = Policy.objects.create(policy_number='P-1', adviser=adviser, provider='A', date_issued='2023-10-10')
+        with mock.patch.object(record_sales_task, 'delay') as delay:
+            with self.captureOnCommitCallbacks() as callbacks:
+                Commission.objects.create(
+                    policy=policy, product=self.product, adviser=adviser, gross_commission=Decimal('100.00'),
+                    net_commission=Decimal('100.00'), adviser_fee_percentage=adviser.fee_percentage,
+                    date_received='2023-10-10',
+                )
+            self.assertFalse(AdviserAchievementCounters.objects.filter(adviser=adviser).exists())
+            delay.assert_not_called()
+            for callback in callbacks:
+                callback()
+        delay.assert_called_once_with([adviser.pk])
+
+        record_sales_task(delay.call_args.args[0])
+        record_sales_task(delay.call_args.args[0])  # повтор задачи ничего не удваивает
+        counters = AdviserAchievementCounters.objects.get(adviser=adviser)
+        self.assertEqual((counters.commission_count, counters.net_volume), (1, Decimal('100.00')))
+        self.assertEqual(self._badges_of(adviser), {'First Deal'})
+
+    def test_broker_failure_does_not_fail_commission_save(self):
+        adviser = self.advisers[0]
+        with mock.patch.object(record_sales_task, 'delay', side_effect=ConnectionError('broker down')), \
+                self.assertLogs('backend.apps.commission.rollups', level='ERROR'):
+            commission = self._commission(adviser, 'P-1', '2023-10-10')
+        self.assertTrue(Commission.objects.filter(pk=commission.pk).exists())
+        # Счетчики восстанавливаются пересборкой
+        rebuild_counters()
+        self.assertEqual(AdviserAchievementCounters.objects.get(adviser=adviser).commission_count, 1)
+
+    def test_month_streaks(self):
+        months = [date(2023, 12, 1), date(2023, 11, 1), date(2023, 9, 1), date(2023, 8, 1), date(2023, 7, 1)]
+        self.assertEqual(month_streaks(months), (2, 3))
+        self.assertEqual(month_streaks([date(2024, 1, 1), date(2023, 12, 1)]), (2, 2))
+        self.assertEqual(month_streaks([]), (0, 0))
@@ -0,0 +1,104 @@
+import io
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.management import CommandError, call_command
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from backend.apps.advisers.models import Adviser
+from backend.apps.commission.advances import advisers_with_outstanding_advances, check_advance_ledger
+from backend.apps.commission.models import Advance, AdviserAdvanceBalance, Repayment
+
+User = get_user_model()
+
+
+class AdvanceLedgerTests(APITestCase):
+
+    def setUp(self):
+        self.adviser = self._adviser('adviser')
+        self.other = self._adviser('other')
+
+    def _adviser(self, username):
+        user = User.objects.create_user(username=username, password='password')
+        return Adviser.objects.create(user=user, fee_percentage=Decimal('80.00'), start_date='2023-01-01')
+
+    def _advance(self, adviser, amount):
+        return Advance.objects.create(adviser=adviser, amount=Decimal(amount), date_issued='2023-10-01')
+
+    def _repay(self, advance, amount):
+        return Repayment.objects.create(advance=advance, amount=Decimal(amount), date_repaid='2023-10-10')
+
+    def _balance(self, adviser):
+        balance = AdviserAdvanceBalance.objects.filter(adviser=adviser).first()
+        return (balance.outstanding_balance, balance.open_advances) if balance else None
+
+    def test_repayments_keep_running_balances(self):
+        advance = self._advance(self.adviser, '300.00')
+        self._advance(self.adviser, '200.00')
+        self.assertEqual(self._balance(self.adviser), (Decimal('500.00'), 2))
+
+        first = self._repay(advance, '100.00')
+        advance.refresh_from_db()
+        self.assertEqual((advance.outstanding_balance, advance.is_fully_repaid), (Decimal('200.00'), False))
+        self.assertEqual(self._balance(self.adviser), (Decimal('400.00'), 2))
+
+        # Полное погашение закрывает аванс, отмена погашения открывает снова
+        last = self._repay(advance, '200.00')
+        advance.refresh_from_db()
+        self.assertTrue(advance.is_fully_repaid)
+        self.assertEqual(self._balance(self.adviser), (Decimal('200.00'), 1))
+        last.delete()
+        advance.refresh_from_db()
+        self.assertFalse(advance.is_fully_repaid)
+        self.assertEqual(self._balance(self.adviser), (Decimal('400.00'), 2))
+
+        # Изменение суммы аванса учитывает уже внесенные погашения, даже из устаревшего экземпляра
+        first.amount = Decimal('150.00')
+        first.save()
+        stale = Advance.objects.get(pk=advance.pk)
+        self._repay(advance, '50.00')
+        stale.amount = Decimal('400.00')
+        stale.save()
+        advance.refresh_from_db()
+        self.assertEqual(advance.outstanding_balance, Decimal('200.00'))
+        self.assertEqual(self._balance(self.adviser), (Decimal('400.00'), 2))
+
+        # Перенос аванса к другому консультанту и удаление с каскадом погашений
+        advance.adviser = self.other
+        advance.save()
+        self.assertEqual(self._balance(self.other), (Decimal('200.00'), 1))
+        self.assertEqual(self._balance(self.adviser), (Decimal('200.00'), 1))
+        advance.delete()
+        self.assertEqual(self._balance(self.other), (Decimal('0.00'), 0))
+        self.assertEqual(check_advance_ledger(), [])
+
+    def test_outstanding_advances_list(self):
+        self._advance(self.adviser, '100.00')
+        repaid = self._advance(self.other, '500.00')
+        self._repay(repaid, '500.00')
+        self.assertEqual(list(advisers_with_outstanding_advances().values_list('adviser_id', flat=True)), [self.adviser.id])
+
+        biggest = self._adviser('biggest')
+        self._advance(biggest, '900.00')
+        self.client.force_authenticate(User.objects.create_user(username='admin', password='password', is_staff=True))
+        response = self.client.get(reverse('commission:outstanding-advance-list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(row['adviser'], row['outstanding_balance']) for row in response.data['results']],
+            [(biggest.id, '900.00'), (self.adviser.id, '100.00')],
+        )
+
+    def test_rebuild_and_check_command(self):
+        advance = self._advance(self.adviser, '300.00')
+        self._repay(advance, '100.00')
+        # update() не вызывает сигналы — реестр расходится с погашениями
+        Repayment.objects.update(amount=Decimal('300.00'))
+        with self.assertRaises(CommandError):
+            call_command('rebuild_advance_ledger', '--check', stdout=io.StringIO())
+
+        call_command('rebuild_advance_ledger', stdout=io.StringIO())
+        advance.refresh_from_db()
+        self.assertTrue(advance.is_fully_repaid)
+        self.assertEqual(advisers_with_outstanding_advances().count(), 0)
+        call_command('rebuild_advance_ledger', '--check', stdout=io.StringIO())
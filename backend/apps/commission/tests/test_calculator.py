@@ -0,0 +1,89 @@
+import json
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from backend.apps.advisers.models import Adviser
+
+User = get_user_model()
+
+
+class CommissionCalculatorBatchTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        admin = User.objects.create_superuser('admin', 'admin@test.com', 'password')
+        self.client.force_authenticate(user=admin)
+        director = Adviser.objects.create(
+            user=User.objects.create_user('director', first_name='Dir', last_name='Ector'),
+            fee_percentage=Decimal('100.00'), start_date='2023-01-01'
+        )
+        self.manager = Adviser.objects.create(
+            user=User.objects.create_user('manager', first_name='Man', last_name='Ager'),
+            parent_adviser=director, fee_percentage=Decimal('90.00'), start_date='2023-01-01'
+        )
+        self.adviser = Adviser.objects.create(
+            user=User.objects.create_user('adviser', first_name='Ad', last_name='Viser'),
+            parent_adviser=self.manager, fee_percentage=Decimal('80.00'), start_date='2023-01-01'
+        )
+        self.url = reverse('commission:commission-calculator-batch-api')
+
+    def test_batch_matches_single_calculator(self):
+        rows = [
+            {"net_commission": "1000.00", "adviser_id": self.adviser.id},
+            {"net_commission": "250.50", "adviser_id": self.manager.id},
+        ]
+        response = self.client.post(self.url, rows, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(response.data['errors'], [])
+
+        single_url = reverse('commission:commission-calculator-api')
+        for row, result in zip(rows, response.data['results']):
+            single = self.client.post(single_url, row, format='json').data
+            self.assertEqual(result['total_payout'], single['total_payout'])
+            self.assertEqual(result['payout_breakdown'], single['payout_breakdown'])
+
+        first = response.data['results'][0]
+        self.assertEqual([share['type'] for share in first['payout_breakdown']], ['DIRECT', 'OVERRIDE', 'OVERRIDE'])
+        self.assertEqual(first['total_payout'], Decimal('1000.00'))
+
+    def test_query_count_is_constant(self):
+        rows = [{"net_commission": str(i), "adviser_id": self.adviser.id if i % 2 else self.manager.id} for i in range(500)]
+        # Один запрос на цепочки всех консультантов пакета
+        with self.assertNumQueries(1):
+            response = self.client.post(self.url, {"rows": rows}, format='json')
+        self.assertEqual(response.data['count'], 500)
+
+    def test_unknown_adviser_and_bad_rows_are_reported(self):
+        rows = [
+            {"net_commission": "100", "adviser_id": 999999},
+            {"net_commission": "abc", "adviser_id": self.adviser.id},
+            {"adviser_id": self.adviser.id},
+            {"net_commission": "100", "adviser_id": self.adviser.id},
+        ]
+        response = self.client.post(self.url, rows, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(len(response.data['errors']), 3)
+        self.assertIn("Консультант 999999 не найден", " ".join(response.data['errors']))
+
+    def test_csv_upload_with_streamed_csv_output(self):
+        content = f"net_commission,adviser_id\n1000.00,{self.adviser.id}\n500.00,{self.manager.id}\n".encode()
+        upload = SimpleUploadedFile("rows.csv", content, content_type="text/csv")
+        response = self.client.post(f"{self.url}?output=csv", {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], "row,adviser_id,recipient,type,fee_percentage,override_percentage,calculated_fee")
+        # 3 выплаты по первой строке + 2 по второй
+        self.assertEqual(len(lines), 6)
+        self.assertTrue(lines[1].startswith(f"1,{self.adviser.id},Ad Viser,DIRECT"))
+
+    def test_invalid_payload(self):
+        response = self.client.post(self.url, json.dumps({"foo": 1}), content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,158 @@
+import asyncio
+import json
+import random
+import time
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
+
+from channels.db import database_sync_to_async
+from channels.layers import channel_layers
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from backend.apps.advisers.hierarchy import rebuild_hierarchy
+from backend.apps.advisers.models import Adviser
+from backend.apps.commission.consumers import DealConsumer
+from backend.apps.commission.deal_events import (
+    deal_event, group_events, publish_deal_events, send_group_events,
+)
+
+User = get_user_model()
+
+IN_MEMORY_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+# Клиентов в нагрузочном тесте: руководитель, MANAGERS команд по ADVISERS_PER_TEAM консультантов
+MANAGERS = 9
+ADVISERS_PER_TEAM = 110
+BURST_ROUNDS = 20
+EVENTS_PER_ROUND = 100
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class DealConsumerTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        channel_layers.backends.clear()
+        self.interval = mock.patch.object(DealConsumer, 'coalesce_interval', 0.2)
+        self.interval.start()
+        self.addCleanup(self.interval.stop)
+
+    def _build_hierarchy(self, managers, advisers_per_team):
+        """Пользователи и консультанты пачкой (без хэширования паролей), closure-таблица пересобирается."""
+        count = 1 + managers + managers * advisers_per_team
+        # Каждый пользователь — отдельное MPTT-дерево
+        users = User.objects.bulk_create([
+            User(username=f'user{i}', tree_id=i + 1, lft=1, rght=2, level=0) for i in range(count)
+        ])
+        director = Adviser.objects.create(user=users[0], start_date='2023-01-01')
+        team_leads = Adviser.objects.bulk_create([
+            Adviser(user=user, parent_adviser=director, start_date='2023-01-01') for user in users[1:managers + 1]
+        ])
+        Adviser.objects.bulk_create([
+            Adviser(user=user, parent_adviser=team_leads[i % managers], start_date='2023-01-01')
+            for i, user in enumerate(users[managers + 1:])
+        ])
+        rebuild_hierarchy()
+        return list(User.objects.select_related('adviser_profile').order_by('id'))
+
+    async def _connect(self, user):
+        communicator = WebsocketCommunicator(DealConsumer.as_asgi(), '/ws/deals/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def _drain(self, communicator):
+        messages = []
+        while not await communicator.receive_nothing(timeout=0):
+            messages.append(json.loads(await communicator.receive_from()))
+        return messages
+
+    async def test_events_reach_only_own_and_team_groups(self):
+        users = await database_sync_to_async(self._build_hierarchy)(2, 2)
+        director, lead_a, lead_b, adviser_a = users[0], users[1], users[2], users[3]
+        self.assertEqual(adviser_a.adviser_profile.parent_adviser_id, lead_a.adviser_profile.id)
+        clients = {user.username: await self._connect(user) for user in (director, lead_a, lead_b, adviser_a)}
+
+        commission = SimpleNamespace(
+            pk=1, adviser_id=adviser_a.adviser_profile.id, commission_type='DIRECT',
+            net_commission=Decimal('100.00'), adviser_fee_amount=Decimal('80.00'), date_received='2023-10-01',
+        )
+        await database_sync_to_async(publish_deal_events)([commission])
+        director_batch = json.loads(await clients['user0'].receive_from(timeout=1))
+        self.assertEqual([event['id'] for event in director_batch['messages']], [1])
+        await asyncio.sleep(DealConsumer.coalesce_interval * 3)
+
+        received = {name: await self._drain(client) for name, client in clients.items()}
+        self.assertEqual(received['user1'][0]['messages'][0]['id'], 1)
+        self.assertEqual(received['user3'][0]['messages'][0]['adviser_id'], adviser_a.adviser_profile.id)
+        self.assertEqual(received['user2'], [])
+        for client in clients.values():
+            await client.disconnect()
+
+    async def test_anonymous_client_is_rejected(self):
+        communicator = WebsocketCommunicator(DealConsumer.as_asgi(), '/ws/deals/')
+        communicator.scope['user'] = SimpleNamespace(is_authenticated=False)
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_message_volume_per_client_is_bounded_at_1k_clients(self):
+        users = await database_sync_to_async(self._build_hierarchy)(MANAGERS, ADVISERS_PER_TEAM)
+        self.assertGreaterEqual(len(users), 1000)
+        clients = [await self._connect(user) for user in users]
+
+        # Всплеск: BURST_ROUNDS публикаций по EVENTS_PER_ROUND событий в пределах одного интервала
+        rng = random.Random(0)
+        adviser_ids = [user.adviser_profile.id for user in users]
+        events = [
+            deal_event(SimpleNamespace(
+                pk=i, adviser_id=rng.choice(adviser_ids), commission_type='DIRECT',
+                net_commission=Decimal('1.00'), adviser_fee_amount=Decimal('0.80'), date_received='2023-10-01',
+            ))
+            for i in range(BURST_ROUNDS * EVENTS_PER_ROUND)
+        ]
+        rounds = [
+            await database_sync_to_async(group_events)(events[start:start + EVENTS_PER_ROUND])
+            for start in range(0, len(events), EVENTS_PER_ROUND)
+        ]
+        layer = channel_layers['default']
+        started = time.monotonic()
+        for grouped in rounds:
+            await send_group_events(layer, grouped)
+        elapsed = time.monotonic() - started
+
+        # Руководитель верхнего уровня получает все события всплеска
+        first = json.loads(await clients[0].receive_from(timeout=5))
+        messages = first['messages']
+        # Отложенные отправки остальных клиентов успевают сработать
+        await asyncio.sleep(DealConsumer.coalesce_interval * 3)
+        received = [await self._drain(client) for client in clients]
+        messages += [event for batch in received[0] for event in batch['messages']]
+        self.assertEqual(sorted(event['id'] for event in messages), list(range(len(events))))
+
+        # Число сообщений клиенту ограничено числом интервалов, а не числом событий
+        per_client = [len(batches) + (1 if i == 0 else 0) for i, batches in enumerate(received)]
+        self.assertLessEqual(max(per_client), int(elapsed / DealConsumer.coalesce_interval) + 2)
+        # Руководитель верхнего уровня получил все события всплеска малым числом сообщений
+        self.assertLess(per_client[0] * 10, len(events))
+        expected = {event['adviser_id'] for event in events}
+        for user, batches in zip(users[MANAGERS + 1:], received[MANAGERS + 1:]):
+            self.assertEqual(bool(batches), user.adviser_profile.id in expected)
+
+        for client in clients:
+            await client.disconnect()
+
+    def test_publish_failure_is_logged_not_raised(self):
+        commission = SimpleNamespace(
+            pk=1, adviser_id=1, commission_type='DIRECT', net_commission=Decimal('1.00'),
+            adviser_fee_amount=Decimal('1.00'), date_received='2023-10-01',
+        )
+        failing = mock.AsyncMock(side_effect=ConnectionError('redis is down'))
+        with mock.patch('backend.apps.commission.deal_events.send_group_events', failing), \
+                self.assertLogs('backend.apps.commission.deal_events', level='ERROR'):
+            publish_deal_events([commission])
+        failing.assert_awaited_once()
@@ -0,0 +1,81 @@
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from backend.apps.advisers.models import Adviser
+from backend.apps.commission.models import Bonus, Clawback, Commission, ReferralFee, Retention
+from backend.apps.policies.models import Policy
+from backend.apps.products.models import Product, ProductCategory
+
+User = get_user_model()
+
+# Потолок запросов на страницу плоского списка: профиль консультанта + сам список
+MAX_FLAT_LIST_QUERIES = 2
+
+
+class FlatCommissionListTests(APITestCase):
+
+    def setUp(self):
+        manager_user = User.objects.create_user(username='manager', password='password', first_name='Big', last_name='Boss')
+        adviser_user = User.objects.create_user(username='adviser', password='password', first_name='Test', last_name='Adviser')
+        self.manager = Adviser.objects.create(user=manager_user, fee_percentage=Decimal('100.00'), start_date='2023-01-01')
+        self.adviser = Adviser.objects.create(
+            user=adviser_user, parent_adviser=self.manager, fee_percentage=Decimal('80.00'), start_date='2023-01-01'
+        )
+        category = ProductCategory.objects.create(name='Life')
+        self.product = Product.objects.create(name='Term Life', category=category)
+        self.url = reverse('commission:commission-list')
+        self.client.force_authenticate(manager_user)
+
+    def _create_commissions(self, start, count):
+        for i in range(start, start + count):
+            policy = Policy.objects.create(policy_number=f'P-{i}', adviser=self.adviser, provider='A', date_issued='2023-10-26')
+            commission = Commission.objects.create(
+                policy=policy, product=self.product, adviser=self.adviser, gross_commission=Decimal('1200.00'),
+                net_commission=Decimal('1000.00'), adviser_fee_percentage=self.adviser.fee_percentage,
+                date_received='2023-10-26'
+            )
+            Retention.objects.create(commission=commission, amount=Decimal('50.00'), reason='Hold')
+            Retention.objects.create(commission=commission, amount=Decimal('25.00'), reason='Hold')
+            Clawback.objects.create(commission=commission, amount=Decimal('-10.00'), reason='Cancel')
+            Bonus.objects.create(commission=commission, amount=Decimal('5.00'), reason='KPI')
+            ReferralFee.objects.create(commission=commission, amount=Decimal('7.00'), reason='Ref', referral_source_name='X')
+
+    def _list_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url, {'view': 'flat'})
+        self.assertEqual(response.status_code, 200)
+        return response, len(context.captured_queries)
+
+    def test_flat_row_contains_modifier_totals(self):
+        self._create_commissions(0, 1)
+        response, _ = self._list_queries()
+        row = response.data['results'][0]
+        self.assertEqual(row['policy_number'], 'P-0')
+        self.assertEqual(row['adviser_name'], 'Test Adviser')
+        self.assertEqual(row['adviser_fee_amount'], '800.00')
+        self.assertEqual((row['retention_total'], row['retention_count']), ('75.00', 2))
+        self.assertEqual((row['clawback_total'], row['clawback_count']), ('-10.00', 1))
+        self.assertEqual((row['override_total'], row['override_count']), ('200.00', 1))
+        self.assertEqual((row['referral_fee_total'], row['bonus_count']), ('7.00', 1))
+        self.assertNotIn('retentions', row)
+
+    def test_query_count_is_constant_as_page_grows(self):
+        self._create_commissions(0, 2)
+        small_response, small = self._list_queries()
+        self._create_commissions(2, 20)
+        large_response, large = self._list_queries()
+
+        self.assertEqual(len(small_response.data['results']), 2)
+        self.assertEqual(len(large_response.data['results']), 22)
+        self.assertEqual(small, large)
+        self.assertLessEqual(large, MAX_FLAT_LIST_QUERIES)
+
+    def test_nested_view_is_default(self):
+        self._create_commissions(0, 1)
+        response = self.client.get(self.url)
+        self.assertIn('retentions', response.data['results'][0])
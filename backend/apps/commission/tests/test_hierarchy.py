@@ -0,0 +1,108 @@
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+
+from backend.apps.advisers.hierarchy import get_ancestor_chain, get_ancestor_chains
+from backend.apps.advisers.models import Adviser
+from backend.apps.commission.achievements_engine import get_badges
+from backend.apps.commission.models import Commission, Override
+from backend.apps.commission.rules_engine import get_evaluator
+from backend.apps.policies.models import Policy
+from backend.apps.products.models import Product, ProductCategory
+
+User = get_user_model()
+
+
+class AncestorChainTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        # Шесть уровней: каждый следующий руководитель получает на 2% больше
+        self.advisers = []
+        parent = None
+        for level in range(6):
+            user = User.objects.create_user(username=f'level{level}', first_name='Level', last_name=str(level))
+            parent = Adviser.objects.create(
+                user=user, parent_adviser=parent, fee_percentage=Decimal('90.00') - 2 * level, start_date='2023-01-01'
+            )
+            self.advisers.append(parent)
+        self.leaf = self.advisers[-1]
+        category = ProductCategory.objects.create(name='Life')
+        self.product = Product.objects.create(name='Term Life', category=category)
+
+    def _create_commission(self, number='P-1'):
+        policy = Policy.objects.create(policy_number=number, adviser=self.leaf, provider='A', date_issued='2023-01-01')
+        return Commission.objects.create(
+            policy=policy, product=self.product, adviser=self.leaf, gross_commission=Decimal('1200.00'),
+            net_commission=Decimal('1000.00'), adviser_fee_percentage=self.leaf.fee_percentage, date_received='2023-01-01'
+        )
+
+    def test_chain_is_loaded_in_one_query_and_cached(self):
+        with self.assertNumQueries(1):
+            chain = get_ancestor_chain(self.leaf.id)
+        self.assertEqual([link.id for link in chain], [a.id for a in reversed(self.advisers)])
+        self.assertEqual(chain[1].full_name, 'Level 4')
+        self.assertEqual(chain[-1].fee_percentage, Decimal('90.00'))
+
+        with self.assertNumQueries(0):
+            get_ancestor_chain(self.leaf.id)
+
+    def test_multiple_chains_in_one_query(self):
+        with self.assertNumQueries(1):
+            chains = get_ancestor_chains([a.id for a in self.advisers])
+        self.assertEqual(len(chains[self.advisers[2].id]), 3)
+        self.assertEqual(chains[self.advisers[0].id][0].parent_id, None)
+
+    def test_override_creation_is_constant_in_depth(self):
+        get_ancestor_chain(self.leaf.id)
+        get_evaluator()
+        get_badges()
+        policy = Policy.objects.create(policy_number='P-1', adviser=self.leaf, provider='A', date_issued='2023-01-01')
+        # INSERT комиссии, новые строки дневных итогов и месячных продаж
+        # (по UPDATE, SAVEPOINT, INSERT, RELEASE), один bulk INSERT оверрайдов
+        # и UPDATE итогов — независимо от глубины; счетчики достижений — после коммита
+        with self.assertNumQueries(11):
+            commission = Commission.objects.create(
+                policy=policy, product=self.product, adviser=self.leaf, gross_commission=Decimal('1200.00'),
+                net_commission=Decimal('1000.00'), adviser_fee_percentage=self.leaf.fee_percentage,
+                date_received='2023-01-01'
+            )
+        overrides = Override.objects.filter(commission=commission).order_by('-amount', 'id')
+        self.assertEqual(overrides.count(), 5)
+        self.assertTrue(all(o.amount == Decimal('20.00') for o in overrides))
+        self.assertEqual(
+            set(overrides.values_list('reason', flat=True)),
+            {f"Override from Level {level}" for level in range(1, 6)}
+        )
+
+    def test_cache_invalidated_on_fee_and_parent_change(self):
+        get_ancestor_chain(self.leaf.id)
+        top = self.advisers[0]
+        top.fee_percentage = Decimal('95.00')
+        top.save()
+        chain = get_ancestor_chain(self.leaf.id)
+        self.assertEqual(chain[-1].fee_percentage, Decimal('95.00'))
+
+        self.leaf.parent_adviser = top
+        self.leaf.save()
+        self.assertEqual([link.id for link in get_ancestor_chain(self.leaf.id)], [self.leaf.id, top.id])
+
+        commission = self._create_commission()
+        override = Override.objects.get(commission=commission)
+        self.assertEqual(override.recipient_id, top.id)
+        self.assertEqual(override.amount, Decimal('150.00'))
+
+    def test_unrelated_save_keeps_cache(self):
+        get_ancestor_chain(self.leaf.id)
+        self.leaf.status = Adviser.AdviserStatus.ON_LEAVE
+        self.leaf.save()
+        with self.assertNumQueries(0):
+            get_ancestor_chain(self.leaf.id)
+
+    def test_cycle_does_not_loop(self):
+        top = self.advisers[0]
+        Adviser.objects.filter(pk=top.pk).update(parent_adviser=self.leaf)
+        chain = get_ancestor_chain(self.leaf.id)
+        self.assertEqual(len(chain), 6)
@@ -0,0 +1,127 @@
+import io
+import os
+import tempfile
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase
+
+from backend.apps.advisers.models import Adviser
+from backend.apps.commission.models import AdviserAchievementCounters, AdviserMonthlySales, Commission, CommissionDailyRollup, Override
+from backend.apps.policies.models import Policy
+from backend.apps.products.models import Product, ProductCategory
+
+User = get_user_model()
+
+HEADER = "policy_number,adviser_username,product_name,provider,gross_commission,net_commission,date_received\n"
+
+
+class BulkIngestionCommandTests(TestCase):
+
+    def setUp(self):
+        manager_user = User.objects.create_user(username='manager', password='password', first_name='Big', last_name='Boss')
+        adviser_user = User.objects.create_user(username='adviser', password='password', first_name='Test', last_name='Adviser')
+        self.manager = Adviser.objects.create(user=manager_user, fee_percentage=Decimal('100.00'), start_date='2023-01-01')
+        self.adviser = Adviser.objects.create(
+            user=adviser_user, parent_adviser=self.manager, fee_percentage=Decimal('80.00'), start_date='2023-01-01'
+        )
+        category = ProductCategory.objects.create(name='Life')
+        self.product = Product.objects.create(name='Term Life', category=category)
+
+    def _write_csv(self, lines):
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(HEADER + "".join(lines))
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_import_creates_policies_commissions_and_overrides(self):
+        path = self._write_csv([
+            f"POL-{i},adviser,Term Life,Aviva,1000.00,800.00,2023-10-26\n" for i in range(25)
+        ])
+        out = io.StringIO()
+        call_command('ingestion', path, '--chunk-size', '10', '--batch-size', '4', stdout=out)
+
+        self.assertEqual(Policy.objects.count(), 25)
+        self.assertEqual(Commission.objects.count(), 25)
+        commission = Commission.objects.get(policy__policy_number='POL-3')
+        self.assertEqual(commission.adviser, self.adviser)
+        self.assertEqual(commission.adviser_fee_amount, Decimal('640.00'))
+
+        # Оверрайды создаются массово так же, как при Commission.save()
+        self.assertEqual(Override.objects.count(), 25)
+        override = Override.objects.get(commission=commission)
+        self.assertEqual(override.recipient, self.manager)
+        self.assertEqual(override.amount, Decimal('160.00'))
+        self.assertEqual(override.reason, "Override from Test Adviser")
+
+        output = out.getvalue()
+        self.assertIn("Чанк 3", output)
+        self.assertIn("строк/сек", output)
+
+    def test_reimport_updates_without_duplicates(self):
+        path = self._write_csv(["POL-1,adviser,Term Life,Aviva,1000.00,800.00,2023-10-26\n"])
+        call_command('ingestion', path, stdout=io.StringIO())
+        path = self._write_csv([
+            "POL-1,adviser,Term Life,Aviva,1000.00,500.00,2023-10-26\n",
+            "POL-1,adviser,Term Life,Aviva,1000.00,900.00,2023-10-26\n",
+        ])
+        call_command('ingestion', path, stdout=io.StringIO())
+
+        self.assertEqual(Commission.objects.count(), 1)
+        commission = Commission.objects.get()
+        self.assertEqual(commission.net_commission, Decimal('900.00'))
+        self.assertEqual(commission.adviser_fee_amount, Decimal('720.00'))
+        # Оверрайды создаются только для новых комиссий
+        self.assertEqual(Override.objects.count(), 1)
+
+    def test_unknown_references_and_bad_rows_are_reported(self):
+        path = self._write_csv([
+            "POL-1,ghost,Term Life,Aviva,1000.00,800.00,2023-10-26\n",
+            "POL-2,adviser,Unknown,Aviva,1000.00,800.00,2023-10-26\n",
+            "POL-3,adviser,Term Life,Aviva,abc,800.00,2023-10-26\n",
+            "POL-4,adviser,Term Life,Aviva,1000.00,800.00,2023-10-26\n",
+        ])
+        out = io.StringIO()
+        call_command('ingestion', path, stdout=out)
+
+        output = out.getvalue()
+        self.assertIn('Строка 2: Консультант "ghost" не найден.', output)
+        self.assertIn('Строка 3: Продукт "Unknown" не найден.', output)
+        self.assertIn('Строка 4: Ошибка данных', output)
+        self.assertEqual(list(Commission.objects.values_list('policy__policy_number', flat=True)), ['POL-4'])
+
+    def test_reads_from_stdin(self):
+        csv_data = HEADER + "POL-1,adviser,Term Life,Aviva,1000.00,800.00,2023-10-26\n"
+        with mock.patch('sys.stdin', io.StringIO(csv_data)):
+            call_command('ingestion', '-', stdout=io.StringIO())
+        self.assertEqual(Commission.objects.count(), 1)
+
+    def test_query_count_does_not_depend_on_chunk_size(self):
+        path = self._write_csv([
+            f"POL-{i},adviser,Term Life,Aviva,1000.00,800.00,2023-10-26\n" for i in range(5)
+        ])
+        small = io.StringIO()
+        cache.clear()
+        call_command('ingestion', path, stdout=small)
+        Commission.objects.all().delete()
+        Policy.objects.all().delete()
+        # строки итогов должны создаваться в обоих прогонах
+        CommissionDailyRollup.objects.all().delete()
+        AdviserMonthlySales.objects.all().delete()
+        AdviserAchievementCounters.objects.all().delete()
+        cache.clear()  # цепочки руководителей должны загружаться в обоих прогонах
+        path = self._write_csv([
+            f"POL-{i},adviser,Term Life,Aviva,1000.00,800.00,2023-10-26\n" for i in range(40)
+        ])
+        large = io.StringIO()
+        call_command('ingestion', path, stdout=large)
+
+        def queries(output):
+            line = next(line for line in output.getvalue().splitlines() if line.startswith("Чанк 1"))
+            return int(line.rsplit(' ', 1)[1])
+
+        self.assertEqual(queries(small), queries(large))
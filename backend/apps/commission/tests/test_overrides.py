@@ -0,0 +1,91 @@
+from datetime import date
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+
+from backend.apps.advisers.models import Adviser
+from backend.apps.commission import signals
+from backend.apps.commission.models import Commission, Override
+from backend.apps.commission.overrides import rederive_overrides
+from backend.apps.commission.rollups import check_rollups
+from backend.apps.policies.models import Policy
+from backend.apps.products.models import Product, ProductCategory
+
+User = get_user_model()
+
+
+class OverrideRederivationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.director = self._adviser('director', None, '100.00')
+        self.manager = self._adviser('manager', self.director, '90.00')
+        self.adviser = self._adviser('adviser', self.manager, '80.00')
+        self.product = Product.objects.create(name='Term Life', category=ProductCategory.objects.create(name='Life'))
+
+    def _adviser(self, username, parent, fee):
+        user = User.objects.create_user(username=username, password='password')
+        return Adviser.objects.create(user=user, parent_adviser=parent, fee_percentage=Decimal(fee), start_date='2023-01-01')
+
+    def _commission(self, number, day='2023-10-15'):
+        policy = Policy.objects.create(policy_number=number, adviser=self.adviser, provider='A', date_issued=day)
+        return Commission.objects.create(
+            policy=policy, product=self.product, adviser=self.adviser, gross_commission=Decimal('1000.00'),
+            net_commission=Decimal('1000.00'), adviser_fee_percentage=self.adviser.fee_percentage, date_received=day
+        )
+
+    def _overrides(self, commission):
+        return dict(Override.objects.filter(commission=commission).values_list('recipient_id', 'amount'))
+
+    def test_fee_change_updates_overrides_inside_window(self):
+        old = self._commission('P-old', day='2023-09-30')
+        current = self._commission('P-1')
+        self.manager.fee_percentage = Decimal('95.00')
+        self.manager.save()
+
+        report = rederive_overrides(self.manager.id, effective_from=date(2023, 10, 1))
+        self.assertEqual(report, {'commissions': 1, 'created': 0, 'updated': 2, 'deleted': 0})
+        self.assertEqual(self._overrides(current), {self.manager.id: Decimal('150.00'), self.director.id: Decimal('50.00')})
+        self.assertEqual(self._overrides(old), {self.manager.id: Decimal('100.00'), self.director.id: Decimal('100.00')})
+        self.assertEqual(check_rollups(), [])
+
+        # Повторный запуск ничего не меняет
+        report = rederive_overrides(self.manager.id, effective_from=date(2023, 10, 1))
+        self.assertEqual(report, {'commissions': 1, 'created': 0, 'updated': 0, 'deleted': 0})
+
+    def test_parent_change_recomputes_subtree_in_chunks(self):
+        commissions = [self._commission(f'P-{i}') for i in range(5)]
+        self.adviser.parent_adviser = self.director
+        self.adviser.save()
+        outsider = self._adviser('outsider', None, '100.00')
+        self.manager.parent_adviser = outsider
+        self.manager.save()
+
+        report = rederive_overrides(self.adviser.id, effective_from=date(2023, 10, 1), chunk_size=2)
+        self.assertEqual(report, {'commissions': 5, 'created': 0, 'updated': 5, 'deleted': 5})
+        for commission in commissions:
+            self.assertEqual(self._overrides(commission), {self.director.id: Decimal('200.00')})
+        self.assertEqual(check_rollups(), [])
+
+    def test_hierarchy_change_schedules_rederivation_after_commit(self):
+        with mock.patch.object(signals.rederive_overrides_task, 'delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.manager.fee_percentage = Decimal('95.00')
+                self.manager.save()
+            with self.captureOnCommitCallbacks(execute=True):
+                self.manager.user.first_name = 'Renamed'
+                self.manager.save()
+        delay.assert_called_once_with(self.manager.id)
+
+    def test_broker_failure_after_hierarchy_change_is_logged(self):
+        with mock.patch.object(signals.rederive_overrides_task, 'delay', side_effect=ConnectionError('broker down')), \
+                self.assertLogs('backend.apps.commission.signals', level='ERROR') as logs:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.manager.fee_percentage = Decimal('95.00')
+                self.manager.save()
+        self.assertIn(f'rederive_overrides {self.manager.id}', logs.output[0])
+        self.manager.refresh_from_db()
+        self.assertEqual(self.manager.fee_percentage, Decimal('95.00'))
@@ -0,0 +1,122 @@
+import base64
+import json
+from datetime import date
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, APITestCase
+
+from backend.apps.advisers.models import Adviser
+from backend.apps.commission.models import Commission
+from backend.apps.core.pagination import KeysetPagination
+from backend.apps.policies.models import Policy
+from backend.apps.products.models import Product, ProductCategory
+
+User = get_user_model()
+
+
+class KeysetPaginationTests(APITestCase):
+
+    def setUp(self):
+        user = User.objects.create_user(username='adviser', password='password')
+        self.adviser = Adviser.objects.create(user=user, fee_percentage=Decimal('80.00'), start_date='2023-01-01')
+        category = ProductCategory.objects.create(name='Life')
+        self.product = Product.objects.create(name='Term Life', category=category)
+        # Несколько комиссий на одну дату: порядок внутри даты задает id
+        days = ['2023-10-01', '2023-10-03', '2023-10-03', '2023-10-03', '2023-10-02', '2023-10-03', '2023-10-01']
+        self.commissions = [self._commission(f'P-{i}', day) for i, day in enumerate(days)]
+        self.url = reverse('commission:commission-list')
+        self.client.force_authenticate(user)
+
+    def _commission(self, number, day):
+        policy = Policy.objects.create(policy_number=number, adviser=self.adviser, provider='A', date_issued=day)
+        return Commission.objects.create(
+            policy=policy, product=self.product, adviser=self.adviser, gross_commission=Decimal('100.00'),
+            net_commission=Decimal('100.00'), adviser_fee_percentage=self.adviser.fee_percentage,
+            date_received=day
+        )
+
+    def _expected_ids(self):
+        return list(Commission.objects.order_by('-date_received', '-id').values_list('id', flat=True))
+
+    def _walk(self, url, params=None, direction='next'):
+        ids, pages = [], 0
+        while url:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            page_ids = [row['id'] for row in response.data['results']]
+            ids = ids + page_ids if direction == 'next' else page_ids + ids
+            url, params, pages = response.data[direction], None, pages + 1
+        return ids, pages
+
+    def test_pages_follow_keyset_order_in_both_directions(self):
+        ids, pages = self._walk(self.url, {'page_size': 3})
+        self.assertEqual(ids, self._expected_ids())
+        self.assertEqual(pages, 3)
+
+        last_page = self.client.get(self.url, {'page_size': 3})
+        while last_page.data['next']:
+            last_page = self.client.get(last_page.data['next'])
+        self.assertEqual(len(last_page.data['results']), 1)
+        previous_ids, _ = self._walk(last_page.data['previous'], direction='previous')
+        self.assertEqual(previous_ids, self._expected_ids()[:-1])
+
+    def test_flat_view_is_paginated_too(self):
+        ids, _ = self._walk(self.url, {'page_size': 2, 'view': 'flat'})
+        self.assertEqual(ids, self._expected_ids())
+
+    def test_no_count_and_constant_cost_per_page(self):
+        first = self.client.get(self.url, {'page_size': 2})
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(first.data['next'])
+        sql = ' '.join(query['sql'] for query in context.captured_queries)
+        self.assertNotIn('COUNT(', sql.upper())
+        self.assertNotIn('OFFSET', sql.upper())
+
+    def test_page_size_is_capped(self):
+        with mock.patch.object(KeysetPagination, 'max_page_size', 2):
+            response = self.client.get(self.url, {'page_size': 1000})
+        self.assertEqual(len(response.data['results']), 2)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_cursor_with_bad_values(self):
+        for values in (['not-a-date', 1], [[1], {'x': 1}], ['2023-10-01', 'abc']):
+            payload = json.dumps({'v': values, 'r': 0}).encode()
+            response = self.client.get(self.url, {'cursor': base64.urlsafe_b64encode(payload).decode()})
+            self.assertEqual(response.status_code, 404, values)
+
+    def test_nullable_ordering_field_keeps_nulls_last(self):
+        Commission.objects.filter(pk__in=[self.commissions[1].pk, self.commissions[4].pk]).update(
+            date_paid_to_adviser=date(2023, 11, 1)
+        )
+        Commission.objects.filter(pk=self.commissions[2].pk).update(date_paid_to_adviser=date(2023, 11, 5))
+        view = SimpleNamespace(keyset_ordering=('-date_paid_to_adviser', 'id'))
+        factory = APIRequestFactory()
+        expected = [self.commissions[i].pk for i in (2, 1, 4, 0, 3, 5, 6)]
+
+        def page(url):
+            paginator = KeysetPagination()
+            rows = paginator.paginate_queryset(Commission.objects.all(), Request(factory.get(url)), view)
+            return [row.pk for row in rows], paginator.get_next_link(), paginator.get_previous_link()
+
+        forward, url, previous = [], '/commissions/?page_size=2', None
+        while url:
+            ids, url, previous = page(url)
+            forward += ids
+        self.assertEqual(forward, expected)
+
+        # Назад с последней страницы (внутри NULL-хвоста и через границу NULL)
+        backward, url = ids, previous
+        while url:
+            ids, _, url = page(url)
+            backward = ids + backward
+        self.assertEqual(backward, expected)
@@ -0,0 +1,139 @@
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from backend.apps.advisers.models import Adviser
+from backend.apps.commission.models import (
+    Advance, Bonus, Clawback, Commission, CommissionSplit, PayoutLine, PayoutRun, Repayment, Retention,
+)
+from backend.apps.commission.payouts import compute_payout_partition, execute_payout_run, start_payout_run
+from backend.apps.policies.models import Policy
+from backend.apps.products.models import Product, ProductCategory
+
+User = get_user_model()
+
+OCTOBER = (date(2023, 10, 1), date(2023, 10, 31))
+
+
+class PayoutRunTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.manager = self._adviser('manager', None, '100.00')
+        self.adviser = self._adviser('adviser', self.manager, '80.00')
+        self.partner = self._adviser('partner', None, '80.00')
+        self.product = Product.objects.create(name='Term Life', category=ProductCategory.objects.create(name='Life'))
+
+    def _adviser(self, username, parent, fee):
+        user = User.objects.create_user(username=username, password='password')
+        return Adviser.objects.create(user=user, parent_adviser=parent, fee_percentage=Decimal(fee), start_date='2023-01-01')
+
+    def _commission(self, adviser, number, net='1000.00', day='2023-10-15', **fields):
+        policy = Policy.objects.create(policy_number=number, adviser=adviser, provider='A', date_issued=day)
+        return Commission.objects.create(
+            policy=policy, product=self.product, adviser=adviser, gross_commission=Decimal(net),
+            net_commission=Decimal(net), adviser_fee_percentage=adviser.fee_percentage, date_received=day, **fields
+        )
+
+    def _created_on(self, modifier, day):
+        type(modifier).objects.filter(pk=modifier.pk).update(
+            created_at=timezone.make_aware(datetime.combine(day, datetime.min.time()))
+        )
+
+    def _lines(self, run):
+        return {line.adviser_id: line for line in run.lines.all()}
+
+    def test_net_payable_combines_all_modifiers(self):
+        commission = self._commission(self.adviser, 'P-1')
+        Retention.objects.create(commission=commission, amount=Decimal('50.00'), reason='Hold')
+        Retention.objects.create(commission=commission, amount=Decimal('30.00'), reason='Released', is_released=True)
+        clawback = Clawback.objects.create(commission=commission, amount=Decimal('-40.00'), reason='Lapse')
+        self._created_on(clawback, date(2023, 10, 20))
+        Bonus.objects.create(commission=commission, amount=Decimal('25.00'), reason='KPI')
+        CommissionSplit.objects.create(commission=commission, adviser=self.partner, split_percentage=Decimal('10.00'))
+        advance = Advance.objects.create(adviser=self.adviser, amount=Decimal('500.00'), date_issued='2023-09-01')
+        Repayment.objects.create(advance=advance, amount=Decimal('100.00'), date_repaid='2023-10-20')
+        Repayment.objects.create(advance=advance, amount=Decimal('100.00'), date_repaid='2023-11-20')
+        # Вне периода и отмененная комиссия не учитываются
+        self._commission(self.adviser, 'P-2', day='2023-11-01')
+        self._commission(self.adviser, 'P-3', payment_status=Commission.PaymentStatus.CANCELLED)
+
+        run = execute_payout_run(*OCTOBER)
+        lines = self._lines(run)
+        adviser = lines[self.adviser.id]
+        self.assertEqual(
+            (adviser.fee_total, adviser.retention_total, adviser.clawback_total, adviser.bonus_total,
+             adviser.split_total, adviser.repayment_total),
+            (Decimal('800.00'), Decimal('50.00'), Decimal('40.00'), Decimal('25.00'), Decimal('-80.00'), Decimal('100.00')),
+        )
+        self.assertEqual(adviser.net_payable, Decimal('555.00'))
+        self.assertEqual(lines[self.manager.id].override_total, Decimal('200.00'))
+        self.assertEqual(lines[self.partner.id].net_payable, Decimal('80.00'))
+
+        self.assertEqual(run.status, PayoutRun.Status.COMPLETED)
+        self.assertEqual((run.adviser_count, run.total_payable), (3, Decimal('835.00')))
+
+    def test_clawback_of_cancelled_prior_period_commission_is_deducted(self):
+        self._commission(self.adviser, 'P-1')
+        lapsed = self._commission(
+            self.adviser, 'P-0', day='2023-08-15', payment_status=Commission.PaymentStatus.CANCELLED
+        )
+        clawback = Clawback.objects.create(commission=lapsed, amount=Decimal('-300.00'), reason='Lapse')
+        self._created_on(clawback, date(2023, 10, 31))
+        # Возврат, созданный вне периода, в этот запуск не входит
+        later = Clawback.objects.create(commission=lapsed, amount=Decimal('-50.00'), reason='Lapse')
+        self._created_on(later, date(2023, 11, 1))
+
+        line = self._lines(execute_payout_run(*OCTOBER))[self.adviser.id]
+        self.assertEqual((line.fee_total, line.clawback_total), (Decimal('800.00'), Decimal('300.00')))
+        self.assertEqual(line.net_payable, Decimal('500.00'))
+
+    def test_runs_and_lines_are_immutable(self):
+        self._commission(self.adviser, 'P-1')
+        run = execute_payout_run(*OCTOBER)
+        line = run.lines.first()
+        line.net_payable = Decimal('0.00')
+        with self.assertRaises(ValidationError):
+            line.save()
+        with self.assertRaises(ValidationError):
+            line.delete()
+        with self.assertRaises(ValidationError):
+            run.save()
+        with self.assertRaises(ValueError):
+            compute_payout_partition(run.pk, [self.adviser.id])
+
+        # Повтор части незавершенного запуска не создает дублей
+        pending = start_payout_run(*OCTOBER)
+        compute_payout_partition(pending.pk, [self.adviser.id, self.manager.id])
+        compute_payout_partition(pending.pk, [self.adviser.id, self.manager.id])
+        self.assertEqual(PayoutLine.objects.filter(run=pending).count(), 2)
+
+    def test_partition_cost_does_not_depend_on_volume(self):
+        def partition_queries():
+            run = start_payout_run(*OCTOBER)
+            with CaptureQueriesContext(connection) as context:
+                compute_payout_partition(run.pk, [self.adviser.id, self.manager.id, self.partner.id])
+            return len(context.captured_queries)
+
+        self._commission(self.adviser, 'P-0')
+        baseline = partition_queries()
+        for i in range(1, 8):
+            commission = self._commission(self.adviser if i % 2 else self.partner, f'P-{i}')
+            Retention.objects.create(commission=commission, amount=Decimal('5.00'), reason='Hold')
+            Bonus.objects.create(commission=commission, amount=Decimal('5.00'), reason='KPI')
+        self.assertEqual(partition_queries(), baseline)
+
+        # Итог не зависит от разбиения консультантов на части
+        whole = self._lines(execute_payout_run(*OCTOBER))
+        parts = self._lines(execute_payout_run(*OCTOBER, partition_size=1))
+        self.assertEqual(
+            {adviser_id: line.net_payable for adviser_id, line in whole.items()},
+            {adviser_id: line.net_payable for adviser_id, line in parts.items()},
+        )
@@ -0,0 +1,112 @@
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from backend.apps.advisers.models import Adviser
+from backend.apps.commission.models import Advance, Commission, Repayment, Retention
+from backend.apps.policies.models import Policy
+from backend.apps.products.models import Product, ProductCategory
+
+User = get_user_model()
+
+
+class MyProfileCacheTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.manager = self._adviser('manager', None, '100.00')
+        self.adviser = self._adviser('adviser', self.manager, '80.00')
+        category = ProductCategory.objects.create(name='Life')
+        self.product = Product.objects.create(name='Term Life', category=category)
+        self.url = reverse('commission:my-profile-api')
+
+    def _adviser(self, username, parent, fee):
+        user = User.objects.create_user(username=username, password='password')
+        return Adviser.objects.create(user=user, parent_adviser=parent, fee_percentage=Decimal(fee), start_date='2023-01-01')
+
+    def _commission(self, adviser, number):
+        policy = Policy.objects.create(policy_number=number, adviser=adviser, provider='A', date_issued='2023-10-26')
+        return Commission.objects.create(
+            policy=policy, product=self.product, adviser=adviser, gross_commission=Decimal('1200.00'),
+            net_commission=Decimal('1000.00'), adviser_fee_percentage=adviser.fee_percentage, date_received='2023-10-26'
+        )
+
+    def _get(self, adviser):
+        self.client.force_authenticate(adviser.user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_profile_is_cached_and_counted(self):
+        commission = self._commission(self.adviser, 'P-1')
+        Retention.objects.create(commission=commission, amount=Decimal('50.00'), reason='Hold')
+        advance = Advance.objects.create(adviser=self.adviser, amount=Decimal('300.00'), date_issued='2023-10-01')
+        Repayment.objects.create(advance=advance, amount=Decimal('100.00'), date_repaid='2023-10-10')
+
+        first = self._get(self.adviser)
+        self.assertEqual(first['X-Cache'], 'MISS')
+        self.assertEqual(first.data['financial_summary'], {
+            'outstanding_advances': Decimal('200.00'), 'total_retentions': Decimal('50.00'),
+        })
+        self.assertEqual(first.data['statistics']['transaction_count'], 1)
+        self.assertEqual(len(first.data['recent_commissions']), 1)
+
+        second = self._get(self.adviser)
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(second.data, first.data)
+
+        admin = User.objects.create_user(username='admin', password='password', is_staff=True)
+        self.client.force_authenticate(admin)
+        stats = self.client.get(reverse('commission:my-profile-cache-stats-api')).data
+        self.assertEqual(stats, {'hits': 1, 'misses': 1})
+
+    def test_miss_query_count_does_not_depend_on_data_volume(self):
+        def miss_queries():
+            cache.clear()
+            self.client.force_authenticate(self.adviser.user)
+            with CaptureQueriesContext(connection) as context:
+                self.client.get(self.url)
+            return len(context.captured_queries)
+
+        commission = self._commission(self.adviser, 'P-1')
+        Retention.objects.create(commission=commission, amount=Decimal('10.00'), reason='Hold')
+        Advance.objects.create(adviser=self.adviser, amount=Decimal('300.00'), date_issued='2023-10-01')
+        baseline = miss_queries()
+
+        for i in range(2, 7):
+            commission = self._commission(self.adviser, f'P-{i}')
+            Retention.objects.create(commission=commission, amount=Decimal('10.00'), reason='Hold')
+            advance = Advance.objects.create(adviser=self.adviser, amount=Decimal('300.00'), date_issued='2023-10-01')
+            Repayment.objects.create(advance=advance, amount=Decimal('10.00'), date_repaid='2023-10-10')
+        self.assertEqual(miss_queries(), baseline)
+
+    def test_writes_invalidate_adviser_and_managers(self):
+        self._get(self.adviser)
+        self._get(self.manager)
+
+        advance = Advance.objects.create(adviser=self.adviser, amount=Decimal('300.00'), date_issued='2023-10-01')
+        response = self._get(self.adviser)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['financial_summary']['outstanding_advances'], Decimal('300.00'))
+        # Аванс подчиненного не влияет на профиль руководителя
+        self.assertEqual(self._get(self.manager)['X-Cache'], 'HIT')
+
+        Repayment.objects.create(advance=advance, amount=Decimal('100.00'), date_repaid='2023-10-10')
+        self.assertEqual(self._get(self.adviser).data['financial_summary']['outstanding_advances'], Decimal('200.00'))
+
+        # Комиссия и удержание подчиненного попадают в статистику руководителя
+        commission = self._commission(self.adviser, 'P-1')
+        response = self._get(self.manager)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['statistics']['transaction_count'], 1)
+
+        self._get(self.manager)
+        Retention.objects.create(commission=commission, amount=Decimal('50.00'), reason='Hold')
+        response = self._get(self.manager)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(len(response.data['recent_commissions'][0]['retentions']), 1)
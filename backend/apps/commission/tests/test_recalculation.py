@@ -0,0 +1,110 @@
+import io
+from decimal import Decimal
+from types import SimpleNamespace
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase
+
+from backend.apps.advisers.models import Adviser
+from backend.apps.commission.models import Bonus, Commission, CommissionRule, CommissionRuleSet
+from backend.apps.commission.recalculation import partition_by_adviser, recalculate_commissions
+from backend.apps.commission.rollups import check_rollups
+from backend.apps.policies.models import Policy
+from backend.apps.products.models import Product, ProductCategory
+
+User = get_user_model()
+
+
+class CommissionRecalculationTests(TestCase):
+
+    def setUp(self):
+        # Версия правил в кэше переживает откат транзакции теста
+        cache.clear()
+        self.advisers = [self._adviser(f'adviser{i}') for i in range(3)]
+        self.product = Product.objects.create(name='Term Life', category=ProductCategory.objects.create(name='Life'))
+        self.commissions = [
+            self._commission(adviser, f'P-{i}-{j}', day)
+            for i, adviser in enumerate(self.advisers)
+            for j, day in enumerate(['2023-10-05', '2023-10-20', '2023-11-02'])
+        ]
+        rule_set = CommissionRuleSet.objects.create(name='2023')
+        self.rule = CommissionRule.objects.create(
+            rule_set=rule_set, name='Month 1500', rule_type=CommissionRule.RuleType.PERFORMANCE,
+            rate=Decimal('0.0100'), threshold=Decimal('1500.00')
+        )
+
+    def _adviser(self, username):
+        user = User.objects.create_user(username=username, password='password')
+        return Adviser.objects.create(user=user, fee_percentage=Decimal('80.00'), start_date='2023-01-01')
+
+    def _commission(self, adviser, number, day):
+        policy = Policy.objects.create(policy_number=number, adviser=adviser, provider='A', date_issued=day)
+        return Commission.objects.create(
+            policy=policy, product=self.product, adviser=adviser, gross_commission=Decimal('1000.00'),
+            net_commission=Decimal('1000.00'), adviser_fee_percentage=adviser.fee_percentage, date_received=day
+        )
+
+    def _state(self):
+        return (
+            list(Commission.objects.order_by('pk').values_list('adviser_fee_percentage', 'adviser_fee_amount')),
+            list(Bonus.objects.order_by('commission_id', 'rule_id').values_list('commission_id', 'rule_id', 'amount')),
+        )
+
+    def test_dry_run_reports_changes_without_writing(self):
+        Adviser.objects.filter(pk=self.advisers[0].pk).update(fee_percentage=Decimal('90.00'))
+        before = self._state()
+
+        report = recalculate_commissions(date_from='2023-10-01', date_to='2023-10-31', refresh_rates=True, dry_run=True)
+
+        self.assertEqual(self._state(), before)
+        self.assertEqual(report['commissions'], 6)
+        self.assertEqual(report['rate_changes'], 2)
+        self.assertEqual(
+            [(c.commission_id, c.old, c.new) for c in report['fee_changes']],
+            [(self.commissions[0].pk, Decimal('800.00'), Decimal('900.00')),
+             (self.commissions[1].pk, Decimal('800.00'), Decimal('900.00'))],
+        )
+        # Правило появилось после создания комиссий: бонус за вторую продажу месяца
+        self.assertEqual(
+            {(c.commission_id, c.old, c.new) for c in report['bonus_changes']},
+            {(self.commissions[1].pk, None, Decimal('9.00'))}
+            | {(self.commissions[i].pk, None, Decimal('8.00')) for i in (4, 7)},
+        )
+
+    def test_write_matches_dry_run_and_keeps_rollups_consistent(self):
+        Adviser.objects.filter(pk=self.advisers[1].pk).update(fee_percentage=Decimal('50.00'))
+        dry = recalculate_commissions(refresh_rates=True, dry_run=True)
+        report = recalculate_commissions(refresh_rates=True, workers=2, partition_size=3)
+
+        self.assertEqual(report['fee_changes'], dry['fee_changes'])
+        self.assertEqual(report['bonus_changes'], dry['bonus_changes'])
+        self.assertEqual(
+            Commission.objects.get(pk=self.commissions[4].pk).adviser_fee_amount, Decimal('500.00')
+        )
+        self.assertEqual(Bonus.objects.get(commission=self.commissions[4], rule=self.rule).amount, Decimal('5.00'))
+        self.assertEqual(check_rollups(), [])
+
+        # Повторный запуск ничего не меняет; отключенное правило снимает свои бонусы
+        again = recalculate_commissions(refresh_rates=True)
+        self.assertEqual((again['rate_changes'], again['fee_changes'], again['bonus_changes']), (0, [], []))
+        self.rule.is_active = False
+        self.rule.save()
+        report = recalculate_commissions(adviser_ids=[self.advisers[1].pk])
+        self.assertEqual(len(report['bonus_changes']), 1)
+        self.assertFalse(Bonus.objects.filter(commission__adviser=self.advisers[1]).exists())
+        self.assertEqual(Bonus.objects.count(), 2)
+        self.assertEqual(check_rollups(), [])
+
+    def test_partitions_do_not_split_advisers(self):
+        rows = [SimpleNamespace(adviser_id=adviser_id) for adviser_id in (1, 1, 1, 2, 3, 3, 4)]
+        partitions = partition_by_adviser(rows, partition_size=2)
+        self.assertEqual([[row.adviser_id for row in part] for part in partitions], [[1, 1, 1], [2, 3, 3], [4]])
+
+    def test_command_dry_run(self):
+        out = io.StringIO()
+        call_command('recalculate_commissions', '--from', '2023-10-01', '--dry-run', '--workers', '1', stdout=out)
+        self.assertIn('бонус правила', out.getvalue())
+        self.assertIn('Будет изменено', out.getvalue())
+        self.assertFalse(Bonus.objects.exists())
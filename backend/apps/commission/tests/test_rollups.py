@@ -0,0 +1,150 @@
+import io
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.management import CommandError, call_command
+from django.db.models import Count, Sum
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from backend.apps.advisers.models import Adviser
+from backend.apps.commission.api_views import get_commissions_for_user
+from backend.apps.commission.models import AdviserMonthlySales, Bonus, Commission, CommissionDailyRollup, Retention
+from backend.apps.commission.rollups import check_monthly_sales, check_rollups
+from backend.apps.policies.models import Policy
+from backend.apps.products.models import Product, ProductCategory
+
+User = get_user_model()
+
+
+class CommissionDailyRollupTests(APITestCase):
+
+    def setUp(self):
+        self.manager = self._adviser('manager', None, '100.00')
+        self.adviser = self._adviser('adviser', self.manager, '80.00')
+        self.other = self._adviser('other', None, '90.00')
+        category = ProductCategory.objects.create(name='Life')
+        self.product = Product.objects.create(name='Term Life', category=category)
+
+    def _adviser(self, username, parent, fee):
+        user = User.objects.create_user(username=username, password='password', first_name=username.title())
+        return Adviser.objects.create(user=user, parent_adviser=parent, fee_percentage=Decimal(fee), start_date='2023-01-01')
+
+    def _commission(self, adviser, number, net='1000.00', day='2023-10-26'):
+        policy = Policy.objects.create(policy_number=number, adviser=adviser, provider='A', date_issued=day)
+        return Commission.objects.create(
+            policy=policy, product=self.product, adviser=adviser, gross_commission=Decimal('1200.00'),
+            net_commission=Decimal(net), adviser_fee_percentage=adviser.fee_percentage, date_received=day
+        )
+
+    def test_rollups_follow_commission_and_modifier_changes(self):
+        commission = self._commission(self.adviser, 'P-1')
+        self._commission(self.adviser, 'P-2', net='500.00')
+        rollup = CommissionDailyRollup.objects.get(adviser=self.adviser)
+        self.assertEqual(rollup.commission_count, 2)
+        self.assertEqual(rollup.net_total, Decimal('1500.00'))
+        self.assertEqual(rollup.fee_total, Decimal('1200.00'))
+        self.assertEqual(rollup.override_total, Decimal('300.00'))
+
+        retention = Retention.objects.create(commission=commission, amount=Decimal('50.00'), reason='Hold')
+        retention.amount = Decimal('70.00')
+        retention.save()
+        Bonus.objects.create(commission=commission, amount=Decimal('10.00'), reason='KPI')
+        self.assertEqual(check_rollups(), [])
+
+        # Смена статуса переносит комиссию вместе с модификаторами в другую строку итогов
+        commission.payment_status = Commission.PaymentStatus.PAID
+        commission.save()
+        paid = CommissionDailyRollup.objects.get(adviser=self.adviser, payment_status=Commission.PaymentStatus.PAID)
+        self.assertEqual((paid.commission_count, paid.retention_total, paid.bonus_total), (1, Decimal('70.00'), Decimal('10.00')))
+        self.assertEqual(check_rollups(), [])
+
+        retention.delete()
+        commission.delete()
+        self.assertEqual(check_rollups(), [])
+
+    def test_statistics_match_raw_aggregates(self):
+        self._commission(self.adviser, 'P-1')
+        self._commission(self.manager, 'P-2', day='2023-10-27')
+        self._commission(self.other, 'P-3')
+        former = self._commission(self.adviser, 'P-4', net='300.00')
+        # После переноса консультанта бывший руководитель видит только комиссию с его оверрайдом
+        self.adviser.parent_adviser = self.other
+        self.adviser.save()
+        self._commission(self.adviser, 'P-5')
+
+        for adviser in (self.manager, self.adviser, self.other):
+            raw = get_commissions_for_user(adviser.user).aggregate(
+                total_net_commission=Sum('net_commission'),
+                total_adviser_payout=Sum('adviser_fee_amount'),
+                transaction_count=Count('id'),
+            )
+            self.client.force_authenticate(adviser.user)
+            response = self.client.get(reverse('commission:commission-statistics-api'))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(Decimal(str(response.data['total_net_commission'])), raw['total_net_commission'])
+            self.assertEqual(Decimal(str(response.data['total_adviser_payout'])), raw['total_adviser_payout'])
+            self.assertEqual(response.data['transaction_count'], raw['transaction_count'])
+
+        self.client.force_authenticate(self.manager.user)
+        response = self.client.get(reverse('commission:top-performers-api'))
+        fees = {row['adviser__user__first_name']: row['total_fees'] for row in response.data}
+        self.assertEqual(fees, {'Manager': Decimal('1000.00'), 'Adviser': Decimal('800.00') + former.adviser_fee_amount})
+
+    def test_ingestion_keeps_rollups_consistent(self):
+        # Существующая комиссия меняет дату и сумму при повторном импорте
+        policy = Policy.objects.create(policy_number='POL-1', adviser=self.adviser, provider='A', date_issued='2023-10-26')
+        Commission.objects.create(
+            policy=policy, product=self.product, adviser=self.adviser, gross_commission=Decimal('1.00'),
+            net_commission=Decimal('1.00'), adviser_fee_percentage=self.adviser.fee_percentage, date_received='2023-10-01'
+        )
+        csv_data = (
+            "policy_number,adviser_username,product_name,provider,gross_commission,net_commission,date_received\n"
+            "POL-1,adviser,Term Life,A,1000.00,800.00,2023-10-26\n"
+            "POL-2,adviser,Term Life,A,1000.00,800.00,2023-10-26\n"
+        )
+        with mock.patch('sys.stdin', io.StringIO(csv_data)):
+            call_command('ingestion', '-', stdout=io.StringIO())
+        self.assertEqual(check_rollups(), [])
+
+    def test_rebuild_and_check_command(self):
+        self._commission(self.adviser, 'P-1')
+        expected = list(CommissionDailyRollup.objects.values().order_by('id'))
+        CommissionDailyRollup.objects.update(net_total=0)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_commission_rollups', '--check', stdout=io.StringIO())
+
+        call_command('rebuild_commission_rollups', stdout=io.StringIO())
+        call_command('rebuild_commission_rollups', '--check', stdout=io.StringIO())
+        rebuilt = list(CommissionDailyRollup.objects.values().order_by('id'))
+        self.assertEqual([{k: v for k, v in row.items() if k != 'id'} for row in rebuilt],
+                         [{k: v for k, v in row.items() if k != 'id'} for row in expected])
+
+    def test_monthly_sales_follow_commission_changes(self):
+        first = self._commission(self.adviser, 'P-1', day='2023-10-01')
+        self._commission(self.adviser, 'P-2', net='500.00', day='2023-10-31')
+        self._commission(self.adviser, 'P-3', net='200.00', day='2023-11-01')
+        october = AdviserMonthlySales.objects.get(adviser=self.adviser, month='2023-10-01')
+        self.assertEqual((october.commission_count, october.net_total), (2, Decimal('1500.00')))
+
+        # Перенос в другой месяц и удаление переносят и снимают продажи
+        first.date_received = '2023-11-15'
+        first.save()
+        first.refresh_from_db()
+        first.delete()
+        sales = dict(AdviserMonthlySales.objects.filter(adviser=self.adviser).values_list('month__month', 'net_total'))
+        self.assertEqual(sales, {10: Decimal('500.00'), 11: Decimal('200.00')})
+        self.assertEqual(check_monthly_sales(), [])
+
+    def test_rebuild_monthly_sales_command(self):
+        self._commission(self.adviser, 'P-1', day='2023-09-10')
+        self._commission(self.adviser, 'P-2', day='2023-10-10')
+        AdviserMonthlySales.objects.all().delete()
+        with self.assertRaises(CommandError):
+            call_command('rebuild_monthly_sales', '--check', stdout=io.StringIO())
+
+        call_command('rebuild_monthly_sales', '--since', '2023-10', stdout=io.StringIO())
+        self.assertEqual(list(AdviserMonthlySales.objects.values_list('month__month', flat=True)), [10])
+        call_command('rebuild_monthly_sales', stdout=io.StringIO())
+        call_command('rebuild_monthly_sales', '--check', stdout=io.StringIO())
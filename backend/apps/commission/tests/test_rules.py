@@ -0,0 +1,119 @@
+from datetime import date
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+
+from backend.apps.advisers.models import Adviser
+from backend.apps.commission.models import AdviserMonthlySales, Bonus, Commission, CommissionRule, CommissionRuleSet
+from backend.apps.commission.rollups import check_rollups, rebuild_monthly_sales, rebuild_rollups
+from backend.apps.commission.rules_engine import EvaluationContext, apply_rules, get_evaluator
+from backend.apps.policies.models import Policy
+from backend.apps.products.models import Product, ProductCategory
+
+User = get_user_model()
+
+
+class CommissionRuleEngineTests(TestCase):
+
+    def setUp(self):
+        # Версия правил в кэше переживает откат транзакции теста
+        cache.clear()
+        user = User.objects.create_user(username='adviser', password='password')
+        self.adviser = Adviser.objects.create(user=user, fee_percentage=Decimal('80.00'), start_date='2023-01-01')
+        self.life = Product.objects.create(name='Term Life', category=ProductCategory.objects.create(name='Life'))
+        self.pension = Product.objects.create(name='SIPP', category=ProductCategory.objects.create(name='Pension'))
+        self.rule_set = CommissionRuleSet.objects.create(name='2023')
+
+    def _rule(self, name, rule_type, rate, threshold=None, categories=None):
+        return CommissionRule.objects.create(
+            rule_set=self.rule_set, name=name, rule_type=rule_type, rate=Decimal(rate),
+            threshold=threshold, categories=categories or []
+        )
+
+    def _commission(self, number, product, net, day='2023-10-26'):
+        policy = Policy.objects.create(policy_number=number, adviser=self.adviser, provider='A', date_issued=day)
+        return Commission.objects.create(
+            policy=policy, product=product, adviser=self.adviser, gross_commission=Decimal(net),
+            net_commission=Decimal(net), adviser_fee_percentage=self.adviser.fee_percentage, date_received=day
+        )
+
+    def _bonuses(self, commission):
+        return dict(Bonus.objects.filter(commission=commission).values_list('rule__name', 'amount'))
+
+    def test_rules_are_applied_on_commission_creation(self):
+        self._rule('Life', CommissionRule.RuleType.PRODUCT_CATEGORY, '0.0500', categories=['Life'])
+        self._rule('Big deal', CommissionRule.RuleType.NET_THRESHOLD, '0.0100', threshold=Decimal('1000.00'))
+        self._rule('Month 1500', CommissionRule.RuleType.PERFORMANCE, '0.0200', threshold=Decimal('1500.00'))
+
+        first = self._commission('P-1', self.life, '1000.00', day='2023-10-01')
+        second = self._commission('P-2', self.pension, '600.00', day='2023-10-20')
+        # Продажи прошлого месяца в KPI не входят
+        third = self._commission('P-3', self.pension, '500.00', day='2023-11-02')
+
+        self.assertEqual(self._bonuses(first), {'Life': Decimal('40.00'), 'Big deal': Decimal('8.00')})
+        self.assertEqual(self._bonuses(second), {'Month 1500': Decimal('9.60')})
+        self.assertEqual(self._bonuses(third), {})
+        self.assertEqual(check_rollups(), [])
+
+    def test_reapply_upserts_and_removes_stale_bonuses(self):
+        rule = self._rule('Life', CommissionRule.RuleType.PRODUCT_CATEGORY, '0.0500', categories=['Life'])
+        commission = self._commission('P-1', self.life, '1000.00')
+        manual = Bonus.objects.create(commission=commission, amount=Decimal('5.00'), reason='Manual')
+
+        rule.rate = Decimal('0.1000')
+        rule.save()
+        apply_rules([commission])
+        apply_rules([commission])
+        self.assertEqual(self._bonuses(commission), {'Life': Decimal('80.00'), None: Decimal('5.00')})
+
+        rule.is_active = False
+        rule.save()
+        apply_rules([commission])
+        self.assertEqual(list(Bonus.objects.filter(commission=commission)), [manual])
+        self.assertEqual(check_rollups(), [])
+
+    def test_evaluator_is_compiled_once_and_recompiled_on_change(self):
+        rule = self._rule('Big deal', CommissionRule.RuleType.NET_THRESHOLD, '0.0100', threshold=Decimal('1000.00'))
+        evaluator = get_evaluator()
+        with self.assertNumQueries(0):
+            self.assertIs(get_evaluator(), evaluator)
+
+        rule.threshold = Decimal('2000.00')
+        rule.save()
+        recompiled = get_evaluator()
+        self.assertIsNot(recompiled, evaluator)
+        commission = self._commission('P-1', self.life, '1000.00')
+        self.assertEqual(self._bonuses(commission), {})
+
+    def test_rules_are_invalidated_again_after_commit(self):
+        rule = self._rule('Big deal', CommissionRule.RuleType.NET_THRESHOLD, '0.0100', threshold=Decimal('1000.00'))
+        with self.captureOnCommitCallbacks(execute=True):
+            rule.threshold = Decimal('2000.00')
+            rule.save()
+            # Процесс, скомпилировавший правила до коммита, мог увидеть старые
+            before_commit = get_evaluator()
+        self.assertIsNot(get_evaluator(), before_commit)
+
+    def test_performance_kpi_counts_direct_sales_like_monthly_accumulator(self):
+        self._rule('Month 1500', CommissionRule.RuleType.PERFORMANCE, '0.0200', threshold=Decimal('1500.00'))
+        override = self._commission('P-1', self.life, '1000.00', day='2023-10-01')
+        Commission.objects.filter(pk=override.pk).update(commission_type=Commission.CommissionType.OVERRIDE)
+        # Отмененная прямая комиссия остается продажей, как в AdviserMonthlySales
+        self._commission('P-2', self.life, '900.00', day='2023-10-05')
+        Commission.objects.filter(policy__policy_number='P-2').update(payment_status=Commission.PaymentStatus.CANCELLED)
+        rebuild_rollups()
+        rebuild_monthly_sales()
+
+        second = self._commission('P-3', self.pension, '500.00', day='2023-10-20')
+        self.assertEqual(self._bonuses(second), {})
+        third = self._commission('P-4', self.pension, '100.00', day='2023-10-25')
+        self.assertEqual(self._bonuses(third), {'Month 1500': Decimal('1.60')})
+
+        # На конец месяца KPI совпадает с накопленными продажами месяца
+        context = EvaluationContext.load([third], {CommissionRule.RuleType.PERFORMANCE})
+        self.assertEqual(
+            context.monthly_sales(Commission(adviser_id=self.adviser.pk, date_received=date(2023, 10, 31))),
+            AdviserMonthlySales.objects.get(adviser=self.adviser).net_total,
+        )
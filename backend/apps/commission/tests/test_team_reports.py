@@ -0,0 +1,93 @@
+import csv
+import io
+from datetime import date
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core import mail
+from django.test import TestCase
+from django.utils import translation
+
+from backend.apps.advisers.models import Adviser
+from backend.apps.commission import team_reports
+from backend.apps.commission.models import Commission
+from backend.apps.commission.team_reports import send_team_reports
+from backend.apps.policies.models import Policy
+from backend.apps.products.models import Product, ProductCategory
+
+User = get_user_model()
+
+
+class TeamReportTests(TestCase):
+
+    def setUp(self):
+        # Скомпилированные правила и значки переживают откат транзакции теста
+        cache.clear()
+        self.product = Product.objects.create(name='Term Life', category=ProductCategory.objects.create(name='Life'))
+        self.director = self._adviser('director', None, email='director@example.com')
+        self.manager = self._adviser('manager', self.director, email='manager@example.com')
+        self.adviser = self._adviser('adviser', self.manager)
+        self._adviser('silent', None, email='')
+
+    def _adviser(self, username, parent, email=''):
+        user = User.objects.create_user(username=username, password='password', email=email, first_name=username.title())
+        return Adviser.objects.create(user=user, parent_adviser=parent, fee_percentage=Decimal('80.00'), start_date='2023-01-01')
+
+    def _commission(self, adviser, number, day, status=Commission.PaymentStatus.PAID, net='1000.00'):
+        policy = Policy.objects.create(policy_number=number, adviser=adviser, provider='A', date_issued=day)
+        return Commission.objects.create(
+            policy=policy, product=self.product, adviser=adviser, gross_commission=Decimal(net),
+            net_commission=Decimal(net), adviser_fee_percentage=adviser.fee_percentage, date_received=day,
+            payment_status=status,
+        )
+
+    def _attachment_rows(self, message):
+        name, content, mimetype = message.attachments[0]
+        self.assertEqual(mimetype, 'text/csv')
+        return list(csv.reader(io.StringIO(content)))[1:]
+
+    def test_reports_contain_team_totals_and_csv_details(self):
+        self._commission(self.adviser, 'P-1', '2023-10-02')
+        self._commission(self.adviser, 'P-2', '2023-10-20', net='500.00')
+        self._commission(self.manager, 'P-3', '2023-10-05')
+        self._commission(self.adviser, 'P-4', '2023-10-06', status=Commission.PaymentStatus.PENDING)
+        self._commission(self.adviser, 'P-5', '2023-09-30')
+
+        # Суммы в письме не локализуются: в локали проекта floatformat дал бы "1500,00"
+        with translation.override('ru'):
+            sent = send_team_reports(date(2023, 11, 1), date_from=date(2023, 10, 1), date_to=date(2023, 10, 31))
+
+        self.assertEqual(sent, 2)
+        messages = {message.to[0]: message for message in mail.outbox}
+        manager_report = messages['manager@example.com']
+        self.assertIn('Adviser | Commissions: 2 | Net: £1500.00 | Paid to adviser: £1200.00', manager_report.body)
+        self.assertIn('Total paid commission amount for your team: £2000.00', manager_report.body)
+        self.assertEqual([row[0] for row in self._attachment_rows(manager_report)], ['P-1', 'P-3', 'P-2'])
+        self.assertNotIn('P-1', manager_report.body)
+
+        director_report = messages['director@example.com']
+        self.assertIn('Total commissions: 3', director_report.body)
+        self.assertEqual(len(self._attachment_rows(director_report)), 3)
+
+    def test_one_connection_and_constant_aggregation_per_batch(self):
+        for i in range(4):
+            manager = self._adviser(f'manager{i}', self.director, email=f'manager{i}@example.com')
+            self._adviser(f'adviser{i}', manager)
+            self._commission(manager, f'P-{i}', '2023-10-02')
+
+        with mock.patch.object(team_reports, 'get_connection', wraps=team_reports.get_connection) as get_connection, \
+                mock.patch.object(team_reports, 'team_member_totals', wraps=team_reports.team_member_totals) as totals:
+            sent = send_team_reports(date(2023, 11, 1), batch_size=4)
+
+        self.assertEqual(sent, 6)
+        self.assertEqual(len(mail.outbox), 6)
+        self.assertEqual(get_connection.call_count, 2)
+        self.assertEqual(totals.call_count, 2)
+
+    def test_team_without_paid_commissions(self):
+        send_team_reports(date(2023, 11, 1), manager_ids=[self.manager.id])
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('No paid commissions found', mail.outbox[0].body)
+        self.assertEqual(self._attachment_rows(mail.outbox[0]), [])
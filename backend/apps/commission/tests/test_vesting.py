@@ -0,0 +1,73 @@
+from datetime import date
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from backend.apps.advisers.models import Adviser
+from backend.apps.commission.models import Commission, ScheduledPayout, VestingSchedule
+from backend.apps.commission.vesting import generate_scheduled_payouts, mark_due_payouts, vesting_installments
+from backend.apps.policies.models import Policy
+from backend.apps.products.models import Product, ProductCategory
+
+User = get_user_model()
+
+
+class VestingTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username='adviser', password='password')
+        self.adviser = Adviser.objects.create(user=user, fee_percentage=Decimal('100.00'), start_date='2023-01-01')
+        self.product = Product.objects.create(name='Term Life', category=ProductCategory.objects.create(name='Life'))
+        self.schedule = VestingSchedule.objects.create(name='Annual', vesting_period_months=12, cliff_months=3)
+
+    def _commission(self, number, net='1000.00', day='2023-01-31'):
+        policy = Policy.objects.create(policy_number=number, adviser=self.adviser, provider='A', date_issued=day)
+        return Commission.objects.create(
+            policy=policy, product=self.product, adviser=self.adviser, gross_commission=Decimal(net),
+            net_commission=Decimal(net), adviser_fee_percentage=self.adviser.fee_percentage, date_received=day
+        )
+
+    def test_installments_respect_cliff_and_sum_to_total(self):
+        installments = vesting_installments(self.schedule, Decimal('1000.00'), date(2023, 1, 31))
+        self.assertEqual(installments[0], (date(2023, 4, 30), Decimal('249.99')))
+        self.assertEqual(installments[1], (date(2023, 5, 31), Decimal('83.33')))
+        self.assertEqual(installments[-1], (date(2024, 1, 31), Decimal('83.37')))
+        self.assertEqual(len(installments), 10)
+        self.assertEqual(sum(amount for _, amount in installments), Decimal('1000.00'))
+
+        immediate = VestingSchedule(name='Now', vesting_period_months=0)
+        self.assertEqual(vesting_installments(immediate, Decimal('10'), date(2023, 1, 1)), [(date(2023, 1, 1), Decimal('10.00'))])
+
+    def test_payouts_are_generated_in_bulk_once(self):
+        commissions = [self._commission(f'P-{i}') for i in range(5)]
+        with CaptureQueriesContext(connection) as context:
+            created = generate_scheduled_payouts(
+                self.schedule, Commission.objects.all(), amounts={commissions[0].id: Decimal('120.00')}, batch_size=20,
+            )
+        self.assertEqual(created, 50)
+        # Выборка комиссий и по INSERT на пакет выплат, а не на выплату
+        self.assertLessEqual(len(context.captured_queries), 5)
+        self.assertEqual(
+            sum(payout.amount for payout in ScheduledPayout.objects.filter(commission=commissions[0])), Decimal('120.00')
+        )
+
+        self._commission('P-new')
+        self.assertEqual(generate_scheduled_payouts(self.schedule, Commission.objects.all()), 10)
+        self.assertEqual(ScheduledPayout.objects.count(), 60)
+
+    def test_due_payouts_are_marked_in_chunks(self):
+        commissions = Commission.objects.filter(pk__in=[self._commission(f'P-{i}').pk for i in range(3)])
+        generate_scheduled_payouts(self.schedule, commissions)
+
+        with CaptureQueriesContext(connection) as context:
+            marked = mark_due_payouts(date(2023, 6, 30), chunk_size=4)
+        # Наступили выплаты апреля, мая и июня: 9 строк — три порции и пустая выборка
+        self.assertEqual(marked, 9)
+        self.assertEqual(sum('UPDATE' in query['sql'] for query in context.captured_queries), 3)
+        self.assertEqual(ScheduledPayout.objects.filter(is_paid=True, payout_date__gt=date(2023, 6, 30)).count(), 0)
+        self.assertEqual(mark_due_payouts(date(2023, 6, 30)), 0)
@@ -0,0 +1,87 @@
+from decimal import Decimal
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.test import TestCase
+
+from backend.apps.advisers.models import Adviser, AdviserHierarchy
+from backend.apps.commission.api_views import get_commissions_for_user
+from backend.apps.commission.models import Commission
+from backend.apps.policies.models import Policy
+from backend.apps.products.models import Product, ProductCategory
+
+User = get_user_model()
+
+
+class HierarchyClosureTests(TestCase):
+
+    def setUp(self):
+        # Скомпилированные правила и значки переживают откат транзакции теста
+        cache.clear()
+        self.director = self._adviser('director', None, '100.00')
+        self.manager = self._adviser('manager', self.director, '90.00')
+        self.adviser = self._adviser('adviser', self.manager, '80.00')
+        self.other = self._adviser('other', None, '80.00')
+        category = ProductCategory.objects.create(name='Life')
+        self.product = Product.objects.create(name='Term Life', category=category)
+
+    def _adviser(self, username, parent, fee):
+        user = User.objects.create_user(username=username, password='password')
+        return Adviser.objects.create(user=user, parent_adviser=parent, fee_percentage=Decimal(fee), start_date='2023-01-01')
+
+    def _commission(self, adviser, number):
+        policy = Policy.objects.create(policy_number=number, adviser=adviser, provider='A', date_issued='2023-01-01')
+        return Commission.objects.create(
+            policy=policy, product=self.product, adviser=adviser, gross_commission=Decimal('100.00'),
+            net_commission=Decimal('100.00'), adviser_fee_percentage=adviser.fee_percentage, date_received='2023-01-01'
+        )
+
+    def _links(self):
+        return set(AdviserHierarchy.objects.values_list('ancestor_id', 'descendant_id', 'depth'))
+
+    def test_closure_is_maintained_on_create_and_move(self):
+        self.assertIn((self.director.id, self.adviser.id, 2), self._links())
+
+        self.manager.parent_adviser = self.other
+        self.manager.save()
+        links = self._links()
+        self.assertIn((self.other.id, self.adviser.id, 2), links)
+        self.assertNotIn((self.director.id, self.adviser.id, 2), links)
+        self.assertNotIn((self.director.id, self.manager.id, 1), links)
+
+    def test_cycle_is_rejected(self):
+        self.director.parent_adviser = self.adviser
+        with self.assertRaises(ValidationError):
+            self.director.save()
+
+    def test_delete_detaches_subtree(self):
+        self.manager.delete()
+        self.assertNotIn((self.director.id, self.adviser.id, 2), self._links())
+        self.assertIn((self.adviser.id, self.adviser.id, 0), self._links())
+
+    def test_rebuild_command_matches_incremental_maintenance(self):
+        expected = self._links()
+        AdviserHierarchy.objects.all().delete()
+        call_command('rebuild_adviser_hierarchy', stdout=StringIO())
+        self.assertEqual(self._links(), expected)
+
+    def test_visibility_covers_whole_subtree_without_distinct(self):
+        own = self._commission(self.adviser, 'P-1')
+        manager_own = self._commission(self.manager, 'P-2')
+        foreign = self._commission(self.other, 'P-3')
+
+        queryset = get_commissions_for_user(self.director.user)
+        self.assertEqual(set(queryset.values_list('id', flat=True)), {own.id, manager_own.id})
+        self.assertNotIn('DISTINCT', str(queryset.query))
+        self.assertEqual(set(get_commissions_for_user(self.adviser.user).values_list('id', flat=True)), {own.id})
+        self.assertEqual(set(get_commissions_for_user(self.other.user).values_list('id', flat=True)), {foreign.id})
+
+    def test_former_manager_keeps_override_commissions(self):
+        commission = self._commission(self.adviser, 'P-1')
+        self.adviser.parent_adviser = self.other
+        self.adviser.save()
+        # manager больше не руководитель, но получает оверрайд по старой комиссии
+        self.assertIn(commission.id, get_commissions_for_user(self.manager.user).values_list('id', flat=True))
@@ -11,9 +11,11 @@ api_router.register(r'retentions', api_views.RetentionViewSet, basename='retenti
 api_router.register(r'clawbacks', api_views.ClawbackViewSet, basename='clawback')
 api_router.register(r'splits', api_views.CommissionSplitViewSet, basename='split')
 api_router.register(r'advances', api_views.AdvanceViewSet, basename='advance')
+api_router.register(r'outstanding-advances', api_views.OutstandingAdvanceViewSet, basename='outstanding-advance')
 api_router.register(r'repayments', api_views.RepaymentViewSet, basename='repayment')
 api_router.register(r'bonuses', api_views.CommissionBonusViewSet, basename='bonus')
 api_router.register(r'referral-fees', api_views.ReferralFeeViewSet, basename='referralfee')
+api_router.register(r'payout-runs', api_views.PayoutRunViewSet, basename='payout-run')
 api_router.register(r'vesting-schedules', api_views.VestingScheduleViewSet, basename='vesting-schedule')
 api_router.register(r'scheduled-payouts', api_views.ScheduledPayoutViewSet, basename='scheduled-payout')
 
@@ -22,5 +24,7 @@ urlpatterns = [
     path("statistics/", api_views.CommissionStatisticsAPIView.as_view(), name="commission-statistics-api"),
     path("top-performers/", api_views.TopPerformersAPIView.as_view(), name="top-performers-api"),
     path("commission-calculator/", api_views.CommissionCalculatorAPIView.as_view(), name="commission-calculator-api"),
+    path("commission-calculator/batch/", api_views.CommissionCalculatorBatchAPIView.as_view(), name="commission-calculator-batch-api"),
     path("my-profile/", api_views.MyProfileAPIView.as_view(), name="my-profile-api"),
+    path("my-profile/cache-stats/", api_views.ProfileCacheStatsAPIView.as_view(), name="my-profile-cache-stats-api"),
 ]
@@ -0,0 +1,102 @@
+"""
+Выплаты по графикам вестинга.
+
+График (VestingSchedule) разворачивается в помесячные выплаты ScheduledPayout:
+сумма делится поровну на vesting_period_months месяцев, выплаты до окончания
+cliff_months накапливаются и выплачиваются одной суммой в месяц окончания cliff,
+остаток от округления уходит в последнюю выплату. Выплаты для любого числа
+комиссий создаются пакетами bulk_create; комиссии, у которых выплаты по
+графику уже есть, пропускаются, поэтому повторный запуск безопасен.
+
+Наступившие невыплаченные выплаты выбираются по индексу (is_paid, payout_date)
+и отмечаются выплаченными порциями, каждая в своей короткой транзакции.
+"""
+import calendar
+from decimal import ROUND_DOWN, Decimal
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import ScheduledPayout
+from .rollups import CENT
+
+
+# Сколько выплат создается одним bulk_create
+PAYOUT_BATCH_SIZE = 2000
+
+# Сколько выплат отмечается одним UPDATE
+DUE_PAYOUT_CHUNK_SIZE = 5000
+
+
+def add_months(day, months):
+    """Дата через `months` месяцев; день ограничивается длиной месяца."""
+    index = day.month - 1 + months
+    year, month = day.year + index // 12, index % 12 + 1
+    return day.replace(year=year, month=month, day=min(day.day, calendar.monthrange(year, month)[1]))
+
+
+def vesting_installments(schedule, total, start):
+    """Выплаты графика для суммы `total`, начиная с `start`: [(дата, сумма)]."""
+    total = Decimal(total).quantize(CENT)
+    months = schedule.vesting_period_months
+    if months <= 0:
+        return [(start, total)]
+    cliff = min(max(schedule.cliff_months, 1), months)
+    share = (total / months).quantize(CENT, rounding=ROUND_DOWN)
+    installments, vested = [], Decimal('0.00')
+    for month in range(cliff, months + 1):
+        target = total if month == months else share * month
+        if target != vested:
+            installments.append((add_months(start, month), target - vested))
+        vested = target
+    return installments
+
+
+def generate_scheduled_payouts(schedule, commissions, amounts=None, batch_size=PAYOUT_BATCH_SIZE):
+    """
+    Создает выплаты графика `schedule` для комиссий из queryset `commissions`.
+    Сумма — `amounts[commission_id]`, по умолчанию вознаграждение консультанта
+    (adviser_fee_amount); график отсчитывается от даты получения комиссии.
+    Возвращает количество созданных выплат.
+    """
+    rows = commissions.exclude(scheduled_payouts__schedule=schedule).order_by('id').values_list(
+        'id', 'date_received', 'adviser_fee_amount'
+    )
+    created, payouts = 0, []
+    for commission_id, date_received, fee in rows.iterator(chunk_size=batch_size):
+        total = amounts.get(commission_id, fee) if amounts is not None else fee
+        payouts.extend(
+            ScheduledPayout(schedule=schedule, commission_id=commission_id, payout_date=payout_date, amount=amount)
+            for payout_date, amount in vesting_installments(schedule, total, date_received)
+        )
+        if len(payouts) >= batch_size:
+            ScheduledPayout.objects.bulk_create(payouts, ignore_conflicts=True)
+            created, payouts = created + len(payouts), []
+    if payouts:
+        ScheduledPayout.objects.bulk_create(payouts, ignore_conflicts=True)
+        created += len(payouts)
+    return created
+
+
+def due_payouts(as_of):
+    """Невыплаченные выплаты со сроком не позже `as_of` (индекс scheduled_payout_due)."""
+    return ScheduledPayout.objects.filter(is_paid=False, payout_date__lte=as_of)
+
+
+def mark_due_payouts(as_of=None, chunk_size=DUE_PAYOUT_CHUNK_SIZE):
+    """
+    Отмечает наступившие выплаты выплаченными порциями по `chunk_size`, не загружая
+    их целиком. Занятые параллельным запуском строки пропускаются. Возвращает количество.
+    """
+    as_of = as_of or timezone.now().date()
+    marked = 0
+    while True:
+        with transaction.atomic():
+            ids = list(
+                due_payouts(as_of).select_for_update(skip_locked=True).order_by(
+                    'payout_date', 'id'
+                ).values_list('id', flat=True)[:chunk_size]
+            )
+            if not ids:
+                return marked
+            marked += ScheduledPayout.objects.filter(pk__in=ids, is_paid=False).update(is_paid=True)
@@ -57,6 +57,12 @@ class Adviser(models.Model):
         validators=[MinValueValidator(Decimal('0.00')), MaxValueValidator(Decimal('100.00'))],
         help_text="Default percentage of the net commission the adviser earns."
     )
+    default_override_percentage = models.DecimalField(
+        max_digits=5, decimal_places=2,
+        default=0.00,
+        validators=[MinValueValidator(Decimal('0.00')), MaxValueValidator(Decimal('100.00'))],
+        help_text="Percentage of subordinates' net commission paid to this adviser as an override."
+    )
 
     manager = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='subordinates')
     role = models.CharField(max_length=20, choices=Role.choices, default=Role.ADVISER)
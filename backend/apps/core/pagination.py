@@ -0,0 +1,201 @@
+"""
+Keyset-пагинация (по курсору) для списков.
+
+В отличие от LIMIT/OFFSET страница выбирается условием по ключу сортировки
+последней строки предыдущей страницы, например
+(date_received, id) < (курсор.date_received, курсор.id), поэтому стоимость
+страницы не зависит от глубины. COUNT(*) не выполняется.
+
+Подключается к представлению явно (pagination_class), глобально не включена,
+чтобы не менять формат ответа остальных списков.
+
+Сортировка берется из `keyset_ordering` представления (по умолчанию по id);
+последнее поле должно быть уникальным. Если у представления есть OrderingFilter
+и клиент передал ?ordering=, сортировка идет по выбранному полю с id как
+уточняющим ключом. NULL всегда идут в конце.
+"""
+import base64
+import binascii
+import datetime
+import json
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    page_size = api_settings.PAGE_SIZE or 50
+    page_size_query_param = 'page_size'
+    # Жесткий предел размера ответа, независимо от ?page_size=
+    max_page_size = 500
+    cursor_query_param = 'cursor'
+    ordering = ('-id',)
+    invalid_cursor_message = 'Некорректный курсор.'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.model = queryset.model
+        self.fields = self.get_ordering_fields(request, queryset, view)
+        values, self.reverse = self.decode_cursor(request)
+
+        if values is not None:
+            queryset = queryset.filter(self._after(values, self.reverse))
+        queryset = queryset.order_by(*self._order_by(self.reverse))
+
+        rows = list(queryset[:self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if self.reverse:
+            rows.reverse()
+
+        # Назад: следующая страница есть всегда (мы пришли с нее); вперед: предыдущая есть, если был курсор
+        self.has_next = (has_more and not self.reverse) or (self.reverse and values is not None)
+        self.has_previous = (has_more and self.reverse) or (not self.reverse and values is not None)
+        self.first_row = rows[0] if rows else None
+        self.last_row = rows[-1] if rows else None
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_ordering_fields(self, request, queryset, view):
+        """Возвращает [(поле, по убыванию, допускает NULL)]."""
+        ordering = list(getattr(view, 'keyset_ordering', self.ordering))
+        if view is not None and any(
+            issubclass(backend, OrderingFilter) for backend in getattr(view, 'filter_backends', [])
+        ) and request.query_params.get(api_settings.ORDERING_PARAM):
+            requested = OrderingFilter().get_ordering(request, queryset, view)
+            if requested:
+                field = requested[0]
+                ordering = [field, '-id' if field.startswith('-') else 'id']
+
+        fields = []
+        for term in ordering:
+            name = term.lstrip('-')
+            fields.append((name, term.startswith('-'), self._model_field(queryset.model, name).null))
+        return fields
+
+    @staticmethod
+    def _model_field(model, name):
+        field = None
+        for part in name.split('__'):
+            field = model._meta.get_field(part)
+            model = field.related_model
+        return field
+
+    def _order_by(self, reverse):
+        expressions = []
+        for name, descending, _ in self.fields:
+            # При обратном обходе порядок (и положение NULL) зеркальный
+            descending = descending != reverse
+            expression = F(name).desc if descending else F(name).asc
+            expressions.append(expression(nulls_first=True) if reverse else expression(nulls_last=True))
+        return expressions
+
+    def _after(self, values, reverse):
+        """Условие "строка идет после курсора" в порядке обхода, лексикографически по всем полям."""
+        condition = Q(pk__in=[])
+        equal = Q()
+        for (name, descending, nullable), value in zip(self.fields, values):
+            lookup = 'lt' if descending != reverse else 'gt'
+            if value is None:
+                # Вперед NULL в конце, после них по этому полю ничего нет; назад — в начале
+                if reverse:
+                    condition |= equal & Q(**{f'{name}__isnull': False})
+                equal &= Q(**{f'{name}__isnull': True})
+            else:
+                after = Q(**{f'{name}__{lookup}': value})
+                if nullable and not reverse:
+                    after |= Q(**{f'{name}__isnull': True})
+                condition |= equal & after
+                equal &= Q(**{name: value})
+        return condition
+
+    @staticmethod
+    def _row_value(row, name):
+        if isinstance(row, dict):
+            return row[name]
+        for part in name.split('__'):
+            row = getattr(row, part)
+            if row is None:
+                break
+        return getattr(row, 'pk', row)
+
+    @staticmethod
+    def _encode_value(value):
+        if isinstance(value, (datetime.date, datetime.datetime, datetime.time)):
+            return value.isoformat()
+        if isinstance(value, Decimal):
+            return str(value)
+        return value
+
+    def encode_cursor(self, row, reverse):
+        values = [self._encode_value(self._row_value(row, name)) for name, _, _ in self.fields]
+        payload = json.dumps({'v': values, 'r': int(reverse)}, separators=(',', ':'))
+        cursor = base64.urlsafe_b64encode(payload.encode()).decode()
+        return replace_query_param(self.base_url, self.cursor_query_param, cursor)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+            values, reverse = payload['v'], bool(payload['r'])
+        except (TypeError, ValueError, KeyError, binascii.Error, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(self.fields):
+            raise NotFound(self.invalid_cursor_message)
+        # Значения курсора попадают в filter(), поэтому приводятся к типам полей сортировки
+        try:
+            values = [
+                None if value is None else self._model_field(self.model, name).to_python(value)
+                for (name, _, _), value in zip(self.fields, values)
+            ]
+        except (ValidationError, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        return values, reverse
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if self.last_row is None:
+            # Пустая страница при обратном обходе: начинаем сначала
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.last_row, reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or self.first_row is None:
+            return None
+        return self.encode_cursor(self.first_row, reverse=True)
@@ -0,0 +1,59 @@
+"""
+Рассылка напоминаний консультантам дайджестами.
+
+Объекты, по которым пора напомнить (полисы к продлению, истекающие ипотеки),
+читаются потоком (iterator) вместе с консультантом и клиентом, сгруппированными
+по консультанту. Каждый консультант получает одно письмо со списком всех своих
+объектов. Письма уходят пакетами через одно SMTP-соединение на всю рассылку,
+после отправки пакета флаги его объектов проставляются одним UPDATE. Если
+отправка пакета упала, флаги этого пакета не ставятся и объекты попадут в
+следующую рассылку.
+"""
+from itertools import groupby
+
+from django.core.mail import EmailMessage, get_connection
+from django.utils import timezone
+
+# Сколько объектов (не писем) отправляется и помечается за один пакет
+REMINDER_BATCH_SIZE = 500
+
+
+def _digest(adviser, items, subject, intro, describe):
+    lines = '\n'.join(f'- {describe(item)}' for item in items)
+    return EmailMessage(
+        subject,
+        f'Dear {adviser.user.get_full_name()},\n\n{intro}\n\n{lines}',
+        None,  # DEFAULT_FROM_EMAIL
+        [adviser.user.email],
+    )
+
+
+def send_reminder_digests(due, *, subject, intro, describe, sent_flag, sent_date, batch_size=REMINDER_BATCH_SIZE):
+    """
+    Рассылает дайджесты по объектам `due` (QuerySet модели с полем adviser)
+    и помечает их отправленными: `sent_flag` = True, `sent_date` = сегодня.
+    `describe(obj)` — строка об объекте в письме. Возвращает число объектов.
+    """
+    due = due.filter(adviser__user__email__gt='').select_related('adviser__user', 'client').order_by('adviser_id', 'pk')
+    model = due.model
+    today = timezone.now().date()
+    count = 0
+
+    def flush(connection, messages, ids):
+        connection.send_messages(messages)
+        model.objects.filter(pk__in=ids).update(**{sent_flag: True, sent_date: today})
+
+    with get_connection() as connection:
+        messages, ids = [], []
+        for _, group in groupby(due.iterator(chunk_size=batch_size), key=lambda obj: obj.adviser_id):
+            items = list(group)
+            messages.append(_digest(items[0].adviser, items, subject, intro, describe))
+            ids.extend(item.pk for item in items)
+            if len(ids) >= batch_size:
+                flush(connection, messages, ids)
+                count += len(ids)
+                messages, ids = [], []
+        if messages:
+            flush(connection, messages, ids)
+            count += len(ids)
+    return count
@@ -58,15 +58,22 @@ class BaseDataIngestionViewSet(mixins.RetrieveModelMixin, viewsets.ViewSet):
     """
     permission_classes = [permissions.IsAdminUser]
 
+    def get_task_payload(self, validated_data, task_instance):
+        """
+        Данные, передаваемые в задачу через брокер. Должны сериализоваться в JSON:
+        загруженные файлы сохраняются в хранилище, в задачу уходит только ссылка.
+        """
+        return validated_data
+
     def create(self, request, *args, **kwargs):
         """Запускает асинхронную задачу по импорту данных."""
         serializer = self.ingestion_serializer_class(data=request.data)
         serializer.is_valid(raise_exception=True)
+        # Запись о задаче создается до запуска, чтобы воркер (или eager-режим) нашел ее по id
+        task_instance = self.queryset.model.objects.create(created_by=request.user)
         # Передаем ID пользователя, чтобы связать задачу с ним
-        task = self.task_function.delay(serializer.validated_data, request.user.id)
-
-        # Со��даем запись о задаче в БД
-        task_instance = self.queryset.model.objects.create(id=task.id, created_by=request.user)
+        self.task_function.delay(self.get_task_payload(serializer.validated_data, task_instance), request.user.id)
+        task_instance.refresh_from_db()
 
         response_serializer = self.serializer_class(task_instance)
         return Response(response_serializer.data, status=status.HTTP_202_ACCEPTED)
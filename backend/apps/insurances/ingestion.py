@@ -1,82 +1,334 @@
+"""
+Импорт выписок страховщиков с комиссиями (CSV).
+
+Строки обрабатываются чанками, каждый чанк — в своей транзакции: номера
+полисов чанка разрешаются одним запросом IN (вместе со страховщиком, типом
+страхования и консультантом), суммы считаются в памяти, а комиссии пишутся
+bulk_create/bulk_update. Ошибки строк собираются с номерами строк файла;
+ошибка записи откатывает только свой чанк.
+
+Загруженная выписка сохраняется в файловое хранилище (save_statement_upload),
+в задачу Celery передается только имя файла; файл читается потоково
+(process_statement_file), так что память не зависит от размера выписки.
+
+Для параллельной обработки выписка разрезается на файлы-части по
+STATEMENT_CHUNK_SIZE строк (split_statement); части обрабатываются
+независимыми подзадачами (process_statement_part), каждая добавляет свой
+прогресс в InsuranceIngestionTask, итог сводит merge_results. Порядок
+частей не гарантирован: если полис встречается в разных частях, какая
+строка победит — не определено (в выписках полис обычно встречается один раз).
+
+Повторные загрузки: выписка регистрируется по хэшу содержимого
+(register_statement), файл, уже успешно импортированный целиком, не
+обрабатывается. Для каждой комиссии хранится отпечаток последней примененной
+строки (StatementRowFingerprint): строки пересекающихся выписок с тем же
+отпечатком пропускаются без обращения к полисам и комиссиям.
+"""
 import csv
-from io import StringIO
+import hashlib
+import io
+import uuid
 from decimal import Decimal, InvalidOperation
-from django.db import transaction
-from .models import Policy, Commission, InsuranceType
+from collections import Counter
+from io import StringIO
+from itertools import islice
+
+from django.core.files.storage import default_storage
+from django.core.files.base import ContentFile
+from django.db import DatabaseError, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .models import (
+    Policy, Commission, CommissionStatement, InsuranceIngestionTask, StatementRowFingerprint,
+)
+
+REQUIRED_HEADERS = ['policy_number', 'date_received']
+
+# Сколько строк выписки обрабатывается в одной транзакции
+STATEMENT_CHUNK_SIZE = 2000
+
+# Каталог хранилища для загруженных выписок до их обработки
+STATEMENT_UPLOAD_DIR = 'ingestion/insurances'
+
+# Поля, которые перезаписываются у уже существующей комиссии (аналог defaults в update_or_create)
+COMMISSION_UPDATE_FIELDS = [
+    'gross_commission', 'net_commission', 'adviser_fee_percentage', 'adviser_fee_amount',
+    'date_received', 'payment_status', 'updated_at',
+]
+
+
+def iter_chunks(reader, chunk_size, first_line=2):
+    """Разбивает DictReader на чанки [(номер строки, строка), ...]."""
+    rows = enumerate(reader, start=first_line)  # 2, т.к. DictReader начинает после заголовка
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _parse_row(row):
+    policy_number = (row.get('policy_number') or '').strip()
+    if not policy_number:
+        raise ValueError("Отсутствует обязательное значение 'policy_number'.")
+    date_received_str = (row.get('date_received') or '').strip()
+    if not date_received_str:
+        raise ValueError("Отсутствует обязательное значение 'date_received'.")
+    date_received = parse_date(date_received_str)
+    if date_received is None:
+        raise ValueError(f"Неверная дата '{date_received_str}', ожидается YYYY-MM-DD.")
+    gross_commission_str = (row.get('gross_commission') or '').strip()
+    gross_commission = Decimal(gross_commission_str) if gross_commission_str else None
+    return policy_number, gross_commission, date_received
+
+
+def row_fingerprint(policy_number, gross_commission, date_received):
+    """Отпечаток значимых полей строки; не зависит от форматирования чисел в файле."""
+    gross = '' if gross_commission is None else f'{gross_commission:.2f}'
+    return hashlib.sha1(f'{policy_number}|{gross}|{date_received.isoformat()}'.encode()).hexdigest()
 
-def process_insurance_commission_statement_logic(file_content_string):
+
+def skip_unchanged_rows(parsed):
     """
-    Обрабатывает CSV-файл с комиссиями в рамках одной транзакции.
-    Использует DictReader, ожидает заголовки: policy_number, gross_commission, date_received.
-    `gross_commission` является опциональным.
+    Отбрасывает строки, отпечаток которых совпадает с последним примененным
+    к комиссии полиса. Полисы, встречающиеся в чанке несколько раз, не
+    пропускаются, чтобы по-прежнему побеждала последняя строка.
+    Возвращает (строки к обработке, число пропущенных).
     """
-    # Используем DictReader для работы с заголовками
-    reader = csv.DictReader(StringIO(file_content_string))
-    processed_count = 0
-    errors = []
+    counts = Counter(row[1] for row in parsed)
+    known = dict(StatementRowFingerprint.objects.filter(
+        commission__policy__policy_number__in=list(counts)
+    ).values_list('commission__policy__policy_number', 'fingerprint'))
+    fresh = [row for row in parsed if counts[row[1]] > 1 or known.get(row[1]) != row[-1]]
+    return fresh, len(parsed) - len(fresh)
+
 
-    required_headers = ['policy_number', 'date_received']
-    if not all(header in reader.fieldnames for header in required_headers):
-        return {'processed': 0, 'errors': [f"Отсутствуют обязательные заголовки в CSV файле. Требуются: {', '.join(required_headers)}."], 'status': 'failed'}
+def calculate_commission_values(policy, gross_commission):
+    """Суммы комиссии по полису: (gross, net, процент консультанта, вознаграждение)."""
+    # --- Интеллектуальный расчет комиссии ---
+    if gross_commission is None:
+        # Если комиссия не указана, рассчитываем ее автоматически
+        rate = policy.insurance_type.default_gross_commission_rate or policy.insurer.default_gross_commission_rate
+        if not policy.annual_premium_value or not rate:
+            raise ValueError("Невозможно рассчитать комиссию: отсутствует 'gross_commission' в файле и/или APV/ставка в полисе.")
+        gross_commission = policy.annual_premium_value * (rate / Decimal(100))
 
+    # Логика расчета net_commission
+    net_rate = policy.insurance_type.default_net_rate or policy.insurer.default_net_rate
+    if net_rate is None:
+        raise ValueError(f"Для полиса {policy.policy_number} не задана чистая ставка (net rate).")
+    net_commission = gross_commission * (net_rate / Decimal(100))
+
+    # Получаем процент вознаграждения из модели Adviser
+    if not policy.adviser:
+        raise ValueError(f"Для полиса {policy.policy_number} не назначен консультант (Adviser).")
+    adviser_fee_percentage = policy.adviser.default_fee_percentage
+    adviser_fee_amount = net_commission * (adviser_fee_percentage / Decimal(100))
+    return gross_commission, net_commission, adviser_fee_percentage, adviser_fee_amount
+
+
+def process_statement_chunk(chunk):
+    """
+    Обрабатывает чанк [(номер строки, строка CSV)] в отдельной транзакции.
+    Возвращает {'processed': число строк, 'skipped': число неизмененных строк, 'errors': [сообщения]}.
+    """
+    errors = []
+    parsed = []
+    for line_num, row in chunk:
+        try:
+            values = _parse_row(row)
+            parsed.append((line_num, *values, row_fingerprint(*values)))
+        except (ValueError, InvalidOperation) as e:
+            errors.append((line_num, f"Строка {line_num}: Ошибка данных - {e}"))
+    parsed, skipped = skip_unchanged_rows(parsed)
+
+    write_errors = []
     try:
         with transaction.atomic():
-            for i, row in enumerate(reader):
-                line_num = i + 2  # +2, т.к. DictReader начинает после заголовка
-                try:
-                    policy_number = row.get('policy_number', '').strip()
-                    if not policy_number:
-                        raise ValueError("Отсутствует обязательное значение 'policy_number'.")
-
-                    policy = Policy.objects.select_related('insurer', 'insurance_type').get(policy_number=policy_number)
-
-                    gross_commission_str = row.get('gross_commission', '').strip()
-
-                    # --- Интеллектуальный расчет комиссии ---
-                    if gross_commission_str:
-                        gross_commission = Decimal(gross_commission_str)
-                    else:
-                        # Если комиссия не указана, рассчитываем ее автоматически
-                        rate = policy.insurance_type.default_gross_commission_rate or policy.insurer.default_gross_commission_rate
-                        if not policy.annual_premium_value or not rate:
-                            raise ValueError("Невозможно рассчитать комиссию: отсутствует 'gross_commission' в файле и/или APV/ставка в полисе.")
-                        gross_commission = policy.annual_premium_value * (rate / Decimal(100))
-
-                    date_received = row.get('date_received', '').strip()
-                    if not date_received:
-                        raise ValueError("Отсутствует обязательное значение 'date_received'.")
-
-                    # Логика расчета net_commission
-                    net_rate = policy.insurance_type.default_net_rate or policy.insurer.default_net_rate
-                    net_commission = gross_commission * (net_rate / Decimal(100))
-
-                    # Получаем процент вознаграждения из модели Adviser
-                    if not policy.adviser:
-                        raise ValueError(f"Для полиса {policy.policy_number} не назначен консультант (Adviser).")
-                    adviser_fee_percentage = policy.adviser.default_fee_percentage
-
-                    # Создаем или обновляем комиссию
-                    commission, created = Commission.objects.update_or_create(
-                        policy=policy,
-                        defaults={
-                            'gross_commission': gross_commission,
-                            'net_commission': net_commission,
-                            'adviser_fee_percentage': adviser_fee_percentage,
-                            'date_received': date_received,
-                            'payment_status': Commission.PaymentStatus.PENDING,
-                        }
-                    )
-                    processed_count += 1
-
-                except Policy.DoesNotExist:
-                    errors.append(f"Строка {line_num}: Полис с номером '{policy_number}' не найден.")
-                except (ValueError, InvalidOperation) as e:
-                    errors.append(f"Строка {line_num}: Ошибка данных - {e}")
-
-        if errors:
-            return {'processed': processed_count, 'errors': errors, 'status': 'partial_success'}
-
-    except Exception as e:
-        return {'processed': 0, 'errors': [f"Критическая ошибка: {e}. Все изменения отменены."], 'status': 'failed'}
-
-    return {'processed': processed_count, 'errors': [], 'status': 'success'}
+            processed = _write_chunk(parsed, write_errors)
+    except DatabaseError as e:
+        first, last = chunk[0][0], chunk[-1][0]
+        processed, write_errors = 0, [
+            (first, f"Строки {first}-{last}: Критическая ошибка: {e}. Изменения этих строк отменены."),
+        ]
+    return {
+        'processed': processed, 'skipped': skipped,
+        'errors': [message for _, message in sorted(errors + write_errors)],
+    }
+
+
+def _write_chunk(parsed, errors):
+    """Записывает разобранные строки чанка; ошибки строк добавляются в `errors`."""
+    policies = Policy.objects.select_related('insurer', 'insurance_type', 'adviser').in_bulk(
+        {row[1] for row in parsed}, field_name='policy_number'
+    )
+    existing = Commission.objects.in_bulk([policy.id for policy in policies.values()], field_name='policy_id')
+
+    to_create, to_update, fingerprints = {}, {}, {}
+    processed = 0
+    now = timezone.now()
+    for line_num, policy_number, gross_commission, date_received, fingerprint in parsed:
+        policy = policies.get(policy_number)
+        if policy is None:
+            errors.append((line_num, f"Строка {line_num}: Полис с номером '{policy_number}' не найден."))
+            continue
+        try:
+            gross, net, fee_percentage, fee_amount = calculate_commission_values(policy, gross_commission)
+        except (ValueError, InvalidOperation) as e:
+            errors.append((line_num, f"Строка {line_num}: Ошибка данных - {e}"))
+            continue
+
+        commission = existing.get(policy.id) or to_create.get(policy.id) or Commission(policy=policy)
+        commission.gross_commission = gross
+        commission.net_commission = net
+        commission.adviser_fee_percentage = fee_percentage
+        commission.adviser_fee_amount = fee_amount
+        commission.date_received = date_received
+        commission.payment_status = Commission.PaymentStatus.PENDING
+        commission.updated_at = now
+        # Повторы полиса внутри чанка: как и при построчном update_or_create, побеждает последняя строка
+        if commission.pk:
+            to_update[policy.id] = commission
+        else:
+            to_create[policy.id] = commission
+        fingerprints[policy.id] = fingerprint
+        processed += 1
+
+    Commission.objects.bulk_create(to_create.values())
+    Commission.objects.bulk_update(to_update.values(), COMMISSION_UPDATE_FIELDS)
+    StatementRowFingerprint.objects.bulk_create(
+        [
+            StatementRowFingerprint(commission=commission, fingerprint=fingerprints[policy_id])
+            for policy_id, commission in (to_create | to_update).items()
+        ],
+        update_conflicts=True, unique_fields=['commission'], update_fields=['fingerprint', 'updated_at'],
+    )
+    return processed
+
+
+def merge_results(results):
+    """Сводит результаты чанков в итог импорта со статусом."""
+    processed, skipped, errors = 0, 0, []
+    for result in results:
+        processed += result['processed']
+        skipped += result.get('skipped', 0)
+        errors.extend(result['errors'])
+    if errors:
+        status = 'partial_success' if processed or skipped else 'failed'
+        return {'processed': processed, 'skipped': skipped, 'errors': errors, 'status': status}
+    return {'processed': processed, 'skipped': skipped, 'errors': [], 'status': 'success'}
+
+
+def missing_headers_result(reader):
+    """Итог импорта с ошибкой, если в CSV нет обязательных заголовков, иначе None."""
+    if not reader.fieldnames or not all(header in reader.fieldnames for header in REQUIRED_HEADERS):
+        return {'processed': 0, 'errors': [f"Отсутствуют обязательные заголовки в CSV файле. Требуются: {', '.join(REQUIRED_HEADERS)}."], 'status': 'failed'}
+    return None
+
+
+def process_statement_reader(reader, chunk_size=STATEMENT_CHUNK_SIZE):
+    """Импортирует строки DictReader чанками и возвращает итог (см. merge_results)."""
+    failed = missing_headers_result(reader)
+    if failed:
+        return failed
+    return merge_results(process_statement_chunk(chunk) for chunk in iter_chunks(reader, chunk_size))
+
+
+def process_insurance_commission_statement_logic(file_content_string, chunk_size=STATEMENT_CHUNK_SIZE):
+    """
+    Обрабатывает CSV-файл с комиссиями чанками.
+    Использует DictReader, ожидает заголовки: policy_number, gross_commission, date_received.
+    `gross_commission` является опциональным.
+    """
+    return process_statement_reader(csv.DictReader(StringIO(file_content_string)), chunk_size)
+
+
+def save_statement_upload(uploaded_file):
+    """
+    Сохраняет загруженную выписку в хранилище и возвращает имя файла.
+    Django уже держит большие загрузки во временном файле, в хранилище они
+    копируются (или перемещаются) частями, без чтения в память целиком.
+    """
+    return default_storage.save(f'{STATEMENT_UPLOAD_DIR}/{uuid.uuid4().hex}.csv', uploaded_file)
+
+
+def open_statement(name):
+    """Открывает сохраненную выписку как текстовый поток (BOM Excel отбрасывается)."""
+    return io.TextIOWrapper(default_storage.open(name, 'rb'), encoding='utf-8-sig', newline='')
+
+
+def process_statement_file(name, chunk_size=STATEMENT_CHUNK_SIZE):
+    """Импортирует выписку из хранилища, читая ее построчно чанками."""
+    with open_statement(name) as stream:
+        return process_statement_reader(csv.DictReader(stream), chunk_size)
+
+
+def split_statement(name, chunk_size=None):
+    """
+    Разрезает выписку из хранилища на части по `chunk_size` строк, каждая со
+    своим заголовком. Читает и пишет потоково, в памяти — одна часть.
+    Возвращает ([(имя части, номер первой строки)], None) или ([], итог с ошибкой заголовков).
+    """
+    parts = []
+    with open_statement(name) as stream:
+        reader = csv.DictReader(stream)
+        failed = missing_headers_result(reader)
+        if failed:
+            return [], failed
+        base = name.rsplit('.', 1)[0]
+        for chunk in iter_chunks(reader, chunk_size or STATEMENT_CHUNK_SIZE):
+            buffer = StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=reader.fieldnames, restval='', extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(row for _, row in chunk)
+            part = default_storage.save(f'{base}.part{len(parts) + 1}.csv', ContentFile(buffer.getvalue().encode()))
+            parts.append((part, chunk[0][0]))
+    return parts, None
+
+
+def process_statement_part(name, first_line):
+    """Обрабатывает часть выписки как один чанк; номера строк — как в исходном файле."""
+    with open_statement(name) as stream:
+        chunk = [row for row in enumerate(csv.DictReader(stream), start=first_line)]
+    if not chunk:
+        return {'processed': 0, 'skipped': 0, 'errors': [], 'rows': 0}
+    return {**process_statement_chunk(chunk), 'rows': len(chunk)}
+
+
+def record_chunk_progress(ingestion_task_id, result):
+    """Добавляет результат чанка к счетчикам прогресса задачи импорта (безопасно для параллельных чанков)."""
+    InsuranceIngestionTask.objects.filter(pk=ingestion_task_id).update(
+        chunks_done=F('chunks_done') + 1,
+        rows_done=F('rows_done') + result['rows'],
+        error_count=F('error_count') + len(result['errors']),
+    )
+
+
+def statement_content_hash(name):
+    """SHA-256 содержимого выписки из хранилища, читается блоками."""
+    digest = hashlib.sha256()
+    with default_storage.open(name, 'rb') as stream:
+        for block in iter(lambda: stream.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def register_statement(name, ingestion_task_id):
+    """
+    Регистрирует выписку по хэшу содержимого за задачей импорта.
+    Если тот же файл уже был успешно импортирован, возвращает id той задачи
+    (файл обрабатывать не нужно), иначе None.
+    """
+    content_hash = statement_content_hash(name)
+    duplicate_of = CommissionStatement.objects.filter(
+        content_hash=content_hash, ingestion_task__status=InsuranceIngestionTask.Status.SUCCESS,
+    ).exclude(ingestion_task_id=ingestion_task_id).values_list('ingestion_task_id', flat=True).first()
+    if duplicate_of:
+        return duplicate_of
+    # Неудачный или незавершенный импорт того же файла повторяется; отпечатки строк отсекут уже примененные
+    CommissionStatement.objects.update_or_create(
+        content_hash=content_hash, defaults={'ingestion_task_id': ingestion_task_id}
+    )
+    return None
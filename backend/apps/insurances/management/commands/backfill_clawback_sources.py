@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from backend.apps.insurances.services import CANCELLATION_CHUNK_SIZE, backfill_clawback_sources
+
+
+class Command(BaseCommand):
+    """
+    Восстанавливает source/source_override у возвратов, созданных до появления
+    этих полей, по шаблонам reason (services.backfill_clawback_sources). Нужно
+    запустить один раз после развертывания, иначе повторная отмена создаст
+    для старых отмен второй возврат.
+    """
+    help = "Проставляет источник возвратам, созданным до появления поля source"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=CANCELLATION_CHUNK_SIZE, help="Комиссий в одной транзакции")
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError("--chunk-size должен быть положительным.")
+        report = backfill_clawback_sources(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Возвратов вознаграждения: {report['adviser_fee']}, возвратов оверрайдов: {report['override']}."
+        ))
@@ -112,6 +112,12 @@ class Policy(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Keyset-пагинация списков
+            models.Index(fields=['created_at', 'id']),
+        ]
+
     def save(self, *args, **kwargs):
         # Automatically calculate APV if not provided
         if self.monthly_premium and not self.annual_premium_value:
@@ -163,6 +169,12 @@ class Commission(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Keyset-пагинация списков
+            models.Index(fields=['date_received', 'id']),
+        ]
+
     def save(self, *args, **kwargs):
         self.adviser_fee_amount = self.net_commission * (self.adviser_fee_percentage / Decimal(100))
         super().save(*args, **kwargs)
@@ -200,7 +212,18 @@ class Clawback(CommissionModifier):
     class ClawbackStatus(models.TextChoices):
         PENDING = 'PENDING', 'Pending'
         RECOVERED = 'RECOVERED', 'Recovered'
+
+    class Source(models.TextChoices):
+        MANUAL = 'MANUAL', 'Manual'
+        ADVISER_FEE = 'ADVISER_FEE', 'Adviser Fee'
+        OVERRIDE = 'OVERRIDE', 'Override'
+
     status = models.CharField(max_length=20, choices=ClawbackStatus.choices, default=ClawbackStatus.PENDING)
+    # Что возвращается: вознаграждение консультанта по комиссии или конкретный оверрайд
+    source = models.CharField(max_length=20, choices=Source.choices, default=Source.MANUAL)
+    source_override = models.ForeignKey(
+        'Override', on_delete=models.SET_NULL, null=True, blank=True, related_name='clawbacks'
+    )
     clawback_period = models.IntegerField(null=True, blank=True, help_text="Clawback period in months.")
     # Chargeback and Write-off details
     chargeback_amount = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
@@ -209,6 +232,18 @@ class Clawback(CommissionModifier):
     write_off_reason = models.CharField(max_length=255, blank=True)
     write_off_date = models.DateField(null=True, blank=True)
 
+    class Meta:
+        constraints = [
+            # Не больше одного возврата вознаграждения на комиссию и одного возврата на оверрайд
+            models.UniqueConstraint(
+                fields=['commission'], condition=models.Q(source='ADVISER_FEE'), name='unique_adviser_fee_clawback'
+            ),
+            models.UniqueConstraint(
+                fields=['source_override'], condition=models.Q(source_override__isnull=False),
+                name='unique_override_clawback',
+            ),
+        ]
+
     def recover(self):
         """Marks the clawback as recovered."""
         if self.status != self.ClawbackStatus.RECOVERED:
@@ -237,3 +272,47 @@ class InsuranceIngestionTask(models.Model):
     created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True)
     status = models.CharField(max_length=20, choices=Status.choices, default=Status.PENDING)
     result = models.JSONField(null=True, blank=True)
+
+    # Прогресс обработки: счетчики увеличивают подзадачи чанков, каждая своим UPDATE
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    total_chunks = models.PositiveIntegerField(default=0)
+    chunks_done = models.PositiveIntegerField(default=0)
+    rows_done = models.PositiveIntegerField(default=0)
+    error_count = models.PositiveIntegerField(default=0)
+
+    @property
+    def rows_per_second(self):
+        """Средняя скорость обработки строк с начала импорта."""
+        if not self.started_at:
+            return None
+        elapsed = ((self.finished_at or timezone.now()) - self.started_at).total_seconds()
+        return round(self.rows_done / elapsed, 1) if elapsed > 0 else None
+
+
+class CommissionStatement(models.Model):
+    """
+    Загруженная выписка страховщика, опознаваемая по SHA-256 содержимого.
+    Повторная загрузка того же файла после успешного импорта не обрабатывается.
+    """
+    content_hash = models.CharField(max_length=64, unique=True)
+    ingestion_task = models.ForeignKey(
+        InsuranceIngestionTask, on_delete=models.SET_NULL, null=True, blank=True, related_name='statements'
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Statement {self.content_hash[:12]}"
+
+
+class StatementRowFingerprint(models.Model):
+    """
+    Отпечаток строки выписки, последней примененной к комиссии. Строки с тем же
+    отпечатком при следующих импортах пропускаются; удаление комиссии удаляет
+    и отпечаток, так что строка снова будет обработана.
+    """
+    commission = models.OneToOneField(
+        Commission, on_delete=models.CASCADE, primary_key=True, related_name='statement_fingerprint'
+    )
+    fingerprint = models.CharField(max_length=40)
+    updated_at = models.DateTimeField(auto_now=True)
@@ -37,11 +37,11 @@ class ClawbackSerializer(serializers.ModelSerializer):
     class Meta:
         model = Clawback
         fields = [
-            'id', 'commission', 'amount', 'reason', 'status', 'created_at',
+            'id', 'commission', 'amount', 'reason', 'status', 'created_at', 'source', 'source_override',
             'clawback_period', 'chargeback_amount', 'chargeback_reason',
             'write_off_amount', 'write_off_reason', 'write_off_date'
         ]
-        read_only_fields = ('status', 'commission')
+        read_only_fields = ('status', 'commission', 'source', 'source_override')
 
 class BonusSerializer(serializers.ModelSerializer):
     class Meta:
@@ -70,11 +70,18 @@ class InsuranceCommissionDataIngestionSerializer(serializers.Serializer):
             raise serializers.ValidationError("Поддерживаются только файлы формата CSV.")
         return value
 
+class PolicyBulkActivationSerializer(serializers.Serializer):
+    policy_ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False)
+
 class InsuranceIngestionTaskSerializer(serializers.ModelSerializer):
     created_by = serializers.StringRelatedField()
+    rows_per_second = serializers.FloatField(read_only=True)
     class Meta:
         model = InsuranceIngestionTask
-        fields = ['id', 'status', 'created_at', 'created_by', 'result']
+        fields = [
+            'id', 'status', 'created_at', 'created_by', 'result',
+            'started_at', 'finished_at', 'total_chunks', 'chunks_done', 'rows_done', 'error_count', 'rows_per_second',
+        ]
         read_only_fields = fields
 
 
@@ -1,20 +1,29 @@
 from decimal import Decimal
 from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
 from .models import Policy, Commission, Override, Clawback
 
-@transaction.atomic
-def create_commission_for_policy(policy: Policy):
+# Сколько полисов отменяется / активируется в одной транзакции при пакетной обработке
+CANCELLATION_CHUNK_SIZE = 1000
+ACTIVATION_CHUNK_SIZE = 1000
+
+# Шаблоны reason автоматических возвратов; по ним backfill_clawback_sources
+# восстанавливает источник у возвратов, созданных до появления полей source
+ADVISER_FEE_CLAWBACK_REASON = "Clawback of adviser fee for cancelled policy {}."
+OVERRIDE_CLAWBACK_REASON = "Clawback of override for {} due to policy cancellation."
+
+def build_policy_commission(policy: Policy, date_received):
     """
-    Service function to create a commission and its related objects for a given policy.
-    Encapsulates all business logic for commission creation.
+    Builds (unsaved) the commission for a policy and the manager's override, if any.
+    Policy must have insurer, insurance_type, adviser__user and adviser__manager loaded
+    to avoid extra queries. Returns (commission, override or None), or None if the policy
+    has no APV or no adviser. No override is built for a manager with a zero override percentage.
     """
-    # 1. Pre-condition checks
-    if not policy.annual_premium_value:
-        return None # Cannot create commission without APV
-    if hasattr(policy, 'commission'):
-        return policy.commission # Commission already exists
+    if not policy.annual_premium_value or not policy.adviser:
+        return None
 
-    # 2. Determine commission rates with override logic
+    # Determine commission rates with override logic
     insurer = policy.insurer
     insurance_type = policy.insurance_type
     gross_rate_pct = insurance_type.default_gross_commission_rate or insurer.default_gross_commission_rate
@@ -22,70 +31,229 @@ def create_commission_for_policy(policy: Policy):
     gross_rate = gross_rate_pct / Decimal(100)
     net_rate = net_rate_pct / Decimal(100)
 
-    # 3. Calculate placeholder values
+    # Calculate placeholder values
     gross_commission_placeholder = policy.annual_premium_value * gross_rate
     net_commission_placeholder = gross_commission_placeholder * net_rate
 
     adviser = policy.adviser
-    # Calculate adviser_fee_amount based on net_commission and adviser's percentage
-    adviser_fee_amount_calculated = net_commission_placeholder * (adviser.default_commission_percentage / Decimal(100))
-
-    # 4. Create the main Commission object
-    commission = Commission.objects.create(
+    # adviser_fee_amount is set explicitly: bulk_create does not call Commission.save()
+    commission = Commission(
         policy=policy,
         gross_commission=gross_commission_placeholder,
         net_commission=net_commission_placeholder,
-        adviser_fee_percentage=adviser.default_commission_percentage,
-        adviser_fee_amount=adviser_fee_amount_calculated, # Добавляем вычисленную сумму
-        date_received=policy.updated_at.date()
+        adviser_fee_percentage=adviser.default_fee_percentage,
+        adviser_fee_amount=net_commission_placeholder * (adviser.default_fee_percentage / Decimal(100)),
+        date_received=date_received,
     )
 
-    # 5. Handle Override Commission creation
-    if adviser.parent_adviser and adviser.parent_adviser.active_flag:
-        manager = adviser.parent_adviser
-        override_amount = commission.net_commission * (manager.default_override_percentage / Decimal(100))
-
-        Override.objects.create(
+    override = None
+    if adviser.manager and adviser.manager.active_flag and adviser.manager.default_override_percentage:
+        manager = adviser.manager
+        override = Override(
             commission=commission,
             recipient=manager,
-            amount=override_amount,
-            reason=f"Override from {adviser.user.get_full_name()}"
+            amount=commission.net_commission * (manager.default_override_percentage / Decimal(100)),
+            reason=f"Override from {adviser.user.get_full_name()}",
         )
+    return commission, override
+
 
+@transaction.atomic
+def create_commission_for_policy(policy: Policy):
+    """
+    Service function to create a commission and its related objects for a given policy.
+    Encapsulates all business logic for commission creation.
+    """
+    if hasattr(policy, 'commission'):
+        return policy.commission # Commission already exists
+
+    built = build_policy_commission(policy, policy.updated_at.date())
+    if built is None:
+        return None # Cannot create commission without APV or adviser
+    commission, override = built
+    commission.save()
+    if override:
+        override.commission = commission
+        override.save()
     return commission
 
 
-@transaction.atomic
-def handle_policy_cancellation_service(policy: Policy):
+def activate_policies(policy_ids, chunk_size=ACTIVATION_CHUNK_SIZE):
     """
-    Service function to handle all logic when a policy is cancelled.
-    Creates clawbacks for adviser and any overrides.
+    Bulk counterpart of activating policies one by one through save(): sets status ACTIVE
+    with one UPDATE per chunk (no post_save signals) and creates missing commissions and
+    overrides with the same values as create_commission_for_policy. Rates, advisers and
+    managers of a chunk are loaded in one query. Each chunk of `chunk_size` policies is
+    its own transaction. Returns {'activated': policies, 'commissions': created}.
     """
-    if not hasattr(policy, 'commission'):
-        return # No commission to claw back
+    policy_ids = sorted(set(policy_ids))
+    report = {'activated': 0, 'commissions': 0}
+    for start in range(0, len(policy_ids), chunk_size):
+        chunk = policy_ids[start:start + chunk_size]
+        with transaction.atomic():
+            now = timezone.now()
+            report['activated'] += Policy.objects.filter(id__in=chunk).exclude(
+                status=Policy.PolicyStatus.ACTIVE
+            ).update(status=Policy.PolicyStatus.ACTIVE, updated_at=now)
+            policies = Policy.objects.filter(
+                id__in=chunk, commission__isnull=True, status=Policy.PolicyStatus.ACTIVE
+            ).select_related('insurer', 'insurance_type', 'adviser__user', 'adviser__manager')
+
+            # Как в create_commission_for_policy: дата получения — дата последнего изменения полиса
+            built = [b for b in (build_policy_commission(policy, policy.updated_at.date()) for policy in policies) if b]
+            Commission.objects.bulk_create([commission for commission, _ in built])
+            overrides = []
+            for commission, override in built:
+                if override:
+                    # pk комиссии появился после bulk_create
+                    override.commission = commission
+                    overrides.append(override)
+            Override.objects.bulk_create(overrides)
+            report['commissions'] += len(built)
+    return report
+
 
-    commission = policy.commission
+def create_cancellation_clawbacks(commissions):
+    """
+    Создает недостающие возвраты (Clawback) для комиссий отмененных полисов:
+    вознаграждения консультанта и каждого оверрайда, и переводит комиссии
+    в статус CLAWBACK. Существующие возвраты находятся по источнику двумя
+    запросами на весь набор, новые пишутся одним bulk_create.
+    Возвращает число действительно вставленных возвратов: строки, отброшенные
+    уникальными ограничениями (параллельная отмена), не считаются.
+    """
+    commissions = list(commissions.select_related('policy'))
+    commission_ids = [commission.id for commission in commissions]
+    fee_clawed = set(Clawback.objects.filter(
+        commission_id__in=commission_ids, source=Clawback.Source.ADVISER_FEE
+    ).values_list('commission_id', flat=True))
+    overrides = Override.objects.filter(commission_id__in=commission_ids).select_related('recipient__user')
+    override_clawed = set(Clawback.objects.filter(
+        source_override__commission_id__in=commission_ids
+    ).values_list('source_override_id', flat=True))
 
-    # 1. Create clawback for the adviser's fee
-    if not Clawback.objects.filter(commission=commission, reason__icontains='adviser').exists():
-        Clawback.objects.create(
+    clawbacks = [
+        Clawback(
             commission=commission,
             amount=-commission.adviser_fee_amount,
-            reason=f"Clawback of adviser fee for cancelled policy {policy.policy_number}."
+            reason=ADVISER_FEE_CLAWBACK_REASON.format(commission.policy.policy_number),
+            source=Clawback.Source.ADVISER_FEE,
+        )
+        for commission in commissions if commission.id not in fee_clawed
+    ]
+    clawbacks += [
+        Clawback(
+            commission_id=override.commission_id,
+            amount=-override.amount,
+            reason=OVERRIDE_CLAWBACK_REASON.format(override.recipient),
+            source=Clawback.Source.OVERRIDE,
+            source_override=override,
         )
+        for override in overrides if override.id not in override_clawed
+    ]
+    # Уникальные ограничения защищают от дублей при параллельной отмене;
+    # ignore_conflicts не сообщает, что отброшено, поэтому считаем до и после
+    existing = Clawback.objects.filter(commission_id__in=commission_ids)
+    before = existing.count() if clawbacks else 0
+    if clawbacks:
+        Clawback.objects.bulk_create(clawbacks, ignore_conflicts=True)
+
+    Commission.objects.filter(id__in=commission_ids).exclude(
+        payment_status=Commission.PaymentStatus.CLAWBACK
+    ).update(payment_status=Commission.PaymentStatus.CLAWBACK, updated_at=timezone.now())
+    return existing.count() - before if clawbacks else 0
+
+
+@transaction.atomic
+def handle_policy_cancellation_service(policy: Policy):
+    """
+    Service function to handle all logic when a policy is cancelled.
+    Creates clawbacks for adviser and any overrides.
+    """
+    create_cancellation_clawbacks(Commission.objects.filter(policy=policy))
+
 
-    # 2. Create clawbacks for any override commissions
-    overrides = Override.objects.filter(commission=commission)
-    for override in overrides:
-        if not Clawback.objects.filter(commission=commission, reason__icontains=f'override for {override.recipient}').exists():
-            Clawback.objects.create(
-                commission=commission,
-                amount=-override.amount,
-                reason=f"Clawback of override for {override.recipient} due to policy cancellation."
+def cancel_policies(policy_ids, reason='', cancellation_date=None, chunk_size=CANCELLATION_CHUNK_SIZE):
+    """
+    Отменяет полисы `policy_ids` пакетно, без сигналов post_save: статус
+    ставится одним UPDATE на часть, возвраты создает create_cancellation_clawbacks
+    только для полисов, которые этот вызов перевел в CANCELLED; уже отмененные
+    пропускаются. Каждая часть по `chunk_size` полисов — в своей транзакции; повторный вызов
+    ничего не дублирует. Возвращает {'policies': отменено, 'clawbacks': создано}.
+    """
+    cancellation_date = cancellation_date or timezone.now().date()
+    policy_ids = sorted(set(policy_ids))
+    report = {'policies': 0, 'clawbacks': 0}
+    for start in range(0, len(policy_ids), chunk_size):
+        chunk = policy_ids[start:start + chunk_size]
+        with transaction.atomic():
+            cancelled = list(Policy.objects.select_for_update().filter(id__in=chunk).exclude(
+                status=Policy.PolicyStatus.CANCELLED
+            ).values_list('id', flat=True))
+            if not cancelled:
+                continue
+            report['policies'] += Policy.objects.filter(id__in=cancelled).update(
+                status=Policy.PolicyStatus.CANCELLED,
+                policy_cancellation_date=cancellation_date,
+                policy_cancellation_reason=reason,
+                updated_at=timezone.now(),
             )
+            report['clawbacks'] += create_cancellation_clawbacks(Commission.objects.filter(policy_id__in=cancelled))
+    return report
+
 
-    # 3. Update the main commission status
-    if commission.payment_status != Commission.PaymentStatus.CLAWBACK:
-        commission.payment_status = Commission.PaymentStatus.CLAWBACK
-        commission.save()
+def backfill_clawback_sources(chunk_size=CANCELLATION_CHUNK_SIZE):
+    """
+    Проставляет source и source_override возвратам, созданным до появления этих
+    полей (source=MANUAL), по шаблонам reason автоматических возвратов. Возврат
+    оверрайда связывается с неиспользованным оверрайдом той же комиссии, чей
+    получатель дает тот же reason (при нескольких — с совпадающей суммой).
+    Лишние совпадения (дубли старых отмен) остаются MANUAL, чтобы не нарушить
+    уникальные ограничения. Части по `chunk_size` комиссий — в своих транзакциях.
+    Повторный вызов ничего не меняет. Возвращает {'adviser_fee': n, 'override': n}.
+    """
+    fee_prefix, fee_suffix = ADVISER_FEE_CLAWBACK_REASON.split('{}')
+    override_prefix, override_suffix = OVERRIDE_CLAWBACK_REASON.split('{}')
+    legacy = Clawback.objects.filter(source=Clawback.Source.MANUAL).filter(
+        Q(reason__startswith=fee_prefix, reason__endswith=fee_suffix)
+        | Q(reason__startswith=override_prefix, reason__endswith=override_suffix)
+    )
+    commission_ids = sorted(set(legacy.values_list('commission_id', flat=True)))
+    report = {'adviser_fee': 0, 'override': 0}
+    for start in range(0, len(commission_ids), chunk_size):
+        chunk = commission_ids[start:start + chunk_size]
+        with transaction.atomic():
+            fee_clawed = set(Clawback.objects.filter(
+                commission_id__in=chunk, source=Clawback.Source.ADVISER_FEE
+            ).values_list('commission_id', flat=True))
+            override_clawed = set(Clawback.objects.filter(
+                commission_id__in=chunk, source_override__isnull=False
+            ).values_list('source_override_id', flat=True))
+            overrides = {}
+            for override in Override.objects.filter(commission_id__in=chunk).select_related('recipient__user'):
+                overrides.setdefault(override.commission_id, []).append(override)
 
+            updated = []
+            for clawback in legacy.filter(commission_id__in=chunk).order_by('pk'):
+                if clawback.reason.startswith(fee_prefix):
+                    if clawback.commission_id in fee_clawed:
+                        continue
+                    fee_clawed.add(clawback.commission_id)
+                    clawback.source = Clawback.Source.ADVISER_FEE
+                    report['adviser_fee'] += 1
+                else:
+                    candidates = [
+                        override for override in overrides.get(clawback.commission_id, [])
+                        if override.id not in override_clawed
+                        and OVERRIDE_CLAWBACK_REASON.format(override.recipient) == clawback.reason
+                    ]
+                    if not candidates:
+                        continue
+                    override = next((o for o in candidates if o.amount == -clawback.amount), candidates[0])
+                    override_clawed.add(override.id)
+                    clawback.source = Clawback.Source.OVERRIDE
+                    clawback.source_override = override
+                    report['override'] += 1
+                updated.append(clawback)
+            Clawback.objects.bulk_update(updated, ['source', 'source_override'])
+    return report
@@ -1,9 +1,23 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
 
 from .models import Policy
 from .services import create_commission_for_policy, handle_policy_cancellation_service
 
+
+def _status_in_update(kwargs):
+    update_fields = kwargs.get('update_fields', None)
+    return update_fields is None or 'status' in update_fields
+
+
+@receiver(pre_save, sender=Policy)
+def remember_policy_status(sender, instance, raw=False, **kwargs):
+    """Запоминает статус полиса до сохранения, чтобы отличить смену статуса от повторного save()."""
+    instance._previous_status = None
+    if instance.pk is not None and not raw and _status_in_update(kwargs):
+        instance._previous_status = Policy.objects.filter(pk=instance.pk).values_list('status', flat=True).first()
+
+
 @receiver(post_save, sender=Policy)
 def handle_policy_status_change(sender, instance, created, **kwargs):
     """
@@ -11,15 +25,14 @@ def handle_policy_status_change(sender, instance, created, **kwargs):
     Handles both creation and updates of policies.
     """
     # On updates, we optimize to only run if the 'status' field was part of the update.
-    if not created:
-        update_fields = kwargs.get('update_fields', None)
-        if update_fields is not None and 'status' not in update_fields:
-            return  # Exit early if status was not updated.
+    if not created and not _status_in_update(kwargs):
+        return  # Exit early if status was not updated.
 
     # At this point, it's either a new object, a full save, or a specific status update.
     # We can now apply our business logic.
     if instance.status == Policy.PolicyStatus.ACTIVE:
         create_commission_for_policy(instance)
     elif instance.status == Policy.PolicyStatus.CANCELLED:
-        handle_policy_cancellation_service(instance)
-
+        # Возвраты создаются только при переходе в CANCELLED, а не при каждом save() отмененного полиса
+        if created or getattr(instance, '_previous_status', None) != Policy.PolicyStatus.CANCELLED:
+            handle_policy_cancellation_service(instance)
@@ -1,15 +1,19 @@
-from celery import shared_task
+from celery import chord, shared_task
 from django.utils import timezone
 from datetime import timedelta
-from django.core.mail import send_mail
+from django.core.files.storage import default_storage
+from backend.apps.core.reminders import send_reminder_digests
 from .models import Policy, InsuranceIngestionTask
-from .ingestion import process_insurance_commission_statement_logic
+from .ingestion import (
+    merge_results, process_insurance_commission_statement_logic, process_statement_part, record_chunk_progress,
+    register_statement, split_statement,
+)
 
 @shared_task
 def send_policy_renewal_reminders():
     """
     Отправляет email-уведомления для страховых полисов, которые скоро требуют продления.
-    Срабатывает за 30 дней до даты продления.
+    Срабатывает за 30 дней до даты продления; консультант получает одно письмо по всем своим полисам.
     """
     thirty_days_from_now = timezone.now().date() + timedelta(days=30)
     today = timezone.now().date()
@@ -22,57 +26,102 @@ def send_policy_renewal_reminders():
         renewal_reminder_sent=False
     )
 
-    count = 0
-    for policy in expiring_policies:
-        if policy.adviser and hasattr(policy.adviser, 'user') and policy.adviser.user.email:
-            send_mail(
-                'Policy Renewal Reminder',
-                f'Dear {policy.adviser.user.get_full_name()},\n\n'
-                f'This is a reminder that the insurance policy for client {policy.client} '
-                f'(policy number {policy.policy_number}) is due for renewal on {policy.renewal_date}.',
-                'from@example.com',
-                [policy.adviser.user.email],
-                fail_silently=False,
-            )
-
-            # Помечаем, что уведомление отправлено
-            policy.renewal_reminder_sent = True
-            policy.renewal_reminder_date = timezone.now().date()
-            policy.save(update_fields=['renewal_reminder_sent', 'renewal_reminder_date'])
-            count += 1
-
+    count = send_reminder_digests(
+        expiring_policies,
+        subject='Policy Renewal Reminder',
+        intro='The following insurance policies are due for renewal:',
+        describe=lambda policy: f'client {policy.client} (policy number {policy.policy_number}) on {policy.renewal_date}',
+        sent_flag='renewal_reminder_sent',
+        sent_date='renewal_reminder_date',
+    )
     return f"Sent {count} policy renewal reminders."
 
 @shared_task(bind=True)
 def process_insurance_commission_ingestion(self, data, user_id):
     """
-    Асинхро��ная задача для обработки файла с комиссиями.
+    Асинхронная задача для обработки файла с комиссиями.
+    `data` — {'file_path': имя файла в хранилище, 'ingestion_task_id': id записи
+    InsuranceIngestionTask}. Уже успешно импортированный файл пропускается по
+    хэшу содержимого, иначе файл разрезается на части, части обрабатываются
+    параллельно (chord), итог сводит finish_insurance_ingestion.
+    Для совместимости принимается и старый формат {'file_content': строка}.
     """
-    task_id = self.request.id
+    task_id = data.get('ingestion_task_id', self.request.id)
+    file_path = data.get('file_path')
     try:
-        # Получ��ем объект задачи, чтобы обновлять его статус
+        # Получаем объект задачи, чтобы обновлять его статус
         task = InsuranceIngestionTask.objects.get(id=task_id)
         task.status = InsuranceIngestionTask.Status.IN_PROGRESS
+        task.started_at = timezone.now()
         task.save()
 
-        # Данные приходят как словарь от BaseDataIngestionViewSet
-        file_content = data['file_content']
+        if not file_path:
+            result = process_insurance_commission_statement_logic(data['file_content'])
+            return _finish_ingestion(task_id, result)
 
-        # Вызываем основную логику
-        result = process_insurance_commission_statement_logic(file_content)
+        duplicate_of = register_statement(file_path, task_id)
+        if duplicate_of:
+            return _finish_ingestion(task_id, {**merge_results([]), 'duplicate_of': duplicate_of})
 
-        # Обновляем задачу результатом
-        task.status = InsuranceIngestionTask.Status.SUCCESS if result['status'] == 'success' else InsuranceIngestionTask.Status.FAILED
-        task.result = result
-        task.save()
+        parts, failed = split_statement(file_path)
+        if not parts:
+            return _finish_ingestion(task_id, failed or merge_results([]))
 
-        return result
+        InsuranceIngestionTask.objects.filter(pk=task_id).update(total_chunks=len(parts))
+        chord(
+            (process_insurance_statement_part.s(task_id, name, first_line) for name, first_line in parts),
+            finish_insurance_ingestion.s(task_id),
+        ).on_error(fail_insurance_ingestion.si(task_id, [name for name, _ in parts])).apply_async()
+        return {'status': 'in_progress', 'chunks': len(parts)}
 
     except Exception as e:
         # В случае непредвиденной ошибки
-        task = InsuranceIngestionTask.objects.filter(id=task_id).first()
-        if task:
-            task.status = InsuranceIngestionTask.Status.FAILED
-            task.result = {'errors': [f'Неожиданная ошибка выполнения задачи: {str(e)}']}
-            task.save()
-        return {'status': 'failed', 'errors': [str(e)]}
+        return _fail_ingestion(task_id, e)
+
+    finally:
+        # Части уже сохранены отдельными файлами, исходный файл больше не нужен
+        if file_path:
+            default_storage.delete(file_path)
+
+
+@shared_task
+def process_insurance_statement_part(ingestion_task_id, name, first_line):
+    """Обрабатывает одну часть выписки и добавляет ее прогресс в запись задачи."""
+    try:
+        result = process_statement_part(name, first_line)
+    finally:
+        default_storage.delete(name)
+    record_chunk_progress(ingestion_task_id, result)
+    return result
+
+
+@shared_task
+def finish_insurance_ingestion(results, ingestion_task_id):
+    """Сводит результаты частей в итог импорта."""
+    return _finish_ingestion(ingestion_task_id, merge_results(results))
+
+
+@shared_task
+def fail_insurance_ingestion(ingestion_task_id, part_names):
+    """Помечает импорт неуспешным, если упала одна из частей, и удаляет оставшиеся части."""
+    for name in part_names:
+        default_storage.delete(name)
+    _fail_ingestion(ingestion_task_id, 'обработка одной из частей файла завершилась ошибкой')
+
+
+def _finish_ingestion(ingestion_task_id, result):
+    InsuranceIngestionTask.objects.filter(pk=ingestion_task_id).update(
+        status=InsuranceIngestionTask.Status.SUCCESS if result['status'] == 'success' else InsuranceIngestionTask.Status.FAILED,
+        result=result,
+        finished_at=timezone.now(),
+    )
+    return result
+
+
+def _fail_ingestion(ingestion_task_id, error):
+    InsuranceIngestionTask.objects.filter(pk=ingestion_task_id).update(
+        status=InsuranceIngestionTask.Status.FAILED,
+        result={'errors': [f'Неожиданная ошибка выполнения задачи: {error}']},
+        finished_at=timezone.now(),
+    )
+    return {'status': 'failed', 'errors': [str(error)]}
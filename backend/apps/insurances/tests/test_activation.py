@@ -0,0 +1,108 @@
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from backend.apps.core.models import Adviser, Client
+from backend.apps.insurances.models import Commission, InsuranceType, Insurer, Override, Policy
+from backend.apps.insurances.services import activate_policies
+
+User = get_user_model()
+
+COMMISSION_FIELDS = (
+    'gross_commission', 'net_commission', 'adviser_fee_percentage', 'adviser_fee_amount', 'date_received',
+    'payment_status',
+)
+
+
+class BulkActivationTests(TestCase):
+
+    def setUp(self):
+        self.manager = self._adviser('manager', fee='90.00', override='7.50')
+        self.adviser = self._adviser('adviser', fee='55.50', manager=self.manager)
+        self.solo = self._adviser('solo', fee='80.00')
+        self.client_record = Client.objects.create(name='Client')
+        self.insurer = Insurer.objects.create(
+            name='Insurer', default_gross_commission_rate=Decimal('22.50'), default_net_rate=Decimal('90.00')
+        )
+        self.life = InsuranceType.objects.create(name='Life')
+        self.health = InsuranceType.objects.create(
+            name='Health', default_gross_commission_rate=Decimal('31.25'), default_net_rate=Decimal('85.00')
+        )
+
+    def _adviser(self, username, fee, override='0.00', manager=None):
+        user = User.objects.create_user(username=username, password='password', first_name=username.title())
+        return Adviser.objects.create(
+            user=user, default_fee_percentage=Decimal(fee), default_override_percentage=Decimal(override), manager=manager
+        )
+
+    def _policies(self, prefix):
+        specs = [
+            (self.adviser, self.life, '123.45'), (self.adviser, self.health, '77.77'),
+            (self.solo, self.life, '10.01'), (self.solo, self.health, '999.99'),
+        ]
+        return [
+            Policy.objects.create(
+                policy_number=f'{prefix}-{i}', insurer=self.insurer, client=self.client_record, adviser=adviser,
+                insurance_type=insurance_type, start_date='2023-01-01', coverage_amount=Decimal('1000.00'),
+                monthly_premium=Decimal(premium),
+            )
+            for i, (adviser, insurance_type, premium) in enumerate(specs)
+        ]
+
+    def _snapshot(self, prefix):
+        commissions = [
+            Commission.objects.filter(policy__policy_number=f'{prefix}-{i}').values(*COMMISSION_FIELDS).first()
+            for i in range(4)
+        ]
+        overrides = [
+            list(Override.objects.filter(commission__policy__policy_number=f'{prefix}-{i}').values_list(
+                'recipient_id', 'amount', 'reason'
+            ))
+            for i in range(4)
+        ]
+        return commissions, overrides
+
+    def test_bulk_activation_matches_per_policy_path(self):
+        for policy in self._policies('SINGLE'):
+            policy.status = Policy.PolicyStatus.ACTIVE
+            policy.save()
+        report = activate_policies([policy.id for policy in self._policies('BULK')], chunk_size=3)
+
+        self.assertEqual(report, {'activated': 4, 'commissions': 4})
+        single = self._snapshot('SINGLE')
+        self.assertNotIn(None, single[0])
+        self.assertEqual(self._snapshot('BULK'), single)
+        self.assertEqual(Override.objects.filter(commission__policy__policy_number__startswith='BULK').count(), 2)
+        self.assertEqual(Policy.objects.filter(status=Policy.PolicyStatus.ACTIVE).count(), 8)
+
+        # Повтор не создает вторых комиссий
+        self.assertEqual(
+            activate_policies(Policy.objects.values_list('id', flat=True)), {'activated': 0, 'commissions': 0}
+        )
+
+    def test_already_active_policy_keeps_its_date_and_zero_override_is_skipped(self):
+        self.manager.default_override_percentage = Decimal('0.00')
+        self.manager.save()
+        policy = self._policies('OLD')[0]
+        # Полис стал активным раньше, без комиссии (например, массовым UPDATE)
+        Policy.objects.filter(pk=policy.pk).update(
+            status=Policy.PolicyStatus.ACTIVE, updated_at=timezone.make_aware(datetime(2023, 5, 17, 12, 0)),
+        )
+
+        self.assertEqual(activate_policies([policy.id]), {'activated': 0, 'commissions': 1})
+        self.assertEqual(Commission.objects.get(policy=policy).date_received, date(2023, 5, 17))
+        self.assertFalse(Override.objects.exists())
+
+    def test_queries_do_not_depend_on_policy_count(self):
+        def activation_queries(prefix, copies):
+            ids = [policy.id for i in range(copies) for policy in self._policies(f'{prefix}{i}')]
+            with CaptureQueriesContext(connection) as context:
+                activate_policies(ids)
+            return len(context.captured_queries)
+
+        self.assertEqual(activation_queries('A', 1), activation_queries('B', 5))
@@ -0,0 +1,126 @@
+from decimal import Decimal
+
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from backend.apps.core.models import Adviser, Client
+from backend.apps.insurances.models import Clawback, Commission, InsuranceType, Insurer, Override, Policy
+from backend.apps.insurances.services import backfill_clawback_sources, cancel_policies
+
+User = get_user_model()
+
+
+class PolicyCancellationTests(TestCase):
+
+    def setUp(self):
+        self.manager = self._adviser('manager')
+        self.adviser = self._adviser('adviser')
+        self.client_record = Client.objects.create(name='Client')
+        self.insurer = Insurer.objects.create(name='Insurer')
+        self.insurance_type = InsuranceType.objects.create(name='Life')
+
+    def _adviser(self, username):
+        return Adviser.objects.create(user=User.objects.create_user(username=username, password='password'))
+
+    def _policy(self, number, override=True):
+        policy = Policy.objects.create(
+            policy_number=number, insurer=self.insurer, client=self.client_record, adviser=self.adviser,
+            insurance_type=self.insurance_type, start_date='2023-01-01', coverage_amount=Decimal('1000.00'),
+            monthly_premium=Decimal('10.00'),
+        )
+        commission = Commission.objects.create(
+            policy=policy, gross_commission=Decimal('100.00'), net_commission=Decimal('100.00'),
+            adviser_fee_percentage=Decimal('80.00'), date_received='2023-10-01',
+        )
+        if override:
+            Override.objects.create(commission=commission, recipient=self.manager, amount=Decimal('5.00'), reason='Override')
+        return policy
+
+    def _clawbacks(self):
+        return sorted(Clawback.objects.values_list('commission__policy__policy_number', 'source', 'amount'))
+
+    def test_bulk_cancellation_creates_each_clawback_once(self):
+        policies = [self._policy('POL-1'), self._policy('POL-2', override=False), self._policy('POL-3')]
+        # Одна отмена через save(): сигнал создает возвраты по одному полису
+        policies[0].status = Policy.PolicyStatus.CANCELLED
+        policies[0].save()
+
+        report = cancel_policies([policy.id for policy in policies], reason='Insurer withdrawal', chunk_size=2)
+        self.assertEqual(report, {'policies': 2, 'clawbacks': 3})
+        self.assertEqual(self._clawbacks(), [
+            ('POL-1', Clawback.Source.ADVISER_FEE, Decimal('-80.00')),
+            ('POL-1', Clawback.Source.OVERRIDE, Decimal('-5.00')),
+            ('POL-2', Clawback.Source.ADVISER_FEE, Decimal('-80.00')),
+            ('POL-3', Clawback.Source.ADVISER_FEE, Decimal('-80.00')),
+            ('POL-3', Clawback.Source.OVERRIDE, Decimal('-5.00')),
+        ])
+        self.assertEqual(
+            set(Commission.objects.values_list('payment_status', flat=True)), {Commission.PaymentStatus.CLAWBACK}
+        )
+        self.assertEqual(Policy.objects.get(policy_number='POL-3').policy_cancellation_reason, 'Insurer withdrawal')
+
+        # Повторный вызов ничего не дублирует
+        self.assertEqual(cancel_policies([policy.id for policy in policies]), {'policies': 0, 'clawbacks': 0})
+        self.assertEqual(len(self._clawbacks()), 5)
+
+    def test_clawback_source_is_unique(self):
+        policy = self._policy('POL-1')
+        cancel_policies([policy.id])
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Clawback.objects.create(
+                commission=policy.commission, amount=Decimal('-1.00'), reason='dup', source=Clawback.Source.ADVISER_FEE
+            )
+        # Ручные возвраты не ограничены
+        Clawback.objects.create(commission=policy.commission, amount=Decimal('-1.00'), reason='manual')
+        Clawback.objects.create(commission=policy.commission, amount=Decimal('-1.00'), reason='manual')
+
+    def test_queries_do_not_depend_on_policy_count(self):
+        def cancellation_queries(prefix, count):
+            ids = [self._policy(f'{prefix}-{i}').id for i in range(count)]
+            with CaptureQueriesContext(connection) as context:
+                cancel_policies(ids)
+            return len(context.captured_queries)
+
+        self.assertEqual(cancellation_queries('A', 2), cancellation_queries('B', 10))
+
+    def test_resaving_cancelled_policy_does_not_reclaw(self):
+        policy = self._policy('POL-1')
+        policy.status = Policy.PolicyStatus.CANCELLED
+        policy.save()
+        self.assertEqual(len(self._clawbacks()), 2)
+
+        # Возврат вознаграждения списан вручную; повторный save() отмененного полиса его не воссоздает
+        Clawback.objects.filter(source=Clawback.Source.ADVISER_FEE).delete()
+        policy.policy_cancellation_reason = 'Updated'
+        policy.save()
+        self.assertEqual(self._clawbacks(), [('POL-1', Clawback.Source.OVERRIDE, Decimal('-5.00'))])
+
+    def test_backfill_links_legacy_clawbacks_to_sources(self):
+        policy = self._policy('POL-1')
+        commission = policy.commission
+        fee_reason = 'Clawback of adviser fee for cancelled policy POL-1.'
+        Clawback.objects.create(commission=commission, amount=Decimal('-80.00'), reason=fee_reason)
+        # Дубль старой повторной отмены остается ручным
+        Clawback.objects.create(commission=commission, amount=Decimal('-80.00'), reason=fee_reason)
+        Clawback.objects.create(
+            commission=commission, amount=Decimal('-5.00'),
+            reason='Clawback of override for manager due to policy cancellation.',
+        )
+        Clawback.objects.create(commission=commission, amount=Decimal('-1.00'), reason='manual')
+
+        call_command('backfill_clawback_sources', stdout=StringIO())
+        self.assertEqual(sorted(Clawback.objects.values_list('source', 'source_override_id')), [
+            (Clawback.Source.ADVISER_FEE, None),
+            (Clawback.Source.MANUAL, None),
+            (Clawback.Source.MANUAL, None),
+            (Clawback.Source.OVERRIDE, commission.override_set.get().id),
+        ])
+
+        # После заполнения отмена не создает вторых возвратов, повторное заполнение ничего не меняет
+        self.assertEqual(cancel_policies([policy.id]), {'policies': 1, 'clawbacks': 0})
+        self.assertEqual(backfill_clawback_sources(), {'adviser_fee': 0, 'override': 0})
@@ -0,0 +1,79 @@
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from backend.apps.core.models import Adviser, Client
+from backend.apps.core.reminders import send_reminder_digests
+from backend.apps.insurances.models import InsuranceType, Insurer, Policy
+from backend.apps.insurances.tasks import send_policy_renewal_reminders
+
+User = get_user_model()
+
+
+class RenewalReminderTests(TestCase):
+
+    def setUp(self):
+        self.today = timezone.now().date()
+        self.client_record = Client.objects.create(name='Client')
+        self.insurer = Insurer.objects.create(name='Insurer')
+        self.insurance_type = InsuranceType.objects.create(name='Life')
+
+    def _adviser(self, username, email):
+        user = User.objects.create_user(username=username, password='password', email=email)
+        return Adviser.objects.create(user=user)
+
+    def _policy(self, number, adviser, days=10):
+        policy = Policy.objects.create(
+            policy_number=number, insurer=self.insurer, client=self.client_record, adviser=adviser,
+            insurance_type=self.insurance_type, start_date='2023-01-01', coverage_amount=Decimal('1000.00'),
+            monthly_premium=Decimal('10.00'), renewal_date=self.today + timedelta(days=days),
+        )
+        # Через update, чтобы активация не создавала комиссию сигналом
+        Policy.objects.filter(pk=policy.pk).update(status=Policy.PolicyStatus.ACTIVE)
+        return policy
+
+    def test_one_digest_per_adviser_and_bulk_flags(self):
+        alice = self._adviser('alice', 'alice@example.com')
+        bob = self._adviser('bob', 'bob@example.com')
+        silent = self._adviser('silent', '')
+        for i in range(3):
+            self._policy(f'A-{i}', alice)
+        self._policy('B-1', bob)
+        self._policy('S-1', silent)
+        self._policy('A-late', alice, days=60)
+
+        self.assertEqual(send_policy_renewal_reminders(), "Sent 4 policy renewal reminders.")
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), ['alice@example.com', 'bob@example.com'])
+        digest = next(message for message in mail.outbox if message.to == ['alice@example.com'])
+        self.assertEqual(sum(f'A-{i}' in digest.body for i in range(3)), 3)
+        self.assertEqual(
+            set(Policy.objects.filter(renewal_reminder_sent=True).values_list('policy_number', flat=True)),
+            {'A-0', 'A-1', 'A-2', 'B-1'},
+        )
+        self.assertEqual(Policy.objects.get(policy_number='B-1').renewal_reminder_date, self.today)
+
+        # Повторный запуск ничего не отправляет
+        self.assertEqual(send_policy_renewal_reminders(), "Sent 0 policy renewal reminders.")
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_queries_per_batch_do_not_depend_on_policies(self):
+        advisers = [self._adviser(f'adviser{i}', f'adviser{i}@example.com') for i in range(4)]
+        for i in range(12):
+            self._policy(f'P-{i}', advisers[i % 4])
+
+        with CaptureQueriesContext(connection) as context:
+            count = send_reminder_digests(
+                Policy.objects.all(), subject='Reminder', intro='Due:', describe=str,
+                sent_flag='renewal_reminder_sent', sent_date='renewal_reminder_date', batch_size=6,
+            )
+        self.assertEqual(count, 12)
+        self.assertEqual(len(mail.outbox), 4)
+        # Один SELECT и по UPDATE на пакет: группы консультантов не режутся между пакетами
+        self.assertEqual(len([q for q in context.captured_queries if q['sql'].startswith('UPDATE')]), 2)
+        self.assertEqual(len([q for q in context.captured_queries if q['sql'].startswith('SELECT')]), 1)
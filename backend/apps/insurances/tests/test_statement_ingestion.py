@@ -0,0 +1,177 @@
+import json
+import tempfile
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from backend.apps.core.models import Adviser, Client
+from backend.apps.insurances import ingestion
+from backend.apps.insurances.ingestion import (
+    STATEMENT_UPLOAD_DIR, process_insurance_commission_statement_logic, save_statement_upload,
+)
+from backend.apps.insurances.models import (
+    Commission, CommissionStatement, InsuranceIngestionTask, InsuranceType, Insurer, Policy,
+)
+from backend.apps.insurances.tasks import process_insurance_commission_ingestion
+
+User = get_user_model()
+
+HEADER = "policy_number,gross_commission,date_received\n"
+
+
+class StatementIngestionTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user(username='adviser', password='password')
+        self.adviser = Adviser.objects.create(user=user, default_fee_percentage=Decimal('80.00'))
+        self.client_record = Client.objects.create(name='Client')
+        self.insurer = Insurer.objects.create(name='Insurer', default_gross_commission_rate=Decimal('20.00'))
+        self.insurance_type = InsuranceType.objects.create(name='Life', default_net_rate=Decimal('50.00'))
+
+    def _policy(self, number, adviser=True):
+        return Policy.objects.create(
+            policy_number=number, insurer=self.insurer, client=self.client_record,
+            adviser=self.adviser if adviser else None, insurance_type=self.insurance_type,
+            start_date='2023-01-01', coverage_amount=Decimal('100000.00'), monthly_premium=Decimal('100.00'),
+        )
+
+    def test_creates_and_updates_commissions_with_fee(self):
+        existing = self._policy('POL-1')
+        Commission.objects.create(
+            policy=existing, gross_commission=Decimal('1.00'), net_commission=Decimal('1.00'),
+            adviser_fee_percentage=Decimal('10.00'), date_received='2023-01-01',
+            payment_status=Commission.PaymentStatus.PAID,
+        )
+        self._policy('POL-2')
+        content = HEADER + "POL-1,1000.00,2023-10-01\nPOL-2,,2023-10-02\n"
+
+        result = process_insurance_commission_statement_logic(content)
+        self.assertEqual(result, {'processed': 2, 'skipped': 0, 'errors': [], 'status': 'success'})
+
+        updated = Commission.objects.get(policy__policy_number='POL-1')
+        self.assertEqual(
+            (updated.gross_commission, updated.net_commission, updated.adviser_fee_amount, updated.payment_status),
+            (Decimal('1000.00'), Decimal('500.00'), Decimal('400.00'), Commission.PaymentStatus.PENDING),
+        )
+        # gross по умолчанию: APV 1200 * 20%
+        created = Commission.objects.get(policy__policy_number='POL-2')
+        self.assertEqual(
+            (created.gross_commission, created.net_commission, created.adviser_fee_percentage, created.adviser_fee_amount),
+            (Decimal('240.00'), Decimal('120.00'), Decimal('80.00'), Decimal('96.00')),
+        )
+
+    def test_row_errors_keep_line_numbers_across_chunks(self):
+        self._policy('POL-1')
+        self._policy('POL-2', adviser=False)
+        content = HEADER + (
+            "POL-1,100.00,2023-10-01\n"
+            "MISSING,100.00,2023-10-01\n"
+            "POL-2,100.00,2023-10-01\n"
+            "POL-1,abc,2023-10-01\n"
+            "POL-1,200.00,2023-10-05\n"
+        )
+
+        result = process_insurance_commission_statement_logic(content, chunk_size=2)
+        self.assertEqual(result['status'], 'partial_success')
+        self.assertEqual(result['processed'], 2)
+        self.assertEqual(len(result['errors']), 3)
+        self.assertEqual(result['errors'][0], "Строка 3: Полис с номером 'MISSING' не найден.")
+        self.assertTrue(result['errors'][1].startswith("Строка 4: Ошибка данных"))
+        self.assertTrue(result['errors'][2].startswith("Строка 5: Ошибка данных"))
+        # Последняя строка по полису побеждает
+        self.assertEqual(Commission.objects.get().gross_commission, Decimal('200.00'))
+
+        result = process_insurance_commission_statement_logic("policy_number,amount\nPOL-1,1\n")
+        self.assertEqual(result['status'], 'failed')
+
+    def test_queries_per_chunk_do_not_depend_on_rows(self):
+        def ingestion_queries(prefix, count):
+            for i in range(count):
+                self._policy(f'{prefix}-{i}')
+            content = HEADER + ''.join(f"{prefix}-{i},100.00,2023-10-01\n" for i in range(count))
+            with CaptureQueriesContext(connection) as context:
+                result = process_insurance_commission_statement_logic(content)
+            self.assertEqual(result['processed'], count)
+            return len(context.captured_queries)
+
+        self.assertEqual(ingestion_queries('A', 5), ingestion_queries('B', 20))
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_statement_parts_run_as_chord_with_progress(self):
+        self._policy('POL-1')
+        self._policy('POL-2')
+        rows = "POL-1,100.00,2023-10-01\nMISSING,1.00,2023-10-01\nPOL-2,50.00,2023-10-01\nPOL-1,200.00,2023-10-02\nPOL-2,,2023-10-02\n"
+        upload = SimpleUploadedFile('statement.csv', ('\ufeff' + HEADER + rows).encode())
+        record = InsuranceIngestionTask.objects.create()
+        data = {'file_path': save_statement_upload(upload), 'ingestion_task_id': record.pk}
+        # Через брокер уходит только ссылка на файл
+        self.assertEqual(json.loads(json.dumps(data)), data)
+
+        conf = process_insurance_commission_ingestion.app.conf
+        conf.task_always_eager = True
+        self.addCleanup(setattr, conf, 'task_always_eager', False)
+        with mock.patch.object(ingestion, 'STATEMENT_CHUNK_SIZE', 2):
+            process_insurance_commission_ingestion.delay(data, None)
+
+        record.refresh_from_db()
+        self.assertEqual(record.status, InsuranceIngestionTask.Status.FAILED)
+        self.assertEqual(record.result, {
+            'processed': 4, 'skipped': 0, 'errors': ["Строка 3: Полис с номером 'MISSING' не найден."],
+            'status': 'partial_success',
+        })
+        self.assertEqual(
+            (record.total_chunks, record.chunks_done, record.rows_done, record.error_count), (3, 3, 5, 1)
+        )
+        self.assertIsNotNone(record.rows_per_second)
+        # В eager-режиме части идут по порядку: побеждает последняя строка полиса
+        self.assertEqual(
+            dict(Commission.objects.values_list('policy__policy_number', 'gross_commission')),
+            {'POL-1': Decimal('200.00'), 'POL-2': Decimal('240.00')},
+        )
+        self.assertEqual(default_storage.listdir(STATEMENT_UPLOAD_DIR)[1], [])
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_repeated_and_overlapping_statements_skip_unchanged_rows(self):
+        for number in ('POL-1', 'POL-2', 'POL-3'):
+            self._policy(number)
+        conf = process_insurance_commission_ingestion.app.conf
+        conf.task_always_eager = True
+        self.addCleanup(setattr, conf, 'task_always_eager', False)
+
+        def ingest(rows):
+            record = InsuranceIngestionTask.objects.create()
+            upload = SimpleUploadedFile('statement.csv', (HEADER + rows).encode())
+            process_insurance_commission_ingestion.delay(
+                {'file_path': save_statement_upload(upload), 'ingestion_task_id': record.pk}, None
+            )
+            record.refresh_from_db()
+            return record.result
+
+        first = "POL-1,100.00,2023-10-01\nPOL-2,100.00,2023-10-01\n"
+        self.assertEqual(ingest(first)['processed'], 2)
+        Commission.objects.filter(policy__policy_number='POL-1').update(payment_status=Commission.PaymentStatus.PAID)
+
+        # Тот же файл отсекается по хэшу
+        duplicate = ingest(first)
+        self.assertEqual((duplicate['processed'], duplicate['status']), (0, 'success'))
+        self.assertIn('duplicate_of', duplicate)
+        self.assertEqual(CommissionStatement.objects.count(), 1)
+
+        # В пересекающемся файле обрабатываются только новые и измененные строки
+        overlap = ingest("POL-1,100.0,2023-10-01\nPOL-2,150.00,2023-10-01\nPOL-3,100.00,2023-10-01\n")
+        self.assertEqual((overlap['processed'], overlap['skipped']), (2, 1))
+        commissions = {c.policy.policy_number: c for c in Commission.objects.select_related('policy')}
+        self.assertEqual(commissions['POL-1'].payment_status, Commission.PaymentStatus.PAID)
+        self.assertEqual(commissions['POL-2'].gross_commission, Decimal('150.00'))
+
+        # Удаленная комиссия снова создается из той же строки
+        commissions['POL-3'].delete()
+        again = ingest("POL-3,100.00,2023-10-01\nPOL-1,100.00,2023-10-01\n")
+        self.assertEqual((again['processed'], again['skipped']), (1, 1))
+        self.assertTrue(Commission.objects.filter(policy__policy_number='POL-3').exists())
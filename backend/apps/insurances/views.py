@@ -16,13 +16,17 @@ from .models import (
 from .serializers import (
     PolicyListSerializer, PolicyDetailSerializer, PolicyWriteSerializer, InsurerSerializer, CommissionSerializer,
     RetentionSerializer, ClawbackSerializer, BonusSerializer, OverrideSerializer, ReferralFeeSerializer,
-    InsuranceCommissionDataIngestionSerializer, InsuranceIngestionTaskSerializer, InsuranceTypeSerializer
+    InsuranceCommissionDataIngestionSerializer, InsuranceIngestionTaskSerializer, InsuranceTypeSerializer,
+    PolicyBulkActivationSerializer
 )
 from backend.apps.core.permissions import IsAdminOrReadOnly, IsOwnerOrManager, HasReportAccess
 from .filters import PolicyFilter
 from .tasks import process_insurance_commission_ingestion
+from .ingestion import save_statement_upload
+from .services import activate_policies
 from backend.apps.core.views import BaseModifierViewSet, BaseRelatedObjectViewSet, BaseDashboardViewSet, BaseReportingViewSet, BaseDataIngestionViewSet
 from backend.apps.core.mixins import HierarchicalQuerySetMixin, AdviserObjectOwnerMixin
+from backend.apps.core.pagination import KeysetPagination
 
 
 class ReportingViewSet(HierarchicalQuerySetMixin, BaseReportingViewSet):
@@ -143,6 +147,8 @@ class PolicyViewSet(HierarchicalQuerySetMixin, AdviserObjectOwnerMixin, viewsets
     filterset_class = PolicyFilter
     search_fields = ['policy_number', 'client__name', 'insurer__name']
     ordering_fields = ['start_date', 'renewal_date', 'annual_premium_value']
+    pagination_class = KeysetPagination
+    keyset_ordering = ('-created_at', '-id')
     related_field_path = 'adviser' # for HierarchicalQuerySetMixin
 
     def get_serializer_class(self):
@@ -150,8 +156,18 @@ class PolicyViewSet(HierarchicalQuerySetMixin, AdviserObjectOwnerMixin, viewsets
             return PolicyWriteSerializer
         if self.action == 'list':
             return PolicyListSerializer
+        if self.action == 'bulk_activate':
+            return PolicyBulkActivationSerializer
         return PolicyDetailSerializer
 
+    @action(detail=False, methods=['post'], url_path='bulk-activate', permission_classes=[permissions.IsAdminUser])
+    def bulk_activate(self, request):
+        """Activates policies by id in bulk and creates their commissions and overrides."""
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        report = activate_policies(serializer.validated_data['policy_ids'])
+        return Response(report, status=status.HTTP_200_OK)
+
 class CommissionViewSet(BaseRelatedObjectViewSet):
     """API endpoint for insurance commissions with hierarchical permissions."""
     queryset = Commission.objects.select_related('policy__adviser').all()
@@ -204,3 +220,10 @@ class IngestionViewSet(BaseDataIngestionViewSet):
     serializer_class = InsuranceIngestionTaskSerializer
     ingestion_serializer_class = InsuranceCommissionDataIngestionSerializer
     task_function = process_insurance_commission_ingestion
+
+    def get_task_payload(self, validated_data, task_instance):
+        # Через брокер передается только ссылка на файл, а не его содержимое
+        return {
+            'file_path': save_statement_upload(validated_data['file']),
+            'ingestion_task_id': task_instance.pk,
+        }
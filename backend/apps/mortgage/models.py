@@ -29,6 +29,12 @@ class MortgageCase(models.Model):
     mortgage_expiry_reminder_date = models.DateField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Keyset-пагинация списков
+            models.Index(fields=['created_at', 'id']),
+        ]
+
     def __str__(self):
         return self.case_number
 
@@ -39,6 +45,12 @@ class Commission(models.Model):
     net_commission = models.DecimalField(max_digits=10, decimal_places=2)
     date_received = models.DateField()
 
+    class Meta:
+        indexes = [
+            # Keyset-пагинация списков
+            models.Index(fields=['date_received', 'id']),
+        ]
+
     def __str__(self):
         return f"Commission for {self.mortgage_case.case_number}"
 
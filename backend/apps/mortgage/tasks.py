@@ -1,14 +1,14 @@
 from celery import shared_task
 from django.utils import timezone
 from datetime import timedelta
-from django.core.mail import send_mail
+from backend.apps.core.reminders import send_reminder_digests
 from .models import MortgageCase, Commission, MortgageIngestionTask
 
 @shared_task
 def send_mortgage_expiry_reminders():
     """
     Отправляет email-уведомления для ипотечных кейсов, которые скоро истекают.
-    Сраб��тывает за 4 месяца (120 дней) до даты истечения.
+    Срабатывает за 4 месяца (120 дней) до даты истечения; консультант получает одно письмо по всем своим кейсам.
     """
     four_months_from_now = timezone.now().date() + timedelta(days=120)
     today = timezone.now().date()
@@ -21,25 +21,14 @@ def send_mortgage_expiry_reminders():
         mortgage_expiry_reminder_sent=False
     )
 
-    count = 0
-    for case in expiring_cases:
-        if case.adviser and hasattr(case.adviser, 'user') and case.adviser.user.email:
-            send_mail(
-                'Mortgage Expiry Reminder',
-                f'Dear {case.adviser.user.get_full_name()},\n\n'
-                f'This is a reminder that the mortgage for client {case.client} '
-                f'(case number {case.case_number}) is expiring on {case.expiry_date}.',
-                'from@example.com',
-                [case.adviser.user.email],
-                fail_silently=False,
-            )
-
-            # Помечаем, что уведомление отправлено
-            case.mortgage_expiry_reminder_sent = True
-            case.mortgage_expiry_reminder_date = timezone.now().date()
-            case.save(update_fields=['mortgage_expiry_reminder_sent', 'mortgage_expiry_reminder_date'])
-            count += 1
-
+    count = send_reminder_digests(
+        expiring_cases,
+        subject='Mortgage Expiry Reminder',
+        intro='The following mortgages are expiring soon:',
+        describe=lambda case: f'client {case.client} (case number {case.case_number}) on {case.expiry_date}',
+        sent_flag='mortgage_expiry_reminder_sent',
+        sent_date='mortgage_expiry_reminder_date',
+    )
     return f"Sent {count} mortgage expiry reminders."
 
 @shared_task(bind=True)
@@ -23,6 +23,7 @@ from backend.apps.core.views import (
     BaseModifierViewSet, BaseDataIngestionViewSet
 )
 from backend.apps.core.mixins import AdviserObjectOwnerMixin, HierarchicalQuerySetMixin
+from backend.apps.core.pagination import KeysetPagination
 from .tasks import process_mortgage_commission_ingestion
 from . import reports
 
@@ -63,6 +64,8 @@ class CommissionViewSet(BaseRelatedObjectViewSet):
     permission_classes = [permissions.IsAuthenticated, IsOwnerOrManager]
     filter_backends = [DjangoFilterBackend]
     filterset_class = CommissionFilter
+    pagination_class = KeysetPagination
+    keyset_ordering = ('-date_received', '-id')
     related_field_path = 'mortgage_case__adviser'
 
 @extend_schema(tags=['Mortgage'])
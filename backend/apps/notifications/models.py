@@ -27,6 +27,10 @@ class Notification(models.Model):
         verbose_name = "Уведомление"
         verbose_name_plural = "Уведомления"
         ordering = ["-created_at"]
+        indexes = [
+            # Keyset-пагинация списка уведомлений пользователя
+            models.Index(fields=["user", "created_at", "id"]),
+        ]
 
     def __str__(self):
         return f"Уведомление для {self.user.username}: {self.message}"
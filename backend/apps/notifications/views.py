@@ -3,6 +3,7 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from .models import Notification
 from .serializers import NotificationSerializer
+from backend.apps.core.pagination import KeysetPagination
 
 
 class NotificationViewSet(viewsets.ReadOnlyModelViewSet):
@@ -10,6 +11,8 @@ class NotificationViewSet(viewsets.ReadOnlyModelViewSet):
     API для просмотра и управления уведомлениями.
     """
     serializer_class = NotificationSerializer
+    pagination_class = KeysetPagination
+    keyset_ordering = ('-created_at', '-id')
 
     def get_queryset(self):
         return self.request.user.notifications.all()
@@ -1,5 +1,6 @@
 from pathlib import Path
 import environ
+from celery.schedules import crontab
 
 # Initialize django-environ
 env = environ.Env(
@@ -102,6 +103,15 @@ CACHES = {
         "LOCATION": "unique-snowflake",
     }
 }
+# Версии скомпилированных правил, значков и цепочек руководителей меняются
+# в одном процессе и должны быть видны остальным. LocMemCache живет в памяти
+# процесса, поэтому при нескольких воркерах (gunicorn, Celery) нужно задать
+# CACHE_REDIS_URL — тогда кэш общий, в Redis.
+if env('CACHE_REDIS_URL', default=''):
+    CACHES["default"] = {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": env('CACHE_REDIS_URL'),
+    }
 
 AUTH_USER_MODEL = "users.User"
 
@@ -119,6 +129,22 @@ CELERY_BEAT_SCHEDULE = {
         "task": "apps.notifications.tasks.check_expiring_mortgages",
         "schedule": 86400.0,  # every 24 hours
     },
+    "send-team-commission-reports-monthly": {
+        "task": "backend.apps.commission.tasks.send_team_commission_reports",
+        "schedule": crontab(minute=0, hour=6, day_of_month=1),
+    },
+    "mark-due-scheduled-payouts-daily": {
+        "task": "backend.apps.commission.tasks.mark_due_scheduled_payouts",
+        "schedule": crontab(minute=0, hour=5),
+    },
+}
+
+# Channels (websocket-события о сделках, commission.consumers)
+CHANNEL_LAYERS = {
+    "default": {
+        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "CONFIG": {"hosts": [env('CHANNEL_LAYER_REDIS_URL', default='redis://localhost:6379/1')]},
+    },
 }
 
 